@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Admission control for submissions, so a few large or concurrent uploads
+can't fill the disks or tie up every CPU encrypting.
+
+Before the body of a submission is read, and so before anything is spooled
+to disk, :meth:`Admission.admit` refuses it, raising :class:`UploadRefused`,
+if:
+
+* it has no `Content-Length`, or one above `UPLOAD_MAX_BYTES` (which
+  defaults to Flask's `MAX_CONTENT_LENGTH`);
+* there isn't room for it, plus `UPLOAD_MIN_FREE_BYTES`, where it's spooled
+  (in `SUBMISSION_SPOOL_DIR` with `ASYNC_SUBMISSIONS`) and where it's stored;
+* the source would go over `SOURCE_QUOTA_BYTES`, or the whole store over
+  `STORE_QUOTA_BYTES`, counting what's recorded in the database. The size of
+  the store is summed again every `STORE_BYTES_MAX_AGE` seconds, and what's
+  admitted in between is added to it;
+* `UPLOAD_MAX_CONCURRENT` submissions are already being received and
+  encrypted.
+
+The concurrency limit holds across the processes of the source interface:
+a submission holds an `flock` on one of `UPLOAD_MAX_CONCURRENT` slot files
+until its request ends.
+"""
+import errno
+import fcntl
+import os
+import time
+
+from flask import g
+from sqlalchemy import func
+
+import spool
+
+from db import db
+from models import Reply, Submission
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Dict, Optional  # noqa: F401
+
+# Why a submission was refused, with the HTTP status it's refused with
+LENGTH_REQUIRED = 'length_required'
+TOO_LARGE = 'too_large'
+DISK_FULL = 'disk_full'
+SOURCE_QUOTA = 'source_quota'
+STORE_QUOTA = 'store_quota'
+BUSY = 'busy'
+
+STATUS = {
+    LENGTH_REQUIRED: 411,
+    TOO_LARGE: 413,
+    DISK_FULL: 507,
+    SOURCE_QUOTA: 507,
+    STORE_QUOTA: 507,
+    BUSY: 503,
+}
+
+# How long a source is asked to wait before trying again when busy
+RETRY_AFTER = 60
+
+# How long the size of the store is counted on rather than summed again
+STORE_BYTES_MAX_AGE = 60
+
+
+class UploadRefused(Exception):
+
+    def __init__(self, reason):
+        super(UploadRefused, self).__init__(reason)
+        self.reason = reason
+        self.status = STATUS[reason]
+
+
+class UploadSlots(object):
+
+    """A semaphore of `count` slots shared by every process using the same
+    `directory`. A slot is an `flock` on a file, so it's released even if
+    its process dies."""
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def acquire(self):
+        """Return an open slot file, to pass to :meth:`release`, or `None`
+        if every slot is taken. Doesn't block."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for i in range(self.count):
+            slot = open(os.path.join(self.directory, 'slot-{}'.format(i)),
+                        'a')
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                slot.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            return slot
+        return None
+
+    def release(self, slot):
+        fcntl.flock(slot.fileno(), fcntl.LOCK_UN)
+        slot.close()
+
+
+class Admission(object):
+
+    """The admission policy set in `config`, see :meth:`admit`."""
+
+    def __init__(self, config, max_bytes, spool_dir):
+        self.max_bytes = max_bytes
+        self.min_free_bytes = getattr(config, 'UPLOAD_MIN_FREE_BYTES', 0)
+        self.source_quota = getattr(config, 'SOURCE_QUOTA_BYTES', None)
+        self.store_quota = getattr(config, 'STORE_QUOTA_BYTES', None)
+        if getattr(config, 'ASYNC_SUBMISSIONS', False):
+            # Documents are encrypted into the submission spool as they're
+            # received instead
+            spool_dir = spool.spool_dir(config)
+        self.directories = [spool_dir, config.STORE_DIR]
+        self._store_bytes = None  # type: Optional[int]
+        self._store_bytes_at = 0.0
+        max_concurrent = getattr(config, 'UPLOAD_MAX_CONCURRENT', None)
+        self.slots = None  # type: Optional[UploadSlots]
+        if max_concurrent:
+            self.slots = UploadSlots(
+                os.path.join(config.SECUREDROP_DATA_ROOT, 'upload-slots'),
+                max_concurrent)
+
+    def admit(self, content_length, source=None):
+        """Raise :class:`UploadRefused` if a submission of `content_length`
+        bytes by `source` is to be refused. Otherwise a slot is taken if
+        concurrency is limited, which :meth:`done` releases."""
+        if content_length is None:
+            raise UploadRefused(LENGTH_REQUIRED)
+        if self.max_bytes is not None and content_length > self.max_bytes:
+            raise UploadRefused(TOO_LARGE)
+        self._check_free_space(content_length)
+        if self.source_quota is not None and source is not None:
+            if (_stored_bytes(source.id) + content_length >
+                    self.source_quota):
+                raise UploadRefused(SOURCE_QUOTA)
+        if self.store_quota is not None:
+            if self._stored_bytes() + content_length > self.store_quota:
+                raise UploadRefused(STORE_QUOTA)
+        if self.slots is not None:
+            slot = self.slots.acquire()
+            if slot is None:
+                raise UploadRefused(BUSY)
+            g.upload_slot = slot
+        if self._store_bytes is not None:
+            self._store_bytes += content_length
+
+    def done(self):
+        slot = g.pop('upload_slot', None)
+        if slot is not None:
+            self.slots.release(slot)
+
+    def _stored_bytes(self):
+        now = time.time()
+        if (self._store_bytes is None or
+                now - self._store_bytes_at > STORE_BYTES_MAX_AGE):
+            self._store_bytes = _stored_bytes()
+            self._store_bytes_at = now
+        return self._store_bytes
+
+    def _check_free_space(self, content_length):
+        # The upload is spooled and then stored, which may be on the same
+        # file system
+        needed = {}  # type: Dict[int, int]
+        free = {}  # type: Dict[int, int]
+        for directory in self.directories:
+            # Until it's created, a directory will be on its parent's
+            while not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            st = os.statvfs(directory)
+            device = os.stat(directory).st_dev
+            needed[device] = needed.get(device, 0) + content_length
+            free[device] = st.f_bavail * st.f_frsize
+        for device, size in needed.items():
+            if free[device] < size + self.min_free_bytes:
+                raise UploadRefused(DISK_FULL)
+
+
+def _stored_bytes(source_id=None):
+    total = 0
+    for model in (Submission, Reply):
+        query = db.session.query(func.coalesce(func.sum(model.size), 0))
+        if source_id is not None:
+            query = query.filter(model.source_id == source_id)
+        total += int(query.scalar())
+    return total
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure what the locale handling in the `setup_g` of both web
+applications costs per request, computed from scratch on every request as it
+used to be, and with the tables and negotiation cached by `i18n.py`.
+
+Each request gets one of a few common Accept-Language headers, with no
+locale in the session, which is what the source interface mostly sees.
+
+    $ python benchmarks/i18n_setup_g.py --requests 2000
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+
+from babel import core
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import i18n  # noqa: E402
+
+ACCEPT_LANGUAGES = [
+    'en-US,en;q=0.5',
+    'fr-FR,fr;q=0.8,en-US;q=0.5,en;q=0.3',
+    'de-DE,de;q=0.9',
+    'ar,en;q=0.5',
+    'zh-TW,zh;q=0.8,en;q=0.5',
+]
+
+
+class Config(object):
+
+    DEFAULT_LOCALE = 'en_US'
+
+    def __init__(self, translation_dirs):
+        self.TRANSLATION_DIRS = translation_dirs
+        self.SUPPORTED_LOCALES = ['en_US'] + sorted(
+            name for name in os.listdir(translation_dirs)
+            if name != 'messages.pot')
+
+
+def uncached(config):
+    """The locale handling of `setup_g` before it was cached."""
+    accept_languages = []
+    for l in i18n.request.accept_languages.values():
+        sep = '-' if '-' in l else '_'
+        try:
+            accept_languages.append(str(core.Locale.parse(l, sep)))
+        except Exception:
+            pass
+    locale = (core.negotiate_locale(accept_languages, i18n.LOCALES) or
+              config.DEFAULT_LOCALE)
+    text_direction = core.Locale.parse(locale).text_direction
+    html_lang = i18n.locale_to_rfc_5646(locale)
+    locales = collections.OrderedDict()
+    for l in i18n.LOCALES:
+        if l in i18n.NAME_OVERRIDES:
+            locales[l] = i18n.NAME_OVERRIDES[l]
+        else:
+            parsed = core.Locale.parse(l)
+            locales[l] = parsed.languages[parsed.language]
+    return locale, text_direction, html_lang, locales
+
+
+def cached(config):
+    """The locale handling of `setup_g` now."""
+    locale = i18n.get_locale(config)
+    return (locale,
+            i18n.get_text_direction(locale),
+            i18n.locale_to_rfc_5646(locale),
+            i18n.get_locale2name())
+
+
+def timed(app, func, config, requests):
+    contexts = [app.test_request_context(
+        headers=[('Accept-Language', ACCEPT_LANGUAGES[i % len(
+            ACCEPT_LANGUAGES)])]) for i in range(requests)]
+    elapsed = 0.0
+    for context in contexts:
+        with context:
+            start = time.time()
+            func(config)
+            elapsed += time.time() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--translations', default=os.path.join(
+        os.path.dirname(os.path.abspath(i18n.__file__)), 'translations'),
+        help='translations directory, with one locale per subdirectory')
+    args = parser.parse_args()
+
+    config = Config(args.translations)
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.urandom(32)
+    i18n.setup_app(config, app)
+    print('{} locales, {} distinct Accept-Language headers'.format(
+        len(i18n.LOCALES), len(ACCEPT_LANGUAGES)))
+
+    for name, func in (('uncached', uncached), ('cached', cached)):
+        # Once to warm up babel's own caches
+        timed(app, func, config, len(ACCEPT_LANGUAGES))
+        elapsed = timed(app, func, config, args.requests)
+        print('{:<10} {:>8.2f}s {:>10.1f} us/request'.format(
+            name, elapsed, elapsed / args.requests * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the in-process secure deletion engine in `rm.py` with the
+external `srm` binary it replaced.
+
+Each run deletes a freshly generated collection of `--files` files of
+`--size` bytes, which mimics deleting a source's collection from the store.
+
+    $ python benchmarks/secure_delete.py --files 20 --size 10485760
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rm import SecureDeleter  # noqa: E402
+
+
+def make_collection(parent, files, size):
+    collection = tempfile.mkdtemp(dir=parent)
+    chunk = os.urandom(min(size, 1024 * 1024))
+    for i in range(files):
+        with open(os.path.join(collection,
+                               '{}-benchmark-msg.gpg'.format(i)), 'wb') as f:
+            written = 0
+            while written < size:
+                f.write(chunk[:size - written])
+                written += len(chunk)
+    return collection
+
+
+def timed(func, path):
+    start = time.time()
+    func(path)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    parser.add_argument('--dir', default=None,
+                        help='directory on the disk to benchmark')
+    args = parser.parse_args()
+
+    candidates = [
+        ('SecureDeleter(passes=1)', SecureDeleter(passes=1).delete),
+        ('SecureDeleter(passes=3)', SecureDeleter(passes=3).delete),
+    ]
+    if any(os.access(os.path.join(d, 'srm'), os.X_OK)
+           for d in os.environ.get('PATH', '').split(os.pathsep)):
+        candidates.append(
+            ('srm -r', lambda p: subprocess.check_call(['srm', '-r', p])))
+    else:
+        print('srm not found in PATH, only benchmarking SecureDeleter')
+
+    parent = tempfile.mkdtemp(dir=args.dir)
+    total = args.files * args.size
+    try:
+        for name, func in candidates:
+            collection = make_collection(parent, args.files, args.size)
+            elapsed = timed(func, collection)
+            print('{:<25} {:>8.2f}s {:>10.1f} MB/s'.format(
+                name, elapsed, total / elapsed / 1024 / 1024))
+    finally:
+        shutil.rmtree(parent)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure how long a fresh web server process takes to import each web
+application, create it with `create_app`, and load the template of its
+first page, which is what every Apache worker pays when it starts or is
+recycled.
+
+Each run is a new Python process, so nothing is cached in memory. It uses
+the `config.py` of this directory. The first template is compiled by the
+first run, and loaded from Jinja's bytecode cache by the following ones.
+
+    $ python benchmarks/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a new process for each measurement
+SCRIPT = """
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+start = time.time()
+import {module} as app_module
+from sdconfig import config
+imported = time.time()
+app = app_module.create_app(config)
+created = time.time()
+with app.test_request_context('/'):
+    app.jinja_env.get_template({template!r})
+rendered = time.time()
+print(json.dumps({{
+    'import': imported - start,
+    'create_app': created - imported,
+    'first template': rendered - created,
+    'max RSS (MB)': resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+}}))
+"""
+
+APPS = [('source_app', 'index.html'), ('journalist_app', 'index.html')]
+
+
+def measure(module, template):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(root=ROOT, module=module,
+                                             template=template)],
+        cwd=ROOT)
+    return json.loads(output.splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for module, template in APPS:
+        runs = [measure(module, template) for _ in range(args.runs)]
+        print(module)
+        for name in ('import', 'create_app', 'first template'):
+            print('  {:<16} {:>8.1f} ms'.format(
+                name, median([run[name] for run in runs]) * 1000))
+        print('  {:<16} {:>8.1f} MB'.format(
+            'max RSS', median([run['max RSS (MB)'] for run in runs])))
+
+
+if __name__ == '__main__':
+    main()
@@ -49,7 +49,7 @@ def create_source_and_submissions(num_submissions=2):
         db.session.commit()
 
         # Generate submissions directory and generate source key
-        os.mkdir(app.storage.path(source.filesystem_id))
+        app.storage.create_source_dir(source.filesystem_id)
         app.crypto_util.genkeypair(source.filesystem_id, codename)
 
         # Generate some test submissions
@@ -58,7 +58,6 @@ def create_source_and_submissions(num_submissions=2):
             fpath = app.storage.save_message_submission(
                 source.filesystem_id,
                 source.interaction_count,
-                source.journalist_filename,
                 'test submission!'
             )
             submission = Submission(source, fpath)
@@ -3,8 +3,9 @@
 
 import gnupg
 import os
+import re
 import scrypt
-import subprocess
+import threading
 
 from base64 import b32encode
 from Cryptodome.Random import random
@@ -18,7 +19,7 @@ if typing.TYPE_CHECKING:
     # That is why all type annotation relative import
     # statements has to be marked as noqa.
     # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401stream
-    from typing import Dict, List, Text  # noqa: F401
+    from typing import Dict, List, Optional, Text  # noqa: F401
 
 # to fix gpg error #78 on production
 os.environ['USERNAME'] = 'www-data'
@@ -28,11 +29,14 @@ class CryptoException(Exception):
     pass
 
 
-class CryptoUtil:
+class CryptoUtil(object):
 
     GPG_KEY_TYPE = "RSA"
     DEFAULT_WORDS_IN_RANDOM_ID = 8
 
+    # The user id of the keys `genkeypair` generates
+    SOURCE_KEY_UID = re.compile(r'^Autogenerated Key <(?P<name>.+)>$')
+
     def __init__(self,
                  scrypt_params,
                  scrypt_id_pepper,
@@ -59,27 +63,48 @@ class CryptoUtil:
 
         self.do_runtime_tests()
 
-        self.gpg = gnupg.GPG(binary='gpg2', homedir=gpg_key_dir)
+        # Creating the keyring runs gpg2, and many workers never need it, so
+        # it's created when first used, like the word lists are read
+        self.__gpg_key_dir = gpg_key_dir
+        self.__gpg = None  # type: Optional[gnupg.GPG]
+        self.__gpg_lock = threading.Lock()
 
         # map code for a given language to a localized wordlist
         self.__language2words = {}  # type: Dict[Text, List[str]]
 
-        with open(nouns_file) as f:
-            self.nouns = f.read().splitlines()
-
-        with open(adjectives_file) as f:
-            self.adjectives = f.read().splitlines()
+        self.__nouns_file = nouns_file
+        self.__nouns = None  # type: Optional[List[str]]
+        self.__adjectives_file = adjectives_file
+        self.__adjectives = None  # type: Optional[List[str]]
+
+    @property
+    def gpg(self):
+        if self.__gpg is None:
+            with self.__gpg_lock:
+                if self.__gpg is None:
+                    self.__gpg = gnupg.GPG(binary='gpg2',
+                                           homedir=self.__gpg_key_dir)
+        return self.__gpg
+
+    @property
+    def nouns(self):
+        if self.__nouns is None:
+            with open(self.__nouns_file) as f:
+                self.__nouns = f.read().splitlines()
+        return self.__nouns
+
+    @property
+    def adjectives(self):
+        if self.__adjectives is None:
+            with open(self.__adjectives_file) as f:
+                self.__adjectives = f.read().splitlines()
+        return self.__adjectives
 
     # Make sure these pass before the app can run
     # TODO: Add more tests
     def do_runtime_tests(self):
         if self.scrypt_id_pepper == self.scrypt_gpg_pepper:
             raise AssertionError('scrypt_id_pepper == scrypt_gpg_pepper')
-        # crash if we don't have srm:
-        try:
-            subprocess.check_call(['srm'], stdout=subprocess.PIPE)
-        except subprocess.CalledProcessError:
-            pass
 
     def get_wordlist(self, locale):
         # type: (Text) -> List[str]
@@ -176,6 +201,18 @@ class CryptoUtil:
         self.gpg.delete_keys(key)  # public key
         # TODO: srm?
 
+    def source_keys(self):
+        # type: () -> Dict[Text, Text]
+        """Return the fingerprints of the reply keys of sources, by
+        filesystem id, listing the keyring only once."""
+        keys = {}
+        for key in self.gpg.list_keys():
+            for uid in key['uids']:
+                match = self.SOURCE_KEY_UID.match(uid)
+                if match:
+                    keys[match.group('name')] = key['fingerprint']
+        return keys
+
     def getkey(self, name):
         for key in self.gpg.list_keys():
             for uid in key['uids']:
@@ -208,8 +245,17 @@ class CryptoUtil:
         else:
             raise CryptoException(out.stderr)
 
-    def decrypt(self, secret, ciphertext):
-        """
+    def reply_passphrase(self, secret):
+        """Return the passphrase of the reply key of the source whose
+        codename is `secret`. It's derived with scrypt, which is slow on
+        purpose, so derive it once to decrypt several replies."""
+        return self.hash_codename(secret, salt=self.scrypt_gpg_pepper)
+
+    def decrypt(self, secret, ciphertext, passphrase=None):
+        """Decrypt `ciphertext`, a string or a file-like object that's read
+        as it's decrypted, with the reply key of the source whose codename
+        is `secret`, or its `passphrase` if given.
+
         >>> crypto = current_app.crypto_util
         >>> key = crypto.genkeypair('randomid', 'randomid')
         >>> message = u'Buenos días, mundo hermoso!'
@@ -217,9 +263,12 @@ class CryptoUtil:
         >>> crypto.decrypt('randomid', ciphertext) == message.encode('utf-8')
         True
         """
-        hashed_codename = self.hash_codename(secret,
-                                             salt=self.scrypt_gpg_pepper)
-        return self.gpg.decrypt(ciphertext, passphrase=hashed_codename).data
+        if passphrase is None:
+            passphrase = self.reply_passphrase(secret)
+        if hasattr(ciphertext, 'read'):
+            return self.gpg.decrypt_file(ciphertext,
+                                         passphrase=passphrase).data
+        return self.gpg.decrypt(ciphertext, passphrase=passphrase).data
 
 
 def clean(s, also=''):
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Notifications that sources, submissions or replies changed.
+
+The journalist interface streams changes to the sources list as they happen
+(see `main.events` in :mod:`journalist_app.main`), rather than have
+journalists reload it. What changed is always read from the change journal
+(:class:`models.Change`), which every process writes to; a notification
+only wakes up the streams so they read it right away, instead of at their
+next poll. So a lost notification merely delays an update.
+
+Like jobs in :mod:`worker`, notifications go through Redis, where the web
+applications and the worker all see them, unless `WORKER_BACKEND` is
+``thread``, in which case they only reach the streams of the current
+process.
+"""
+import logging
+import os
+import threading
+import time
+
+from redis import ConnectionPool, Redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'securedrop:changes'
+
+
+class RedisBroadcaster(object):
+
+    """Notify through the Redis pub/sub channel `channel`."""
+
+    name = 'rq'
+
+    def __init__(self, host='localhost', port=6379, db=0, channel=CHANNEL):
+        self.connection = Redis(connection_pool=ConnectionPool(
+            host=host, port=port, db=db))
+        self.channel = channel
+
+    def publish(self):
+        self.connection.publish(self.channel, 'changed')
+
+    def listener(self):
+        return RedisListener(self.connection, self.channel)
+
+
+class RedisListener(object):
+
+    def __init__(self, connection, channel):
+        self.pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a notification, and return
+        whether there was one."""
+        deadline = time.time() + timeout
+        notified = False
+        while True:
+            message = self.pubsub.get_message(
+                timeout=max(deadline - time.time(), 0))
+            if message is None:
+                return notified
+            # Catch up with the notifications that queued up meanwhile,
+            # they are all about the same journal
+            notified = True
+            timeout = 0
+            deadline = time.time()
+
+    def close(self):
+        self.pubsub.close()
+
+
+class LocalBroadcaster(object):
+
+    """Notify the listeners in the current process."""
+
+    name = 'thread'
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__generation = 0
+
+    def publish(self):
+        with self.__condition:
+            self.__generation += 1
+            self.__condition.notify_all()
+
+    def listener(self):
+        return LocalListener(self.__condition, lambda: self.__generation)
+
+
+class LocalListener(object):
+
+    def __init__(self, condition, generation):
+        self.__condition = condition
+        self.__generation = generation
+        self.__seen = generation()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a notification, and return
+        whether there was one."""
+        deadline = time.time() + timeout
+        with self.__condition:
+            while self.__generation() == self.__seen:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.__condition.wait(remaining)
+            self.__seen = self.__generation()
+            return True
+
+    def close(self):
+        pass
+
+
+def broadcaster_from_config(config):
+    default_backend = ('thread' if os.environ.get('SECUREDROP_ENV') == 'test'
+                       else 'rq')
+    backend = getattr(config, 'WORKER_BACKEND', default_backend)
+    if backend == 'thread':
+        return LocalBroadcaster()
+    elif backend == 'rq':
+        return RedisBroadcaster(
+            host=getattr(config, 'REDIS_HOST', 'localhost'),
+            port=getattr(config, 'REDIS_PORT', 6379))
+    raise ValueError("Unknown WORKER_BACKEND {}".format(backend))
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    """Return the broadcaster, creating it from the configuration the first
+    time it's needed rather than at import time."""
+    global _broadcaster
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            from sdconfig import config
+            _broadcaster = broadcaster_from_config(config)
+        return _broadcaster
+
+
+def set_broadcaster(broadcaster):
+    global _broadcaster
+    with _broadcaster_lock:
+        _broadcaster = broadcaster
+
+
+def publish():
+    """Notify the streams that the change journal has new entries. Call it
+    once they are committed."""
+    try:
+        get_broadcaster().publish()
+    except (ConnectionError, TimeoutError):
+        # The streams will pick the changes up at their next poll anyway
+        log.warning("Couldn't notify of changes, Redis is unreachable")
+
+
+def listen():
+    """Return a listener whose `wait(timeout)` returns once changes are
+    published, or after `timeout` seconds. `close` it when done."""
+    return get_broadcaster().listener()
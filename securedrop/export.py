@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""Bulk exports in volumes of bounded size.
+
+A bulk download (see `store.Storage.get_bulk_archive`) of many submissions
+is often too large for the USB media it's carried to the Secure Viewing
+Station on, and takes long to copy in one go. An export lays the submissions
+out the same way, one folder per source, but splits them into ZIP volumes of
+at most `EXPORT_VOLUME_MAX_BYTES` each. A document too large for a volume of
+its own is split into parts, `<name>.001`, `<name>.002` and so on, to be
+joined with `cat`.
+
+What goes into which volume is planned when the export is created, and
+recorded in its directory in `EXPORT_DIR`. The volumes are then built one
+after the other by the worker (see :func:`build_export`), and can be
+downloaded as soon as each is ready. The SHA-256 of every volume and of every
+file in it is recorded as it's built, for :meth:`Export.manifest` and
+:meth:`Export.checksums`. A volume is only renamed into place once complete,
+so should the build be interrupted, building again picks up with the first
+volume that's missing.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+import zipfile
+
+from datetime import datetime
+from flask import current_app, has_app_context
+
+import store
+import worker
+
+log = logging.getLogger(__name__)
+
+# FAT, which most USB media come formatted with, can't hold larger files
+DEFAULT_VOLUME_MAX_BYTES = 4 * 1024 ** 3 - 1
+
+# Exports are removed this long after they were created
+EXPORT_MAX_AGE = 7 * 24 * 60 * 60
+
+# Expired exports are renamed with this prefix until they're shredded
+EXPIRED_PREFIX = '.expired-'
+# The job shredding each of them, so it's only queued again once lost
+EXPIRED_JOBS_FILENAME = 'expired-jobs.json'
+
+# Room taken in a ZIP file by the headers of an entry, besides its name
+# (twice, in its local header and the central directory), including the
+# ZIP64 extra fields of large entries
+ENTRY_OVERHEAD = 30 + 46 + 2 * 28
+# And by the end of the central directory, with its ZIP64 records
+VOLUME_OVERHEAD = 22 + 56 + 20
+
+# Files aren't split into parts smaller than this, rather they start a new
+# volume
+MIN_PART_SIZE = 64 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+STATE_FILENAME = 'export.json'
+
+
+class Export(object):
+
+    """The export `export_id` in `directory`."""
+
+    def __init__(self, directory, export_id):
+        try:
+            uuid.UUID(hex=export_id)
+        except ValueError:
+            raise LookupError("Invalid export id {}".format(export_id))
+        self.id = export_id
+        self.path = os.path.join(directory, export_id)
+        try:
+            with open(os.path.join(self.path, STATE_FILENAME)) as f:
+                self.state = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise LookupError("No export {}".format(export_id))
+
+    @classmethod
+    def create(cls, directory, zip_basename, submissions, max_volume_bytes,
+               journalist_id):
+        """Plan an export of `submissions` for the journalist
+        `journalist_id`, laid out and named after `zip_basename` like
+        bulk downloads, in volumes of at most `max_volume_bytes`, and return
+        it. Its volumes still have to be built."""
+        export_id = uuid.uuid4().hex
+        name = "{}--{}".format(
+            zip_basename, datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"))
+        path = os.path.join(directory, export_id)
+        os.makedirs(path, 0o700)
+        files = []
+        for submission in submissions:
+            filesystem_id = submission.source.filesystem_id
+            files.append((store.archive_name(submission, zip_basename),
+                          filesystem_id,
+                          submission.filename,
+                          current_app.storage.stat(filesystem_id,
+                                                   submission.filename).size))
+        volumes = plan(files, max_volume_bytes)
+        state = {
+            'name': name,
+            'journalist_id': journalist_id,
+            'created': time.time(),
+            'job_id': None,
+            'volumes': [
+                {'filename': '{}--{:03d}-of-{:03d}.zip'.format(
+                    name, number, len(volumes)),
+                 'size': None,
+                 'sha256': None,
+                 'files': entries}
+                for number, entries in enumerate(volumes, 1)],
+        }
+        _write_json(os.path.join(path, STATE_FILENAME), state)
+        return cls(directory, export_id)
+
+    @property
+    def name(self):
+        return self.state['name']
+
+    @property
+    def journalist_id(self):
+        return self.state['journalist_id']
+
+    @property
+    def volumes(self):
+        return self.state['volumes']
+
+    @property
+    def complete(self):
+        return all(volume['sha256'] for volume in self.volumes)
+
+    def volume_path(self, volume):
+        return os.path.join(self.path, volume['filename'])
+
+    def set_job(self, job):
+        """Record `job` as the one building the volumes."""
+        self.state['job_id'] = job.id
+        self._save()
+
+    def build(self, progress=None):
+        """Build the volumes that haven't been yet, in order. `progress`, if
+        given, is called with the number of volumes built so far."""
+        for number, volume in enumerate(self.volumes):
+            if not (volume['sha256'] and
+                    os.path.exists(self.volume_path(volume))):
+                self.build_volume(volume)
+            if progress is not None:
+                progress(number + 1)
+
+    def build_volume(self, volume):
+        path = self.volume_path(volume)
+        partial = path + '.partial'
+        with zipfile.ZipFile(partial, 'w', allowZip64=True) as zf:
+            for entry in volume['files']:
+                try:
+                    self._add(zf, entry)
+                except (IOError, OSError, store.PathException):
+                    # Deleted since the export was created
+                    log.warning("{} of {} is gone, not exporting it".format(
+                        entry['filename'], entry['filesystem_id']))
+                    entry['missing'] = True
+        volume['size'] = os.path.getsize(partial)
+        volume['sha256'] = _sha256(partial)
+        os.rename(partial, path)
+        self._save()
+
+    def _add(self, zf, entry):
+        storage = current_app.storage
+        with storage.local_copy(entry['filesystem_id'],
+                                entry['filename']) as local:
+            if entry['offset'] == 0 and entry['length'] == entry['size']:
+                entry['sha256'] = _sha256(local)
+                zf.write(local, arcname=entry['path'])
+                return
+            # Only part of the file goes into this volume
+            part = os.path.join(self.path, 'part.partial')
+            digest = hashlib.sha256()
+            with open(local, 'rb') as src, open(part, 'wb') as dst:
+                src.seek(entry['offset'])
+                remaining = entry['length']
+                while remaining:
+                    chunk = src.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError("{} is shorter than planned".format(
+                            entry['filename']))
+                    digest.update(chunk)
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+            try:
+                zf.write(part, arcname=entry['path'])
+            finally:
+                os.remove(part)
+            entry['sha256'] = digest.hexdigest()
+
+    def manifest(self):
+        """Return the manifest of the export: every volume, with the files
+        it contains and their checksums, as far as they are built."""
+        return {
+            'name': self.name,
+            'created': self.state['created'],
+            'volumes': [
+                {'filename': volume['filename'],
+                 'size': volume['size'],
+                 'sha256': volume['sha256'],
+                 'files': [
+                     {'path': entry['path'],
+                      'size': entry['length'],
+                      'sha256': entry['sha256'],
+                      'missing': entry.get('missing', False)}
+                     for entry in volume['files']]}
+                for volume in self.volumes],
+        }
+
+    def checksums(self):
+        """Return the checksums of the volumes built so far, in the format
+        of `sha256sum`, so they can be checked with `sha256sum -c`."""
+        return ''.join('{}  {}\n'.format(volume['sha256'], volume['filename'])
+                       for volume in self.volumes if volume['sha256'])
+
+    def _save(self):
+        _write_json(os.path.join(self.path, STATE_FILENAME), self.state)
+
+
+def plan(files, max_volume_bytes):
+    """Split `files`, which are `(path, filesystem_id, filename, size)`
+    tuples, into volumes of at most `max_volume_bytes`. Returns a list of
+    volumes, each a list of the entries that go into it."""
+    if max_volume_bytes < (VOLUME_OVERHEAD + ENTRY_OVERHEAD +
+                           MIN_PART_SIZE + 1024):
+        raise ValueError("Volumes of {} bytes are too small".format(
+            max_volume_bytes))
+    volumes = [[]]
+    used = [VOLUME_OVERHEAD]
+
+    def room(path):
+        return max_volume_bytes - used[0] - ENTRY_OVERHEAD - len(path)
+
+    def add(path, filesystem_id, filename, size, offset, length):
+        volumes[-1].append({'path': path,
+                            'filesystem_id': filesystem_id,
+                            'filename': filename,
+                            'size': size,
+                            'offset': offset,
+                            'length': length,
+                            'sha256': None})
+        used[0] += ENTRY_OVERHEAD + len(path) + length
+
+    def next_volume():
+        volumes.append([])
+        used[0] = VOLUME_OVERHEAD
+
+    for path, filesystem_id, filename, size in files:
+        if size <= room(path):
+            add(path, filesystem_id, filename, size, 0, size)
+            continue
+        if size <= max_volume_bytes - VOLUME_OVERHEAD - ENTRY_OVERHEAD - \
+                len(path):
+            # Fits in a volume of its own
+            next_volume()
+            add(path, filesystem_id, filename, size, 0, size)
+            continue
+        offset = 0
+        part = 1
+        while offset < size:
+            part_path = '{}.{:03d}'.format(path, part)
+            length = min(room(part_path), size - offset)
+            if length < min(MIN_PART_SIZE, size - offset):
+                if not volumes[-1]:
+                    raise ValueError("{} doesn't fit in volumes of {} "
+                                     "bytes".format(path, max_volume_bytes))
+                next_volume()
+                continue
+            add(part_path, filesystem_id, filename, size, offset, length)
+            offset += length
+            part += 1
+    return [volume for volume in volumes if volume]
+
+
+def build_export(directory, export_id):
+    """Worker job building the volumes of the export `export_id` in
+    `directory`."""
+    if has_app_context():
+        return _build_export(directory, export_id)
+    with worker.job_app().app_context():
+        return _build_export(directory, export_id)
+
+
+def _build_export(directory, export_id):
+    try:
+        export = Export(directory, export_id)
+    except LookupError:
+        # Removed while it was waiting
+        return
+    job = worker.get_current_job()
+    total = len(export.volumes)
+    export.build(lambda done: worker.set_progress(job, done, total))
+
+
+def enqueue_build(export):
+    job = worker.enqueue(build_export, os.path.dirname(export.path),
+                         export.id)
+    export.set_job(job)
+    return job
+
+
+def export_dir(config):
+    return getattr(config, 'EXPORT_DIR',
+                   os.path.join(config.SECUREDROP_DATA_ROOT, 'exports'))
+
+
+def clean_exports(directory, max_age=EXPORT_MAX_AGE):
+    """Securely delete the exports in `directory` created more than `max_age`
+    seconds ago. They are copies of submissions, so like the files of the
+    store they are shredded, by a worker job. Returns how many expired."""
+    removed = 0
+    if not os.path.isdir(directory):
+        return removed
+    now = time.time()
+    jobs_path = os.path.join(directory, EXPIRED_JOBS_FILENAME)
+    try:
+        with open(jobs_path) as f:
+            jobs = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        jobs = {}
+    expired = []
+    for name in os.listdir(directory):
+        if name.startswith(EXPIRED_PREFIX):
+            # Set aside by an earlier run, whose job may still be pending
+            progress = jobs.get(name) and worker.job_progress(jobs[name])
+            if progress is None or progress['status'] in ('finished',
+                                                          'failed'):
+                expired.append(os.path.join(directory, name))
+            continue
+        try:
+            export = Export(directory, name)
+        except LookupError:
+            continue
+        if now - export.state['created'] > max_age:
+            # Set aside right away, so it can't be downloaded anymore while
+            # the job waits
+            path = os.path.join(directory, EXPIRED_PREFIX + name)
+            os.rename(export.path, path)
+            expired.append(path)
+            removed += 1
+    jobs = dict((name, job_id) for name, job_id in jobs.items()
+                if os.path.lexists(os.path.join(directory, name)))
+    if expired:
+        job = worker.enqueue_srm(expired)
+        for path in expired:
+            jobs[os.path.basename(path)] = job.id
+    _write_json(jobs_path, jobs)
+    if removed:
+        log.info('Queued {} expired exports for deletion'.format(removed))
+    return removed
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    # Replaced in one step, so it's never read half written
+    partial = path + '.partial'
+    with open(partial, 'w') as f:
+        json.dump(data, f)
+    os.rename(partial, path)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""Check that the store, the database and the keyring agree with each
+other, see `./manage.py fsck`.
+
+:func:`check` yields an :class:`Issue` for each of these problems:
+
+* ``missing_file``: a submission or reply whose file is gone.
+* ``size_mismatch``: a file whose size isn't the one in the database.
+* ``orphaned_file``: a file no submission or reply refers to.
+* ``orphaned_source_dir``: the directory of a source that isn't in the
+  database.
+* ``missing_source_dir``: a source without a directory.
+* ``unreachable_source_dir``: a directory in the wrong shard, or shadowed by
+  another directory of the same source, e.g. after an interrupted
+  `./manage.py migrate-store`.
+* ``unexpected_file``: a file that isn't named like a submission or reply.
+* ``bad_header``: a file that doesn't start with an OpenPGP encrypted
+  session key packet, if headers are checked.
+* ``missing_reply_key``: a source that was replied to, but has no key to
+  decrypt the replies with.
+* ``orphaned_key``: a source key whose source isn't in the database.
+
+Source directories are scanned by a pool of threads, since the work is
+mostly waiting on the disk, while the database is queried from the calling
+thread, for a batch of sources at a time.
+"""
+import collections
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import store
+import store_pack
+from db import db
+from models import Reply, Source, Submission
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Dict, Iterator, List, Optional, Set, Tuple  # noqa: F401
+
+DEFAULT_JOBS = 4
+# SQLite limits the number of parameters of a query to 999
+DEFAULT_BATCH_SIZE = 500
+
+# Files that belong in a source directory without being in the database
+SPECIAL_FILENAMES = ('_FLAG', store_pack.PACK_FILENAME)
+
+# OpenPGP packet tags of the encrypted session keys messages start with
+# (RFC 4880, section 4.3)
+SESSION_KEY_PACKET_TAGS = (1, 3)
+
+# The issues `repair` fixes
+REPAIRABLE = ('orphaned_file', 'orphaned_source_dir')
+
+# Files are stored before the row of their submission or reply is
+# committed, and uploads can take up to a day (see
+# `maintenance.SPOOL_MAX_AGE`), so `repair` leaves younger orphans alone
+ORPHAN_MIN_AGE = 24 * 60 * 60
+
+
+class Issue(collections.namedtuple('Issue', ['type', 'filesystem_id',
+                                             'filename', 'detail'])):
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+    def __str__(self):
+        return ' '.join(str(field) for field in self
+                        if field is not None)
+
+
+def check(storage, crypto_util=None, journalist_key=None, jobs=DEFAULT_JOBS,
+          batch_size=DEFAULT_BATCH_SIZE, check_headers=False):
+    """Yield the :class:`Issue` found in `storage`, the database and, if
+    `crypto_util` is given, the keyring, whose `journalist_key` is left
+    alone. Needs an application context.
+
+    Only the posix storage backend is supported.
+    """
+    if not storage.backend.is_local:
+        raise ValueError("fsck only supports the posix storage backend")
+    pool = ThreadPool(jobs)
+    try:
+        seen = set()  # type: Set[str]
+        for batch in _batches(storage.source_dirs(), batch_size):
+            reachable = []
+            for filesystem_id, path in batch:
+                if storage.source_dir(filesystem_id) != path:
+                    yield Issue('unreachable_source_dir', filesystem_id,
+                                None, path)
+                else:
+                    reachable.append((filesystem_id, path))
+            scans = pool.map(lambda args: _scan(*args, check_headers=(
+                check_headers)), reachable)
+            sources, rows = _lookup([fid for fid, _ in reachable])
+            for filesystem_id, files, issues in scans:
+                seen.add(filesystem_id)
+                for issue in issues:
+                    yield issue
+                if filesystem_id not in sources:
+                    yield Issue('orphaned_source_dir', filesystem_id, None,
+                                '{} files'.format(len(files)))
+                    continue
+                for issue in _compare(filesystem_id, rows[filesystem_id],
+                                      files):
+                    yield issue
+
+        missing = [filesystem_id for (filesystem_id,) in
+                   db.session.query(Source.filesystem_id)
+                   if filesystem_id not in seen]
+        for batch in _batches(missing, batch_size):
+            _, rows = _lookup(batch)
+            for filesystem_id in batch:
+                yield Issue('missing_source_dir', filesystem_id, None, None)
+                for issue in _compare(filesystem_id, rows[filesystem_id], {}):
+                    yield issue
+    finally:
+        pool.close()
+        pool.join()
+
+    if crypto_util is not None:
+        for issue in _check_keyring(crypto_util, journalist_key):
+            yield issue
+
+
+def repair(storage, issues, min_age=ORPHAN_MIN_AGE):
+    """Enqueue the secure deletion of the orphaned files and source
+    directories among `issues`, unless they were modified in the last
+    `min_age` seconds or are in the database by now. Needs an application
+    context. Returns the job, or `None` if there was nothing to delete."""
+    cutoff = time.time() - min_age
+    items = []  # type: List[Tuple[str, ...]]
+    for issue in issues:
+        if issue.type == 'orphaned_file':
+            item = (issue.filesystem_id, issue.filename)
+        elif issue.type == 'orphaned_source_dir':
+            item = (issue.filesystem_id,)
+        else:
+            continue
+        if _modified_since(storage, item, cutoff) or _in_database(item):
+            continue
+        items.append(item)
+    if not items:
+        return None
+    return storage.secure_delete(items)
+
+
+def _modified_since(storage, item, cutoff):
+    try:
+        if len(item) > 1:
+            return storage.stat(*item).mtime > cutoff
+        mtimes = [os.stat(storage.path(*item)).st_mtime]
+        mtimes.extend(f.mtime for f in storage.list(*item))
+    except OSError:
+        # Gone already
+        return True
+    return max(mtimes) > cutoff
+
+
+def _in_database(item):
+    if len(item) == 1:
+        return db.session.query(Source.id).filter(
+            Source.filesystem_id == item[0]).first() is not None
+    for model in (Submission, Reply):
+        if db.session.query(model.id).join(model.source).filter(
+                Source.filesystem_id == item[0],
+                model.filename == item[1]).first() is not None:
+            return True
+    return False
+
+
+def _scan(filesystem_id, path, check_headers=False):
+    """Return the filesystem id, the `{filename: size}` of the files in the
+    source directory `path`, and the issues found on the way."""
+    files = {}  # type: Dict[str, int]
+    issues = []  # type: List[Issue]
+    packed = False
+    for filename, size, _ in store.list_files(path):
+        if filename == store_pack.PACK_FILENAME:
+            packed = True
+        elif filename in SPECIAL_FILENAMES:
+            continue
+        elif not store.VALIDATE_FILENAME(filename):
+            issues.append(Issue('unexpected_file', filesystem_id, filename,
+                                None))
+        else:
+            files[filename] = size
+            if check_headers:
+                with open(os.path.join(path, filename), 'rb') as f:
+                    if not _is_encrypted(f.read(2)):
+                        issues.append(Issue('bad_header', filesystem_id,
+                                            filename, None))
+
+    if packed:
+        pack = store_pack.Pack(path)
+        for filename, size, _ in pack.list():
+            files[filename] = size
+            if check_headers and not _is_encrypted(pack.read(filename)):
+                issues.append(Issue('bad_header', filesystem_id, filename,
+                                    'packed'))
+    return filesystem_id, files, issues
+
+
+def _lookup(filesystem_ids):
+    """Return the set of `filesystem_ids` that are in the database, and the
+    `{filename: size}` of their submissions and replies, by filesystem
+    id. Submissions that aren't stored yet have a size of `None`."""
+    rows = collections.defaultdict(dict)  # type: Dict[str, Dict[str, Optional[int]]]  # noqa: E501
+    if not filesystem_ids:
+        return set(), rows
+    sources = set(filesystem_id for (filesystem_id,) in
+                  db.session.query(Source.filesystem_id).filter(
+                      Source.filesystem_id.in_(filesystem_ids)))
+    for model in (Submission, Reply):
+        query = db.session.query(
+            Source.filesystem_id, model.filename, model.size).join(
+                model.source).filter(Source.filesystem_id.in_(filesystem_ids))
+        for filesystem_id, filename, size in query:
+            rows[filesystem_id][filename] = size
+    # Submissions the worker hasn't stored yet may or may not have a file by
+    # now, see `spool`
+    query = db.session.query(Source.filesystem_id, Submission.filename).join(
+        Submission.source).filter(Source.filesystem_id.in_(filesystem_ids),
+                                  Submission.state.isnot(None))
+    for filesystem_id, filename in query:
+        rows[filesystem_id][filename] = None
+    return sources, rows
+
+
+def _compare(filesystem_id, rows, files):
+    for filename, size in sorted(rows.items()):
+        if size is None:
+            continue
+        elif filename not in files:
+            yield Issue('missing_file', filesystem_id, filename, None)
+        elif files[filename] != size:
+            yield Issue('size_mismatch', filesystem_id, filename,
+                        'expected {} bytes, found {}'.format(
+                            size, files[filename]))
+    for filename in sorted(set(files) - set(rows)):
+        yield Issue('orphaned_file', filesystem_id, filename, None)
+
+
+def _check_keyring(crypto_util, journalist_key):
+    keys = set(filesystem_id for filesystem_id, fingerprint in
+               crypto_util.source_keys().items()
+               if fingerprint != journalist_key)
+
+    sources = set(filesystem_id for (filesystem_id,) in
+                  db.session.query(Source.filesystem_id))
+    replied = set(filesystem_id for (filesystem_id,) in
+                  db.session.query(Source.filesystem_id).join(
+                      Source.replies).distinct())
+    for filesystem_id in sorted(replied - keys):
+        yield Issue('missing_reply_key', filesystem_id, None, None)
+    for filesystem_id in sorted(keys - sources):
+        yield Issue('orphaned_key', filesystem_id, None, None)
+
+
+def _is_encrypted(head):
+    """Return whether `head` starts with the header of an OpenPGP encrypted
+    session key packet, as every encrypted message does."""
+    if not head:
+        return False
+    tag = ord(head[0])
+    if not tag & 0x80:
+        return False
+    if tag & 0x40:
+        # New format packet header
+        return tag & 0x3f in SESSION_KEY_PACKET_TAGS
+    return (tag >> 2) & 0x0f in SESSION_KEY_PACKET_TAGS
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -15,20 +15,40 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from flask import request, session
+from flask import g, request, session
 from flask_babel import Babel
 from babel import core
 
 import collections
 import os
 import re
+import threading
 
 from os import path
 
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Dict, Optional  # noqa: F401
+
 LOCALE_SPLIT = re.compile('(-|_)')
 LOCALES = ['en_US']
 babel = None
 
+# Computed from LOCALES when first needed, rather than on every request,
+# and reset by `setup_app`. Computing them loads the locale data of every
+# supported locale, so that's left out of starting up.
+LOCALE2NAME = None  # type: Optional[collections.OrderedDict]
+TEXT_DIRECTIONS = {}  # type: Dict[str, str]
+
+# Browsers send one of few distinct Accept-Language headers, so the locale
+# negotiated for the most recent ones is kept
+NEGOTIATED_LOCALES_MAX = 256
+
 
 class LocaleNotFound(Exception):
 
@@ -66,8 +86,19 @@ def setup_app(config, app):
         getattr(config, 'SUPPORTED_LOCALES', None),
         getattr(config, 'DEFAULT_LOCALE', None),
         translation_directories)
+    _reset_locale_caches()
+
+    # `setup_g` has negotiated the locale already
+    babel.localeselector(
+        lambda: getattr(g, 'locale', None) or get_locale(config))
+
 
-    babel.localeselector(lambda: get_locale(config))
+def _reset_locale_caches():
+    global LOCALE2NAME
+    global TEXT_DIRECTIONS
+    LOCALE2NAME = None
+    TEXT_DIRECTIONS = {}
+    _negotiated.clear()
 
 
 def get_locale(config):
@@ -79,21 +110,11 @@ def get_locale(config):
     - 'en_US'
     """
     locale = None
-    accept_languages = []
-    for l in request.accept_languages.values():
-        if '-' in l:
-            sep = '-'
-        else:
-            sep = '_'
-        try:
-            accept_languages.append(str(core.Locale.parse(l, sep)))
-        except Exception:
-            pass
     if 'l' in request.args:
         if len(request.args['l']) == 0:
             if 'locale' in session:
                 del session['locale']
-            locale = core.negotiate_locale(accept_languages, LOCALES)
+            locale = _negotiate_accept_languages()
         else:
             locale = core.negotiate_locale([request.args['l']], LOCALES)
             session['locale'] = locale
@@ -101,7 +122,7 @@ def get_locale(config):
         if 'locale' in session:
             locale = session['locale']
         else:
-            locale = core.negotiate_locale(accept_languages, LOCALES)
+            locale = _negotiate_accept_languages()
 
     if locale:
         return locale
@@ -109,8 +130,72 @@ def get_locale(config):
         return getattr(config, 'DEFAULT_LOCALE', 'en_US')
 
 
+class _LRUCache(object):
+
+    """A mapping that keeps the `size` most recently used items."""
+
+    def __init__(self, size):
+        self.size = size
+        self.__items = collections.OrderedDict()  # type: collections.OrderedDict  # noqa: E501
+        self.__lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the value of `key`, from `compute(key)` if it isn't
+        cached."""
+        with self.__lock:
+            try:
+                value = self.__items.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.__items[key] = value
+                return value
+        value = compute(key)
+        with self.__lock:
+            self.__items[key] = value
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+
+_negotiated = _LRUCache(NEGOTIATED_LOCALES_MAX)
+
+
+def _negotiate_accept_languages():
+    """Return the supported locale the Accept-Language header of the
+    request prefers, `None` if there is none."""
+    header = request.headers.get('Accept-Language', '')
+    return _negotiated.get(header, lambda _: core.negotiate_locale(
+        _parse_accept_languages(request.accept_languages.values()),
+        LOCALES))
+
+
+def _parse_accept_languages(languages):
+    accept_languages = []
+    for l in languages:
+        if '-' in l:
+            sep = '-'
+        else:
+            sep = '_'
+        try:
+            accept_languages.append(str(core.Locale.parse(l, sep)))
+        except Exception:
+            pass
+    return accept_languages
+
+
 def get_text_direction(locale):
-    return core.Locale.parse(locale).text_direction
+    try:
+        return TEXT_DIRECTIONS[locale]
+    except KeyError:
+        direction = core.Locale.parse(locale).text_direction
+        if locale in LOCALES:
+            TEXT_DIRECTIONS[locale] = direction
+        return direction
 
 
 def _get_supported_locales(locales, supported, default_locale,
@@ -144,8 +229,17 @@ NAME_OVERRIDES = {
 
 
 def get_locale2name():
+    """Return the names of the supported locales, by locale. Don't modify
+    it, it's shared between requests."""
+    global LOCALE2NAME
+    if LOCALE2NAME is None:
+        LOCALE2NAME = _get_locale2name(LOCALES)
+    return LOCALE2NAME
+
+
+def _get_locale2name(locales):
     locale2name = collections.OrderedDict()
-    for l in LOCALES:
+    for l in locales:
         if l in NAME_OVERRIDES:
             locale2name[l] = NAME_OVERRIDES[l]
         else:
@@ -13,7 +13,7 @@ import version
 
 from crypto_util import CryptoUtil
 from db import db
-from journalist_app import account, admin, main, col
+from journalist_app import account, admin, api, main, col
 from journalist_app.utils import get_source, logged_in
 from models import Journalist
 from store import Storage
@@ -39,7 +39,7 @@ def create_app(config):
     app.config.from_object(config.JournalistInterfaceFlaskConfig)
     app.sdconfig = config
 
-    CSRFProtect(app)
+    csrf = CSRFProtect(app)
     Environment(app)
 
     if config.DATABASE_ENGINE == "sqlite":
@@ -57,9 +57,7 @@ def create_app(config):
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     db.init_app(app)
 
-    app.storage = Storage(config.STORE_DIR,
-                          config.TEMP_DIR,
-                          config.JOURNALIST_KEY)
+    app.storage = Storage.from_config(config)
 
     app.crypto_util = CryptoUtil(
         scrypt_params=config.SCRYPT_PARAMS,
@@ -84,6 +82,7 @@ def create_app(config):
 
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
+    app.jinja_env.bytecode_cache = template_filters.bytecode_cache(config)
     app.jinja_env.globals['version'] = version.__version__
     if hasattr(config, 'CUSTOM_HEADER_IMAGE'):
         app.jinja_env.globals['header_image'] = \
@@ -111,15 +110,22 @@ def create_app(config):
     @app.before_request
     def setup_g():
         """Store commonly used values in Flask's special g object"""
+        if request.blueprint == 'api':
+            # Authenticated by token rather than the session
+            return
+
         if 'expires' in session and datetime.utcnow() >= session['expires']:
             session.clear()
             flash(gettext('You have been logged out due to inactivity'),
                   'error')
 
-        session['expires'] = datetime.utcnow() + \
-            timedelta(minutes=getattr(config,
-                                      'SESSION_EXPIRATION_MINUTES',
-                                      120))
+        # The browser reconnects to the sources list's event stream on its
+        # own, which doesn't make the journalist any less inactive
+        if request.endpoint != 'main.events':
+            session['expires'] = datetime.utcnow() + \
+                timedelta(minutes=getattr(config,
+                                          'SESSION_EXPIRATION_MINUTES',
+                                          120))
 
         uid = session.get('uid', None)
         if uid:
@@ -145,4 +151,9 @@ def create_app(config):
     app.register_blueprint(admin.make_blueprint(config), url_prefix='/admin')
     app.register_blueprint(col.make_blueprint(config), url_prefix='/col')
 
+    api_blueprint = api.make_blueprint(config)
+    csrf.exempt(api_blueprint)
+    app.register_blueprint(api_blueprint,
+                           url_prefix='/api/v{}'.format(api.VERSION))
+
     return app
@@ -3,11 +3,13 @@
 import os
 
 from flask import (Blueprint, render_template, request, url_for, redirect, g,
-                   current_app, flash, abort)
+                   current_app, flash, abort, jsonify)
 from flask_babel import gettext
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
+import worker
+
 from db import db
 from models import Journalist, InvalidUsernameException, PasswordError
 from journalist_app.decorators import admin_required
@@ -42,6 +44,13 @@ def make_blueprint(config):
                     flash(error, "logo-error")
             return render_template("config.html", form=form)
 
+    @view.route('/worker-stats')
+    @admin_required
+    def worker_stats():
+        """Queue depth per priority and, for the thread pool backend, job
+        latency per job type."""
+        return jsonify(worker.stats())
+
     @view.route('/add', methods=('GET', 'POST'))
     @admin_required
     def add_user():
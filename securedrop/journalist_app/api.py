@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Versioned JSON API of the journalist interface, for workstation clients
+that mirror sources, submissions and replies rather than scrape the pages.
+
+Clients get a token from `/token` with the same credentials as the login
+form, and send it as `Authorization: Token <token>`. To stay in sync, they
+fetch `/changes?since=<cursor>` with the `cursor` of the previous response,
+which returns the objects changed (or deleted) since, from the journal kept
+by :class:`models.Change`.
+"""
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, g, jsonify, request, url_for
+from sqlalchemy.sql.expression import false
+from werkzeug.exceptions import HTTPException
+
+from db import db
+from journalist_app.utils import (delete_collection, delete_items,
+                                  make_star_false, make_star_true,
+                                  send_stored_file)
+from models import (BadTokenException, Change, InvalidUsernameException,
+                    Journalist, LoginThrottledException, Reply, Source,
+                    Submission, WrongPasswordException)
+
+# The version of the API, part of its URLs
+VERSION = 1
+
+# Changes returned at most by one request to `/changes`
+MAX_CHANGES = 1000
+
+
+def token_required(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Token '):
+            g.user = Journalist.validate_api_token_and_get_user(
+                header[len('Token '):])
+            if g.user is not None:
+                return func(*args, **kwargs)
+        return _error(403, 'API token not found in Authorization header '
+                           'or invalid.')
+    return wrapper
+
+
+def make_blueprint(config):
+    api = Blueprint('api', __name__)
+    token_expiration = getattr(config, 'API_TOKEN_EXPIRATION', 8 * 60 * 60)
+
+    @api.errorhandler(HTTPException)
+    def handle_error(e):
+        return _error(e.code, e.description)
+
+    @api.route('/')
+    def get_endpoints():
+        return jsonify({'version': VERSION,
+                        'token_url': url_for('.get_token'),
+                        'sources_url': url_for('.get_all_sources'),
+                        'submissions_url': url_for('.get_all_submissions'),
+                        'replies_url': url_for('.get_all_replies'),
+                        'changes_url': url_for('.get_changes')})
+
+    @api.route('/token', methods=['POST'])
+    def get_token():
+        creds = request.get_json(force=True, silent=True) or {}
+        try:
+            username = creds['username']
+            passphrase = creds['passphrase']
+            one_time_code = creds['one_time_code']
+        except KeyError as e:
+            return _error(400, '{} field is missing'.format(e.args[0]))
+
+        try:
+            journalist = Journalist.login(username, passphrase,
+                                          one_time_code)
+        except (InvalidUsernameException, BadTokenException,
+                WrongPasswordException, LoginThrottledException) as e:
+            current_app.logger.error(
+                "API login for '{}' failed: {}".format(username, e))
+            return _error(403, 'Token authentication failed.')
+
+        journalist.last_access = datetime.utcnow()
+        db.session.commit()
+        return jsonify({
+            'token': journalist.generate_api_token(token_expiration),
+            'expiration': _iso(datetime.utcnow() +
+                               timedelta(seconds=token_expiration)),
+            'journalist_id': journalist.id}), 200
+
+    @api.route('/sources')
+    @token_required
+    def get_all_sources():
+        sources = Source.query.filter(Source.pending == false()).order_by(
+            Source.id).all()
+        return jsonify({'sources': [_source(source) for source in sources]})
+
+    @api.route('/sources/<int:source_id>', methods=['GET', 'DELETE'])
+    @token_required
+    def single_source(source_id):
+        source = _get_source(source_id)
+        if request.method == 'DELETE':
+            job = delete_collection(source.filesystem_id)
+            return jsonify({'message': 'Source and submissions deleted',
+                            'job_id': job.id})
+        return jsonify(_source(source))
+
+    @api.route('/sources/<int:source_id>/star', methods=['POST', 'DELETE'])
+    @token_required
+    def star(source_id):
+        source = _get_source(source_id)
+        if request.method == 'POST':
+            make_star_true(source.filesystem_id)
+        else:
+            make_star_false(source.filesystem_id)
+        db.session.commit()
+        return jsonify(_source(source))
+
+    @api.route('/sources/<int:source_id>/submissions')
+    @token_required
+    def get_source_submissions(source_id):
+        source = _get_source(source_id)
+        return jsonify({'submissions': [_submission(submission)
+                                        for submission in source.submissions]})
+
+    @api.route('/sources/<int:source_id>/submissions/<int:submission_id>',
+               methods=['GET', 'DELETE'])
+    @token_required
+    def single_submission(source_id, submission_id):
+        submission = _get_item(Submission, source_id, submission_id)
+        if request.method == 'DELETE':
+            job = delete_items([submission])
+            return jsonify({'message': 'Submission deleted',
+                            'job_id': job.id})
+        return jsonify(_submission(submission))
+
+    @api.route('/sources/<int:source_id>/submissions/<int:submission_id>/'
+               'download')
+    @token_required
+    def download_submission(source_id, submission_id):
+        submission = _get_item(Submission, source_id, submission_id)
+        if submission.state is not None:
+            return _error(409, "The submission hasn't been stored yet.")
+
+        def mark_downloaded():
+            Submission.query.get(submission_id).mark_downloaded()
+            db.session.commit()
+
+        return send_stored_file(submission.source.filesystem_id,
+                                submission.filename,
+                                submission.display_filename,
+                                mark_downloaded)
+
+    @api.route('/sources/<int:source_id>/replies')
+    @token_required
+    def get_source_replies(source_id):
+        source = _get_source(source_id)
+        return jsonify({'replies': [_reply(reply)
+                                    for reply in source.replies]})
+
+    @api.route('/sources/<int:source_id>/replies/<int:reply_id>',
+               methods=['GET', 'DELETE'])
+    @token_required
+    def single_reply(source_id, reply_id):
+        reply = _get_item(Reply, source_id, reply_id)
+        if request.method == 'DELETE':
+            job = delete_items([reply])
+            return jsonify({'message': 'Reply deleted', 'job_id': job.id})
+        return jsonify(_reply(reply))
+
+    @api.route('/sources/<int:source_id>/replies/<int:reply_id>/download')
+    @token_required
+    def download_reply(source_id, reply_id):
+        reply = _get_item(Reply, source_id, reply_id)
+        return send_stored_file(reply.source.filesystem_id, reply.filename,
+                                reply.display_filename, lambda: None)
+
+    @api.route('/submissions')
+    @token_required
+    def get_all_submissions():
+        submissions = Submission.query.join(Source).filter(
+            Source.pending == false()).order_by(Submission.id).all()
+        return jsonify({'submissions': [_submission(submission)
+                                        for submission in submissions]})
+
+    @api.route('/replies')
+    @token_required
+    def get_all_replies():
+        replies = Reply.query.order_by(Reply.id).all()
+        return jsonify({'replies': [_reply(reply) for reply in replies]})
+
+    @api.route('/submissions/downloaded', methods=['POST'])
+    @token_required
+    def mark_submissions_downloaded():
+        """Mark the submissions `ids` as downloaded, e.g. once the client
+        has them from an export."""
+        submissions = _get_items(Submission)
+        for submission in submissions:
+            submission.mark_downloaded()
+        db.session.commit()
+        return jsonify({'submissions': [_submission(submission)
+                                        for submission in submissions]})
+
+    @api.route('/submissions/delete', methods=['POST'])
+    @token_required
+    def delete_submissions():
+        job = delete_items(_get_items(Submission))
+        return jsonify({'message': 'Submissions deleted', 'job_id': job.id})
+
+    @api.route('/replies/delete', methods=['POST'])
+    @token_required
+    def delete_replies():
+        job = delete_items(_get_items(Reply))
+        return jsonify({'message': 'Replies deleted', 'job_id': job.id})
+
+    @api.route('/changes')
+    @token_required
+    def get_changes():
+        """Return the objects changed since the cursor `since`, oldest
+        change first, and the cursor to pass next time. Objects changed
+        several times are only returned once. `more` tells whether there
+        are changes left after these."""
+        since = request.args.get('since', 0, type=int)
+        limit = min(request.args.get('limit', MAX_CHANGES, type=int),
+                    MAX_CHANGES)
+        changes = Change.query.filter(Change.id > since).order_by(
+            Change.id).limit(limit + 1).all()
+        more = len(changes) > limit
+        changes = changes[:limit]
+
+        latest = {}
+        for change in changes:
+            latest[(change.kind, change.object_id)] = change
+        results = []
+        for change in sorted(latest.values(), key=lambda c: c.id):
+            result = _change(change)
+            if result is not None:
+                results.append(result)
+        return jsonify({'changes': results,
+                        'cursor': changes[-1].id if changes else since,
+                        'more': more})
+
+    return api
+
+
+def _error(status, message):
+    response = jsonify({'error': _STATUS_NAMES.get(status, 'Error'),
+                        'message': message})
+    response.status_code = status
+    return response
+
+
+_STATUS_NAMES = {400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                 405: 'Method Not Allowed', 409: 'Conflict'}
+
+
+def _get_source(source_id):
+    source = Source.query.get(source_id)
+    if source is None or source.pending:
+        abort(404, 'No source {}'.format(source_id))
+    return source
+
+
+def _get_item(model, source_id, item_id):
+    item = model.query.get(item_id)
+    if item is None or item.source_id != source_id:
+        abort(404, 'No such {}'.format(model.__tablename__[:-1]))
+    return item
+
+
+def _get_items(model):
+    """Return the `model` objects whose ids the request body lists as
+    `ids`."""
+    body = request.get_json(force=True, silent=True) or {}
+    ids = body.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        abort(400, 'ids has to be a list of integers')
+    items = model.query.filter(model.id.in_(ids)).all() if ids else []
+    if len(items) != len(set(ids)):
+        abort(404, 'No such {}'.format(model.__tablename__[:-1]))
+    return items
+
+
+def _change(change):
+    """Return the result for `change`, or `None` if it's to an object API
+    clients don't see."""
+    model = {Change.SOURCE: Source,
+             Change.SUBMISSION: Submission,
+             Change.REPLY: Reply}[change.kind]
+    obj = None if change.deleted else model.query.get(change.object_id)
+    result = {'cursor': change.id,
+              'type': change.kind,
+              'id': change.object_id,
+              'deleted': obj is None}
+    if obj is None:
+        return result
+    if change.kind == Change.SOURCE:
+        if obj.pending:
+            return None
+        result['source'] = _source(obj)
+    elif change.kind == Change.SUBMISSION:
+        result['submission'] = _submission(obj)
+    else:
+        result['reply'] = _reply(obj)
+    return result
+
+
+def _source(source):
+    counts = source.documents_messages_count()
+    return {
+        'id': source.id,
+        'journalist_designation': source.journalist_designation,
+        'is_flagged': bool(source.flagged),
+        'is_starred': bool(source.star and source.star.starred),
+        'last_updated': _iso(source.last_updated),
+        'number_of_documents': counts['documents'],
+        'number_of_messages': counts['messages'],
+        'url': url_for('api.single_source', source_id=source.id),
+        'submissions_url': url_for('api.get_source_submissions',
+                                   source_id=source.id),
+        'replies_url': url_for('api.get_source_replies',
+                               source_id=source.id),
+        'star_url': url_for('api.star', source_id=source.id),
+    }
+
+
+def _submission(submission):
+    return {
+        'id': submission.id,
+        'source_id': submission.source_id,
+        'filename': submission.display_filename,
+        'size': submission.size,
+        'is_read': bool(submission.downloaded),
+        'state': submission.state,
+        'url': url_for('api.single_submission',
+                       source_id=submission.source_id,
+                       submission_id=submission.id),
+        'download_url': url_for('api.download_submission',
+                                source_id=submission.source_id,
+                                submission_id=submission.id),
+    }
+
+
+def _reply(reply):
+    return {
+        'id': reply.id,
+        'source_id': reply.source_id,
+        'journalist_id': reply.journalist_id,
+        'filename': reply.display_filename,
+        'size': reply.size,
+        'created_on': _iso(reply.created_on),
+        'url': url_for('api.single_reply', source_id=reply.source_id,
+                       reply_id=reply.id),
+        'download_url': url_for('api.download_reply',
+                                source_id=reply.source_id,
+                                reply_id=reply.id),
+    }
+
+
+def _iso(timestamp):
+    return timestamp.isoformat() + 'Z' if timestamp is not None else None
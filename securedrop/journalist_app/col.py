@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 
 from flask import (Blueprint, redirect, url_for, render_template, flash,
-                   request, abort, send_file, current_app)
+                   request, abort, current_app)
 from flask_babel import gettext
+from functools import partial
 from sqlalchemy.orm.exc import NoResultFound
 
+import store
+
 from db import db
-from models import Submission
+from models import Change, Submission
 from journalist_app.forms import ReplyForm
 from journalist_app.utils import (make_star_true, make_star_false, get_source,
                                   delete_collection, col_download_unread,
                                   col_download_all, col_star, col_un_star,
-                                  col_delete)
+                                  col_delete, track_deletion,
+                                  send_stored_file, start_export, page_etag,
+                                  not_modified, with_etag)
 
 
 def make_blueprint(config):
@@ -31,17 +36,27 @@ def make_blueprint(config):
 
     @view.route('/<filesystem_id>')
     def col(filesystem_id):
-        form = ReplyForm()
+        # Every change to the collection is journaled, but not the reply
+        # keypair generated after the first submission
+        latest_change = Change.latest_id()
         source = get_source(filesystem_id)
         source.has_key = current_app.crypto_util.getkey(filesystem_id)
-        return render_template("col.html", filesystem_id=filesystem_id,
-                               source=source, form=form)
+        etag = page_etag(latest_change, source.has_key)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        form = ReplyForm()
+        return with_etag(render_template("col.html",
+                                         filesystem_id=filesystem_id,
+                                         source=source, form=form),
+                         etag)
 
     @view.route('/delete/<filesystem_id>', methods=('POST',))
     def delete_single(filesystem_id):
         """deleting a single collection from its /col page"""
         source = get_source(filesystem_id)
-        delete_collection(filesystem_id)
+        track_deletion(delete_collection(filesystem_id))
         flash(gettext("{source_name}'s collection deleted")
               .format(source_name=source.journalist_designation),
               "notification")
@@ -50,8 +65,12 @@ def make_blueprint(config):
     @view.route('/process', methods=('POST',))
     def process():
         actions = {'download-unread': col_download_unread,
-                   'download-all': col_download_all, 'star': col_star,
-                   'un-star': col_un_star, 'delete': col_delete}
+                   'download-all': col_download_all,
+                   'export-unread': partial(col_download_unread,
+                                            send=start_export),
+                   'export-all': partial(col_download_all, send=start_export),
+                   'star': col_star, 'un-star': col_un_star,
+                   'delete': col_delete}
         if 'cols_selected' not in request.form:
             flash(gettext('No collections selected.'), 'error')
             return redirect(url_for('main.index'))
@@ -68,19 +87,38 @@ def make_blueprint(config):
 
     @view.route('/<filesystem_id>/<fn>')
     def download_single_submission(filesystem_id, fn):
-        """Sends a client the contents of a single submission."""
+        """Sends a client the contents of a single submission, or the range
+        of it they asked for. It's marked as downloaded once its last byte
+        is sent."""
         if '..' in fn or fn.startswith('/'):
             abort(404)
 
+        source = get_source(filesystem_id)
         try:
-            Submission.query.filter(
-                Submission.filename == fn).one().downloaded = True
-            db.session.commit()
+            submission = Submission.query.filter(
+                Submission.source_id == source.id,
+                Submission.filename == fn).one()
         except NoResultFound as e:
             current_app.logger.error(
                 "Could not mark " + fn + " as downloaded: %s" % (e,))
+            submission_id = None
+        else:
+            if submission.state is not None:
+                flash(gettext("This submission hasn't been stored yet."),
+                      "error")
+                return redirect(url_for('col.col',
+                                        filesystem_id=filesystem_id))
+            submission_id = submission.id
+
+        def mark_downloaded():
+            if submission_id is None:
+                return
+            Submission.query.get(submission_id).mark_downloaded()
+            db.session.commit()
 
-        return send_file(current_app.storage.path(filesystem_id, fn),
-                         mimetype="application/pgp-encrypted")
+        return send_stored_file(
+            filesystem_id, fn,
+            store.display_filename(fn, source.journalist_filename),
+            mark_downloaded)
 
     return view
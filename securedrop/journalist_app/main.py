@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 from datetime import datetime
 from flask import (Blueprint, request, current_app, session, url_for, redirect,
-                   render_template, g, flash, abort)
+                   render_template, g, flash, abort, jsonify, send_file,
+                   Response, stream_with_context)
 from flask_babel import gettext
 from sqlalchemy.sql.expression import false
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+import export
+import store
+import worker
 
 from db import db
-from models import Source, SourceStar, Submission, Reply
+from models import Change, Source, SourceStar, Submission, Reply
 from journalist_app.forms import ReplyForm
 from journalist_app.utils import (validate_user, bulk_delete, download,
-                                  confirm_bulk_delete, get_source)
+                                  confirm_bulk_delete, get_source,
+                                  untrack_deletion, start_export, get_export,
+                                  source_events, page_etag, not_modified,
+                                  with_etag)
 
 
 def make_blueprint(config):
@@ -45,6 +56,16 @@ def make_blueprint(config):
 
     @view.route('/')
     def index():
+        # Where the page's event stream picks up from, read before the
+        # sources so that no change in between is missed. Since every change
+        # to the sources is journaled, it also tells whether the page
+        # changed.
+        events_cursor = Change.latest_id()
+        etag = page_etag(events_cursor)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         unstarred = []
         starred = []
 
@@ -64,9 +85,37 @@ def make_blueprint(config):
                 Submission.query.filter_by(source_id=source.id,
                                            downloaded=False).all())
 
-        return render_template('index.html',
-                               unstarred=unstarred,
-                               starred=starred)
+        return with_etag(render_template('index.html',
+                                         unstarred=unstarred,
+                                         starred=starred,
+                                         events_cursor=events_cursor),
+                         etag)
+
+    @view.route('/events')
+    def events():
+        """Stream the changes to the sources list as server-sent events,
+        from the `Last-Event-ID` the browser reconnects with, or the cursor
+        `since` the index page was rendered at."""
+        cursor = request.headers.get('Last-Event-ID', type=int)
+        if cursor is None:
+            cursor = request.args.get('since', type=int)
+        if cursor is None:
+            cursor = Change.latest_id()
+        max_seconds = getattr(config, 'EVENT_STREAM_MAX_SECONDS', 10 * 60)
+        if 'expires' in session:
+            # End with the session, for the browser to reconnect to the
+            # login page rather than keep streaming
+            max_seconds = min(max_seconds, (session['expires'] -
+                                            datetime.utcnow()).total_seconds())
+        stream = source_events(
+            cursor,
+            getattr(config, 'EVENT_STREAM_POLL_SECONDS', 30),
+            max_seconds)
+        return Response(stream_with_context(stream),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 # Don't let a proxy hold the events back
+                                 'X-Accel-Buffering': 'no'})
 
     @view.route('/reply', methods=('POST',))
     def reply():
@@ -89,15 +138,12 @@ def make_blueprint(config):
                 flash(error, "error")
             return redirect(url_for('col.col', filesystem_id=g.filesystem_id))
 
-        g.source.interaction_count += 1
-        filename = "{0}-{1}-reply.gpg".format(g.source.interaction_count,
-                                              g.source.journalist_filename)
-        current_app.crypto_util.encrypt(
-            form.message.data,
+        [count] = g.source.allocate_interactions()
+        filename = store.stored_filename(count, 'reply')
+        current_app.storage.save_encrypted(
+            g.filesystem_id, filename, form.message.data,
             [current_app.crypto_util.getkey(g.filesystem_id),
-             config.JOURNALIST_KEY],
-            output=current_app.storage.path(g.filesystem_id, filename),
-        )
+             config.JOURNALIST_KEY])
         reply = Reply(g.user, g.source, filename)
 
         try:
@@ -135,7 +181,7 @@ def make_blueprint(config):
         selected_docs = [doc for doc in g.source.collection
                          if doc.filename in doc_names_selected]
         if selected_docs == []:
-            if action == 'download':
+            if action in ('download', 'export'):
                 flash(gettext("No collections selected for download."),
                       "error")
             elif action in ('delete', 'confirm_delete'):
@@ -146,6 +192,9 @@ def make_blueprint(config):
         if action == 'download':
             source = get_source(g.filesystem_id)
             return download(source.journalist_filename, selected_docs)
+        elif action == 'export':
+            source = get_source(g.filesystem_id)
+            return start_export(source.journalist_filename, selected_docs)
         elif action == 'delete':
             return bulk_delete(g.filesystem_id, selected_docs)
         elif action == 'confirm_delete':
@@ -157,12 +206,6 @@ def make_blueprint(config):
     def regenerate_code():
         original_journalist_designation = g.source.journalist_designation
         g.source.journalist_designation = current_app.crypto_util.display_id()
-
-        for item in g.source.collection:
-            item.filename = current_app.storage.rename_submission(
-                g.filesystem_id,
-                item.filename,
-                g.source.journalist_filename)
         db.session.commit()
 
         flash(gettext(
@@ -172,6 +215,66 @@ def make_blueprint(config):
               "notification")
         return redirect(url_for('col.col', filesystem_id=g.filesystem_id))
 
+    @view.route('/deletion-progress/<job_id>')
+    def deletion_progress(job_id):
+        """Report the progress of one of the journalist's deletion jobs as
+        JSON. Finished jobs are forgotten once they have been reported."""
+        if job_id not in session.get('deletion_jobs', []):
+            abort(404)
+
+        progress = worker.job_progress(job_id)
+        if progress is None:
+            untrack_deletion(job_id)
+            abort(404)
+        if progress['status'] in ('finished', 'failed'):
+            untrack_deletion(job_id)
+        return jsonify(progress)
+
+    @view.route('/export/<export_id>')
+    def export_volumes(export_id):
+        exported = get_export(export_id)
+        return render_template('export.html', export=exported,
+                               building=_building(exported))
+
+    @view.route('/export/<export_id>/resume', methods=('POST',))
+    def resume_export(export_id):
+        """Build the volumes of an export that are missing, e.g. because
+        the worker was restarted while building them."""
+        exported = get_export(export_id)
+        if not (exported.complete or _building(exported)):
+            export.enqueue_build(exported)
+        return redirect(url_for('.export_volumes', export_id=export_id))
+
+    @view.route('/export/<export_id>/<filename>')
+    def download_export_file(export_id, filename):
+        exported = get_export(export_id)
+        if filename == 'MANIFEST.json':
+            return Response(json.dumps(exported.manifest(), indent=2,
+                                       sort_keys=True),
+                            mimetype='application/json')
+        elif filename == 'SHA256SUMS':
+            return Response(exported.checksums(), mimetype='text/plain')
+
+        volumes = [volume for volume in exported.volumes
+                   if volume['filename'] == filename and volume['sha256']]
+        if not volumes:
+            abort(404)
+        # Volumes are large, so the copy can be resumed with a range request
+        response = send_file(exported.volume_path(volumes[0]),
+                             mimetype='application/zip', as_attachment=True,
+                             attachment_filename=filename, conditional=False)
+        response.set_etag(volumes[0]['sha256'])
+        if current_app.use_x_sendfile:
+            # The web server serves the range from the file itself
+            return response.make_conditional(request, accept_ranges=True)
+        try:
+            return response.make_conditional(
+                request, accept_ranges=True,
+                complete_length=volumes[0]['size'])
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            raise
+
     @view.route('/download_unread/<filesystem_id>')
     def download_unread_filesystem_id(filesystem_id):
         id = Source.query.filter(Source.filesystem_id == filesystem_id) \
@@ -186,3 +289,12 @@ def make_blueprint(config):
         return download(source.journalist_filename, submissions)
 
     return view
+
+
+def _building(exported):
+    """Return whether a job is building the volumes of `exported`."""
+    if not exported.state['job_id']:
+        return False
+    progress = worker.job_progress(exported.state['job_id'])
+    return (progress is not None and
+            progress['status'] not in ('finished', 'failed'))
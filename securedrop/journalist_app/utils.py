@@ -1,20 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import os
+import time
+
 from datetime import datetime
 from flask import (g, flash, current_app, abort, send_file, redirect, url_for,
-                   render_template, Markup)
+                   render_template, Markup, session, request, Response,
+                   stream_with_context, make_response)
 from flask_babel import gettext, ngettext
 from sqlalchemy.sql.expression import false
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
 
+import events
+import export
 import i18n
-import worker
+import version
 
 from db import db
 from models import (get_one_or_else, Source, Journalist,
                     InvalidUsernameException, WrongPasswordException,
                     LoginThrottledException, BadTokenException, SourceStar,
-                    PasswordError, Submission)
-from rm import srm
+                    PasswordError, Submission, Change)
 
 import typing
 # https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
@@ -155,14 +164,19 @@ def download(zip_basename, submissions):
     :param list submissions: A list of :class:`models.Submission`s to
                              include in the ZIP-file.
     """
+    # Submissions the worker hasn't stored yet have nothing to download
+    submissions = [submission for submission in submissions
+                   if getattr(submission, 'state', None) is None]
     zf = current_app.storage.get_bulk_archive(submissions,
                                               zip_directory=zip_basename)
     attachment_filename = "{}--{}.zip".format(
         zip_basename, datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"))
 
-    # Mark the submissions that have been downloaded as such
+    # Mark the submissions that have been downloaded as such, leaving the
+    # replies selected with them alone
     for submission in submissions:
-        submission.downloaded = True
+        if isinstance(submission, Submission):
+            submission.mark_downloaded()
     db.session.commit()
 
     return send_file(zf.name, mimetype="application/zip",
@@ -170,12 +184,141 @@ def download(zip_basename, submissions):
                      as_attachment=True)
 
 
-def bulk_delete(filesystem_id, items_selected):
-    for item in items_selected:
-        item_path = current_app.storage.path(filesystem_id, item.filename)
-        worker.enqueue(srm, item_path)
+def start_export(zip_basename, submissions):
+    """Start exporting *submissions* in volumes of bounded size (see
+    :mod:`export`), and send the client to the page the volumes can be
+    downloaded from as they are built. Like :func:`download`, the
+    submissions are marked as downloaded.
+
+    :param str zip_basename: The basename of the volumes.
+
+    :param list submissions: A list of :class:`models.Submission`s to
+                             export.
+    """
+    submissions = [submission for submission in submissions
+                   if getattr(submission, 'state', None) is None]
+    for submission in submissions:
+        if isinstance(submission, Submission):
+            submission.mark_downloaded()
+
+    config = current_app.sdconfig
+    exported = export.Export.create(
+        export.export_dir(config),
+        zip_basename,
+        submissions,
+        getattr(config, 'EXPORT_VOLUME_MAX_BYTES',
+                export.DEFAULT_VOLUME_MAX_BYTES),
+        g.user.id)
+    export.enqueue_build(exported)
+    db.session.commit()
+
+    return redirect(url_for('main.export_volumes', export_id=exported.id))
+
+
+def get_export(export_id):
+    """Return the export `export_id` of the logged in journalist, or abort
+    with 404."""
+    try:
+        exported = export.Export(
+            export.export_dir(current_app.sdconfig), export_id)
+    except LookupError:
+        abort(404)
+    if exported.journalist_id != g.user.id:
+        abort(404)
+    return exported
+
+
+def send_stored_file(filesystem_id, filename, attachment_filename,
+                     on_complete):
+    """Send `filename` of the source `filesystem_id` as an attachment, or
+    the byte range of it the client asked for (see `make_conditional`), so
+    that an interrupted download can be resumed. `on_complete` is called
+    once the file's last byte is sent, or with X-Sendfile once the response
+    to a GET that includes it is handed to the web server.
+    """
+    storage = current_app.storage
+    stored = storage.stat(filesystem_id, filename)
+    etag = hashlib.sha1('{}/{}/{}/{}'.format(
+        filesystem_id, filename, stored.size, int(stored.mtime))).hexdigest()
+    last_modified = datetime.utcfromtimestamp(int(stored.mtime))
+
+    path = storage.path(filesystem_id, filename)
+    if current_app.use_x_sendfile and os.path.isfile(path):
+        # The web server serves the range from the file itself
+        response = send_file(path, mimetype="application/pgp-encrypted",
+                             as_attachment=True,
+                             attachment_filename=attachment_filename,
+                             add_etags=False, conditional=False)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.make_conditional(request, accept_ranges=True)
+        # Flask answers HEAD requests with this view too, which send nothing
+        if (request.method == 'GET' and response.status_code == 200 and
+                _range_includes_end(stored.size, etag, last_modified)):
+            on_complete()
+        return response
+
+    f = storage.get(filesystem_id, filename)
+    response = Response(wrap_file(request.environ, f),
+                        mimetype="application/pgp-encrypted",
+                        direct_passthrough=True)
+    response.content_length = stored.size
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=attachment_filename)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    try:
+        response.make_conditional(request, accept_ranges=True,
+                                  complete_length=stored.size)
+    except RequestedRangeNotSatisfiable:
+        f.close()
+        raise
+    if (response.status_code == 200 or
+            (response.status_code == 206 and
+             response.content_range.stop == stored.size)):
+        response.response = stream_with_context(
+            _then(response.response, on_complete))
+    return response
+
+
+def _then(iterable, callback):
+    """Yield from `iterable`, then call `callback` if it was exhausted."""
+    try:
+        for data in iterable:
+            yield data
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    callback()
+
+
+def _range_includes_end(length, etag, last_modified):
+    """Return whether the response to the request, for a file of `length`
+    bytes, includes its last byte. A range that is conditional on an
+    `If-Range` that doesn't match is ignored, so the whole file is sent."""
+    if request.range is None or (
+            request.if_range.etag not in (None, etag) or
+            (request.if_range.date is not None and
+             last_modified > request.if_range.date)):
+        return True
+    byte_range = request.range.range_for_length(length)
+    return byte_range is not None and byte_range[1] == length
+
+
+def delete_items(items):
+    """Delete the submissions and replies *items* from the database right
+    away, and enqueue a single worker job that securely deletes their files.
+    Returns the job."""
+    files = []
+    for item in items:
+        files.append((item.source.filesystem_id, item.filename))
         db.session.delete(item)
     db.session.commit()
+    return current_app.storage.secure_delete(files)
+
+
+def bulk_delete(filesystem_id, items_selected):
+    track_deletion(delete_items(items_selected))
 
     flash(ngettext("Submission deleted.",
                    "{num} submissions deleted.".format(
@@ -230,8 +373,7 @@ def col_delete(cols_selected):
     if len(cols_selected) < 1:
         flash(gettext("No collections selected for deletion."), "error")
     else:
-        for filesystem_id in cols_selected:
-            delete_collection(filesystem_id)
+        track_deletion(delete_collections(cols_selected))
         num = len(cols_selected)
         flash(ngettext('{num} collection deleted', '{num} collections deleted',
                        num).format(num=num),
@@ -254,17 +396,45 @@ def make_password(config):
 
 
 def delete_collection(filesystem_id):
-    # Delete the source's collection of submissions
-    job = worker.enqueue(srm, current_app.storage.path(filesystem_id))
+    return delete_collections([filesystem_id])
 
-    # Delete the source's reply keypair
-    current_app.crypto_util.delete_reply_keypair(filesystem_id)
 
-    # Delete their entry in the db
-    source = get_source(filesystem_id)
-    db.session.delete(source)
+def delete_collections(filesystem_ids):
+    """Delete the sources with the given *filesystem_ids* from the database
+    right away, and enqueue a single worker job that securely deletes all of
+    their collections. Returns the job."""
+    for filesystem_id in filesystem_ids:
+
+        # Delete the source's reply keypair
+        current_app.crypto_util.delete_reply_keypair(filesystem_id)
+
+        # Delete their entry in the db
+        source = get_source(filesystem_id)
+        db.session.delete(source)
     db.session.commit()
-    return job
+
+    # Delete the sources' collections of submissions
+    return current_app.storage.secure_delete(
+        [(filesystem_id,) for filesystem_id in filesystem_ids])
+
+
+# Only remember the most recent deletions so the session cookie stays small
+MAX_TRACKED_DELETIONS = 10
+
+
+def track_deletion(job):
+    """Remember the deletion *job* in the session, so its progress is shown
+    to the journalist until it finishes."""
+    deletion_jobs = session.get('deletion_jobs', [])
+    deletion_jobs.append(job.id)
+    session['deletion_jobs'] = deletion_jobs[-MAX_TRACKED_DELETIONS:]
+
+
+def untrack_deletion(job_id):
+    deletion_jobs = session.get('deletion_jobs', [])
+    if job_id in deletion_jobs:
+        deletion_jobs.remove(job_id)
+        session['deletion_jobs'] = deletion_jobs
 
 
 def set_diceware_password(user, password):
@@ -294,8 +464,9 @@ def set_diceware_password(user, password):
         'success')
 
 
-def col_download_unread(cols_selected):
-    """Download all unread submissions from all selected sources."""
+def col_download_unread(cols_selected, send=download):
+    """Download all unread submissions from all selected sources, or export
+    them with `send=start_export`."""
     submissions = []
     for filesystem_id in cols_selected:
         id = Source.query.filter(Source.filesystem_id == filesystem_id) \
@@ -307,15 +478,146 @@ def col_download_unread(cols_selected):
         flash(gettext("No unread submissions in selected collections."),
               "error")
         return redirect(url_for('main.index'))
-    return download("unread", submissions)
+    return send("unread", submissions)
 
 
-def col_download_all(cols_selected):
-    """Download all submissions from all selected sources."""
+def col_download_all(cols_selected, send=download):
+    """Download all submissions from all selected sources, or export them
+    with `send=start_export`."""
     submissions = []
     for filesystem_id in cols_selected:
         id = Source.query.filter(Source.filesystem_id == filesystem_id) \
                    .one().id
         submissions += Submission.query.filter(
             Submission.source_id == id).all()
-    return download("all", submissions)
+    return send("all", submissions)
+
+
+# Browsers reconnect to an event stream that ended after this many
+# milliseconds
+EVENT_STREAM_RETRY_MS = 5000
+
+
+def source_events(cursor, poll_seconds, max_seconds):
+    """Generate the server-sent events updating the sources list for the
+    changes journaled after `cursor`: a ``source`` event with the new row of
+    each source changed, or ``source-deleted``. The journal is read whenever
+    changes are published (see :mod:`events`), or at least every
+    `poll_seconds`. The stream ends after `max_seconds`, for the browser to
+    reconnect, so it doesn't hold a web server thread forever."""
+    listener = events.listen()
+    deadline = time.time() + max_seconds
+    try:
+        yield 'retry: {}\n\n'.format(EVENT_STREAM_RETRY_MS)
+        while True:
+            cursor, messages = _source_changes(cursor)
+            # Don't keep a connection, or stale objects, while waiting
+            db.session.remove()
+            for message in messages:
+                yield message
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if not listener.wait(min(poll_seconds, remaining)):
+                # Also lets the server notice the browser went away
+                yield ': keepalive\n\n'
+    finally:
+        listener.close()
+
+
+def _source_changes(cursor, limit=1000):
+    """Return the cursor of the last change journaled after `cursor` (up to
+    `limit` of them), and the events for the sources they changed, in the
+    order they last changed."""
+    changes = Change.query.filter(
+        Change.id > cursor,
+        Change.kind.in_([Change.SOURCE, Change.SUBMISSION])).order_by(
+            Change.id).limit(limit).all()
+    if not changes:
+        return cursor, []
+    latest = {}
+    for change in changes:
+        if change.kind == Change.SOURCE:
+            latest[change.object_id] = change
+        elif not change.deleted:
+            submission = Submission.query.get(change.object_id)
+            if submission is not None:
+                latest[submission.source_id] = change
+
+    messages = []
+    for source_id, change in sorted(latest.items(),
+                                    key=lambda item: item[1].id):
+        source = Source.query.get(source_id)
+        if source is None:
+            messages.append(_event('source-deleted', change.id,
+                                   {'id': source_id}))
+        elif not source.pending:
+            messages.append(_event('source', change.id, {
+                'id': source.id,
+                'starred': bool(source.star and source.star.starred),
+                'row': render_source_row(source)}))
+    return changes[-1].id, messages
+
+
+def render_source_row(source, loop_index=0):
+    """Render the row of `source` in the sources list."""
+    source.num_unread = Submission.query.filter_by(
+        source_id=source.id, downloaded=False).count()
+    return render_template('_source_row.html', source=source,
+                           loop_index=loop_index)
+
+
+def _event(name, event_id, data):
+    return 'event: {}\nid: {}\ndata: {}\n\n'.format(
+        name, event_id, json.dumps(data))
+
+
+# Relative dates on the pages ("3 minutes ago"), and the CSRF tokens in them,
+# age, so a page is only ever considered unchanged for this long
+PAGE_VALIDITY_SECONDS = 60
+
+
+def page_etag(*state):
+    """Return the ETag of a page showing `state`, which has to include
+    everything in the database the page depends on, such as the latest
+    change journaled (see :meth:`models.Change.latest_id`). What the page
+    shows of the journalist and their session is added here. Returns `None`
+    if the page has to be rendered anyway, to show flashed messages."""
+    if session.get('_flashes'):
+        return None
+    user = g.user
+    return hashlib.sha1(json.dumps([
+        version.__version__,
+        request.path,
+        g.locale,
+        user.id,
+        user.username,
+        user.is_admin,
+        session.get('csrf_token'),
+        session.get('deletion_jobs', []),
+        int(time.time() // PAGE_VALIDITY_SECONDS),
+        list(state),
+    ])).hexdigest()
+
+
+def not_modified(etag):
+    """Return a `304 Not Modified` response if the browser has the page
+    with `etag` already, `None` otherwise."""
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    return _revalidated(Response(status=304), etag)
+
+
+def with_etag(page, etag):
+    """Return the response for the rendered `page` with `etag`."""
+    return _revalidated(make_response(page), etag)
+
+
+def _revalidated(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+    # Only for the journalist's browser, which has to check it's still
+    # current every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Recurring housekeeping jobs, run by the scheduler in the worker process
+(see :func:`build_scheduler`)."""
+import datetime
+import logging
+import os
+import re
+import time
+
+import sqlalchemy
+from flask import current_app
+from sqlalchemy import text, true
+
+import export
+import retention
+import spool
+from db import db
+from models import (Change, Journalist, JournalistLoginAttempt, Source,
+                    Submission)
+from scheduler import Daily, Interval, Scheduler
+
+log = logging.getLogger(__name__)
+
+# Name of the files `secure_tempfile.SecureTemporaryFile` spools uploads to
+SPOOL_FILENAME = re.compile(r'^[A-Za-z0-9_-]{43}\.aes$').match
+
+# Uploads can take up to a day over Tor (see `WTF_CSRF_TIME_LIMIT` in
+# `source_app.create_app`), so any spool file older than that was abandoned
+SPOOL_MAX_AGE = 24 * 60 * 60
+
+# Login attempts are only needed for the throttling window, keep a day's
+# worth so there is some margin
+LOGIN_ATTEMPT_MAX_AGE = 24 * 60 * 60
+
+# Pending sources are reaped this many at a time, pausing in between so that
+# sources and journalists get the database lock in the meantime
+REAP_BATCH_SIZE = 200
+REAP_PAUSE = 0.1
+
+
+def clean_tmp(directory, days, log=log):
+    """Remove the files in `directory` that have not been modified in the
+    last `days` days."""
+    if not os.path.exists(directory):
+        log.debug('{} does not exist, do nothing'.format(directory))
+        return 0
+
+    def listdir_fullpath(d):
+        return [os.path.join(d, f) for f in os.listdir(d)]
+
+    too_old = days * 24 * 60 * 60
+    for path in listdir_fullpath(directory):
+        if time.time() - os.stat(path).st_mtime > too_old:
+            os.remove(path)
+            log.debug('{} removed'.format(path))
+        else:
+            log.debug('{} modified less than {} days ago'.format(
+                path, days))
+
+    return 0
+
+
+def clean_upload_spools(directory='/tmp', max_age=SPOOL_MAX_AGE,  # nosec
+                        pattern=SPOOL_FILENAME):
+    """Remove the upload spool files named like `pattern` left behind in
+    `directory` by requests that never completed, or whose job was lost.
+    They can't be read anymore, or are in the store, but they still take up
+    space."""
+    removed = 0
+    now = time.time()
+    if not os.path.isdir(directory):
+        return removed
+    for filename in os.listdir(directory):
+        if not pattern(filename):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if now - os.stat(path).st_mtime > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # The upload finished and removed its spool in the meantime
+            pass
+    if removed:
+        log.info('Removed {} stale upload spool files'.format(removed))
+    return removed
+
+
+def prune_changes():
+    """Delete the entries of the change journal superseded by a later
+    change to the same object. API clients only need the last one, so
+    the journal doesn't grow much larger than there are objects."""
+    latest = db.session.query(sqlalchemy.func.max(Change.id)).group_by(
+        Change.kind, Change.object_id)
+    deleted = Change.query.filter(~Change.id.in_(latest)).delete(
+        synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        log.info('Pruned {} superseded changes'.format(deleted))
+    return deleted
+
+
+def prune_login_attempts(max_age=LOGIN_ATTEMPT_MAX_AGE):
+    """Delete the login attempts that are too old to matter for
+    `Journalist.throttle_login`."""
+    max_age = max(max_age, Journalist._LOGIN_ATTEMPT_PERIOD)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    deleted = JournalistLoginAttempt.query.filter(
+        JournalistLoginAttempt.timestamp < cutoff).delete(
+            synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def reap_pending_sources(max_idle_days, batch_size=REAP_BATCH_SIZE,
+                         pause=REAP_PAUSE):
+    """Delete the sources that never submitted anything and haven't been
+    updated in `max_idle_days`, with their store directory and reply key.
+    Returns how many were deleted.
+
+    Each batch is deleted in a short transaction that checks the conditions
+    again, so a source that submits something between being selected and
+    deleted is kept.
+    """
+    cutoff = (datetime.datetime.utcnow() -
+              datetime.timedelta(days=max_idle_days))
+    idle = (Source.pending == true(), Source.last_updated < cutoff)
+    reaped = 0
+    keys = None
+    while True:
+        candidates = db.session.query(Source.id, Source.filesystem_id).filter(
+            *idle).order_by(Source.last_updated).limit(batch_size).all()
+        if not candidates:
+            break
+        ids = [source_id for source_id, _ in candidates]
+        Source.query.filter(Source.id.in_(ids), *idle).delete(
+            synchronize_session=False)
+        kept = set(source_id for (source_id,) in db.session.query(
+            Source.id).filter(Source.id.in_(ids)))
+        # Bulk deletes bypass the ORM, which journals changes otherwise
+        Change.record(db.session, Change.SOURCE,
+                      [source_id for source_id in ids
+                       if source_id not in kept], deleted=True)
+        db.session.commit()
+        filesystem_ids = [filesystem_id for source_id, filesystem_id in
+                          candidates if source_id not in kept]
+        if filesystem_ids:
+            if keys is None:
+                # Listing a large keyring is slow, so only do it once
+                keys = current_app.crypto_util.source_keys()
+            for filesystem_id in filesystem_ids:
+                if filesystem_id in keys:
+                    current_app.crypto_util.delete_reply_keypair(
+                        filesystem_id)
+            current_app.storage.secure_delete(
+                [(filesystem_id,) for filesystem_id in filesystem_ids])
+            reaped += len(filesystem_ids)
+        time.sleep(pause)
+    if reaped:
+        log.info('Reaped {} pending sources'.format(reaped))
+    return reaped
+
+
+def vacuum_db():
+    """Rebuild the sqlite database to reclaim the space left by deleted rows
+    and refresh the query planner's statistics."""
+    if db.engine.name != 'sqlite':
+        return
+    # VACUUM can't run inside a transaction, so don't use the session
+    with db.engine.connect() as connection:
+        connection.execute(text('VACUUM'))
+        connection.execute(text('ANALYZE'))
+
+
+def upgrade_db():
+    """Add the tables, columns and indexes of the models that a database
+    created by an older release lacks. `db.create_all` only creates
+    missing tables, and only nullable columns are ever added to existing
+    ones. Returns the names of what was added."""
+    added = []
+    db.create_all()
+    inspector = sqlalchemy.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            columns = set(column['name'] for column in
+                          inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                connection.execute(text(
+                    'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name,
+                        column.type.compile(dialect=db.engine.dialect))))
+                added.append('{}.{}'.format(table.name, column.name))
+            indexes = set(index['name'] for index in
+                          inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    added.append(index.name)
+
+        # Submissions downloaded before the time was recorded are treated
+        # as downloaded now by the retention policy
+        connection.execute(
+            Submission.__table__.update().where(
+                Submission.downloaded == sqlalchemy.true()).where(
+                    Submission.downloaded_at.is_(None)).values(
+                        downloaded_at=datetime.datetime.utcnow()))
+    return added
+
+
+def scheduler_state_dir(config):
+    return getattr(config, 'SCHEDULER_STATE_DIR',
+                   os.path.join(config.SECUREDROP_DATA_ROOT, 'scheduler'))
+
+
+def build_scheduler(config, app):
+    """Return a :class:`scheduler.Scheduler` with SecureDrop's recurring
+    jobs registered. Jobs that use the database run in an application
+    context of `app`."""
+    scheduler = Scheduler(scheduler_state_dir(config))
+
+    def in_app_context(func):
+        def wrapper():
+            with app.app_context():
+                return func()
+        return wrapper
+
+    scheduler.register(
+        'clean-tmp', Daily(hour=4, jitter=30 * 60),
+        lambda: clean_tmp(config.TEMP_DIR, 7))
+    scheduler.register(
+        'clean-upload-spools', Interval(60 * 60, jitter=5 * 60),
+        clean_upload_spools)
+    if getattr(config, 'ASYNC_SUBMISSIONS', False):
+        scheduler.register(
+            'clean-submission-spool', Daily(hour=4, jitter=30 * 60),
+            lambda: clean_upload_spools(spool.spool_dir(config),
+                                        spool.SPOOL_MAX_AGE,
+                                        spool.SPOOL_FILENAME))
+    scheduler.register(
+        'clean-exports', Daily(hour=4, jitter=30 * 60),
+        lambda: export.clean_exports(
+            export.export_dir(config),
+            getattr(config, 'EXPORT_MAX_AGE_DAYS', 7) * 24 * 60 * 60))
+    scheduler.register(
+        'prune-login-attempts', Interval(60 * 60, jitter=5 * 60),
+        in_app_context(prune_login_attempts))
+    scheduler.register(
+        'prune-changes', Daily(hour=3, jitter=30 * 60),
+        in_app_context(prune_changes))
+    scheduler.register(
+        'vacuum-db', Daily(hour=3, jitter=30 * 60),
+        in_app_context(vacuum_db))
+    max_idle_days = getattr(config, 'PENDING_SOURCE_MAX_IDLE_DAYS', None)
+    if max_idle_days is not None:
+        scheduler.register(
+            'reap-pending-sources', Interval(60 * 60, jitter=5 * 60),
+            in_app_context(lambda: reap_pending_sources(max_idle_days)))
+    if retention.Policy.from_config(config).enabled:
+        scheduler.register(
+            'retention', Daily(hour=2, jitter=30 * 60),
+            in_app_context(lambda: retention.apply_from_config(config)))
+    return scheduler
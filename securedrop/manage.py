@@ -3,6 +3,7 @@
 
 import argparse
 import codecs
+import json
 import logging
 import os
 import pwd
@@ -22,8 +23,10 @@ from sdconfig import config
 import journalist_app
 
 from db import db
-from models import Journalist, PasswordError, InvalidUsernameException
+from models import (Journalist, PasswordError, InvalidUsernameException,
+                    Source)
 from management.run import run
+from store import PathException
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger(__name__)
@@ -220,22 +223,157 @@ def delete_user(args):
 
 def clean_tmp(args):  # pragma: no cover
     """Cleanup the SecureDrop temp directory. """
-    if not os.path.exists(args.directory):
-        log.debug('{} does not exist, do nothing'.format(args.directory))
-        return 0
+    import maintenance
+    return maintenance.clean_tmp(args.directory, args.days, log)
 
-    def listdir_fullpath(d):
-        return [os.path.join(d, f) for f in os.listdir(d)]
 
-    too_old = args.days * 24 * 60 * 60
-    for path in listdir_fullpath(args.directory):
-        if time.time() - os.stat(path).st_mtime > too_old:
-            os.remove(path)
-            log.debug('{} removed'.format(path))
-        else:
-            log.debug('{} modified less than {} days ago'.format(
-                path, args.days))
+def migrate_store(args):
+    """Move source directories from directly under STORE_DIR to their
+    shard. Sources are moved `args.batch_size` at a time, pausing
+    `args.pause` seconds in between, so this can run while the applications
+    are serving requests: they find sources in either layout. It can be
+    interrupted and run again at any time."""
+    with app_context():
+        storage = current_app.storage
+        moved = 0
+        for filesystem_id in storage.legacy_source_dirs():
+            if storage.migrate_source_dir(filesystem_id):
+                moved += 1
+                if moved % args.batch_size == 0:
+                    log.info('{} sources migrated'.format(moved))
+                    time.sleep(args.pause)
+    log.info('Done, {} sources migrated'.format(moved))
+    return 0
+
+
+def migrate_filenames(args):
+    """Rename the submissions and replies stored under the old naming scheme,
+    which included the journalist designation, to their stable names. Each
+    source's files are renamed and committed together; it can be
+    interrupted and run again at any time."""
+    with app_context():
+        storage = current_app.storage
+        migrated = failed = 0
+        for source in Source.query.all():
+            for item in source.collection:
+                try:
+                    filename = storage.migrate_filename(source.filesystem_id,
+                                                        item.filename)
+                except (OSError, PathException) as e:
+                    log.error('Could not migrate {}: {}'.format(
+                        item.filename, e))
+                    failed += 1
+                    continue
+                if filename != item.filename:
+                    item.filename = filename
+                    migrated += 1
+            db.session.commit()
+    log.info('Done, {} files migrated, {} failed'.format(migrated, failed))
+    return 1 if failed else 0
+
+
+def fsck(args):
+    """Check that the store, the database and the keyring agree, see
+    `fsck.py`. Each issue found is printed on a line of its own, as JSON with
+    `--json`. With `--repair`, orphaned files and source directories older
+    than a day are queued for secure deletion. Returns 1 if any issue was
+    found."""
+    import fsck as store_fsck
+    counts = {}
+    with app_context():
+        issues = []
+        for issue in store_fsck.check(
+                current_app.storage,
+                crypto_util=None if args.skip_keyring else
+                current_app.crypto_util,
+                journalist_key=config.JOURNALIST_KEY,
+                jobs=args.jobs or store_fsck.DEFAULT_JOBS,
+                batch_size=args.batch_size or store_fsck.DEFAULT_BATCH_SIZE,
+                check_headers=args.check_headers):
+            counts[issue.type] = counts.get(issue.type, 0) + 1
+            if args.json:
+                print(json.dumps(issue.as_dict(), sort_keys=True))
+            else:
+                print(str(issue))
+            if args.repair and issue.type in store_fsck.REPAIRABLE:
+                issues.append(issue)
+        job = store_fsck.repair(current_app.storage, issues)
+    if args.json:
+        print(json.dumps({'type': 'summary', 'issues': counts,
+                          'repair_job': job.id if job else None},
+                         sort_keys=True))
+    else:
+        log.info('Done, {} issues found'.format(sum(counts.values())))
+        if job:
+            log.info('Orphans older than {} hours queued for deletion by '
+                     'job {}'.format(store_fsck.ORPHAN_MIN_AGE // 3600,
+                                     job.id))
+    return 1 if counts else 0
+
+
+def stats(args):
+    """Print a capacity report of the store, the database, the keyring and
+    the temporary directory as JSON, see `stats.py`."""
+    import stats as store_stats
+    with app_context():
+        result = store_stats.report(
+            current_app.storage, config,
+            crypto_util=current_app.crypto_util if args.count_keys else None,
+            top=args.top or store_stats.DEFAULT_TOP,
+            jobs=args.jobs or store_stats.DEFAULT_JOBS)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+
+def apply_retention(args):
+    """Delete the submissions and sources that are past the retention policy
+    set in `config.py`, see `retention.py`, and print a summary as JSON. With
+    `--dry-run`, only list what would be deleted."""
+    import retention
+    policy = retention.Policy.from_config(config)
+    if not policy.enabled:
+        log.error('No retention policy is set in config.py')
+        return 1
+    with app_context():
+        summary = retention.apply(policy, dry_run=args.dry_run)
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    return 0
+
+
+def reap_pending_sources(args):
+    """Delete the sources that never submitted anything and have been idle
+    for `args.days` days, see `maintenance.reap_pending_sources`."""
+    if args.days is None:
+        log.error('Set PENDING_SOURCE_MAX_IDLE_DAYS in config.py or pass '
+                  '--days')
+        return 1
+    import maintenance
+    with app_context():
+        reaped = maintenance.reap_pending_sources(args.days)
+    log.info('Done, {} pending sources deleted'.format(reaped))
+    return 0
+
 
+def upgrade_db(args):
+    """Add what the database of an older release lacks, see
+    `maintenance.upgrade_db`."""
+    import maintenance
+    with app_context():
+        added = maintenance.upgrade_db()
+    for name in added:
+        log.info('Added {}'.format(name))
+    log.info('Done, the database is up to date')
+    return 0
+
+
+def scheduled_jobs(args):
+    """Print the last run, duration and outcome of the recurring jobs run by
+    the worker's scheduler, as JSON."""
+    import maintenance
+    import scheduler
+    state = scheduler.load_state(
+        args.state_dir or maintenance.scheduler_state_dir(config))
+    print(json.dumps(state, indent=2, sort_keys=True))
     return 0
 
 
@@ -286,6 +424,97 @@ def get_args():
     set_clean_tmp_parser(subps, 'clean-tmp')
     set_clean_tmp_parser(subps, 'clean_tmp')
 
+    migrate_store_subp = subps.add_parser(
+        'migrate-store', help='Move source directories to the sharded '
+        'store layout.')
+    migrate_store_subp.add_argument(
+        '--batch-size', default=1000, type=int,
+        help='number of sources to move between pauses '
+        '(default %(default)s)')
+    migrate_store_subp.add_argument(
+        '--pause', default=1.0, type=float,
+        help='seconds to pause between batches (default %(default)s)')
+    migrate_store_subp.set_defaults(func=migrate_store)
+
+    migrate_filenames_subp = subps.add_parser(
+        'migrate-filenames', help='Rename stored submissions and replies so '
+        'their names no longer include the journalist designation.')
+    migrate_filenames_subp.set_defaults(func=migrate_filenames)
+
+    fsck_subp = subps.add_parser(
+        'fsck', help='Check that the stored files, the database and the '
+        'keyring agree.')
+    fsck_subp.add_argument(
+        '--jobs', type=int,
+        help='number of source directories scanned in parallel '
+        '(default DEFAULT_JOBS of fsck.py)')
+    fsck_subp.add_argument(
+        '--batch-size', type=int,
+        help='number of sources looked up in the database at once '
+        '(default DEFAULT_BATCH_SIZE of fsck.py)')
+    fsck_subp.add_argument(
+        '--check-headers', action='store_true',
+        help='check that every file starts like an OpenPGP message')
+    fsck_subp.add_argument(
+        '--skip-keyring', action='store_true',
+        help="don't check the keyring")
+    fsck_subp.add_argument(
+        '--json', action='store_true',
+        help='print issues as JSON, one object per line')
+    fsck_subp.add_argument(
+        '--repair', action='store_true',
+        help='queue orphaned files and source directories for secure '
+        'deletion, unless they were modified in the last day')
+    fsck_subp.set_defaults(func=fsck)
+
+    stats_subp = subps.add_parser(
+        'stats', help='Report the disk usage of the store, the database, '
+        'the keyring and the temporary directory as JSON.')
+    stats_subp.add_argument(
+        '--top', type=int,
+        help='number of sources using the most space to list '
+        '(default DEFAULT_TOP of stats.py)')
+    stats_subp.add_argument(
+        '--jobs', type=int,
+        help='number of threads walking the store '
+        '(default DEFAULT_JOBS of stats.py)')
+    stats_subp.add_argument(
+        '--count-keys', action='store_true',
+        help='count the keys in the keyring, which is slow for large ones')
+    stats_subp.set_defaults(func=stats)
+
+    retention_subp = subps.add_parser(
+        'retention', help='Delete the submissions and sources that are past '
+        'the retention policy.')
+    retention_subp.add_argument(
+        '--dry-run', action='store_true',
+        help='only list what would be deleted')
+    retention_subp.set_defaults(func=apply_retention)
+
+    reap_subp = subps.add_parser(
+        'reap-pending-sources', help='Delete the sources that never '
+        'submitted anything and have been idle for a while.')
+    reap_subp.add_argument(
+        '--days', type=int,
+        default=getattr(config, 'PENDING_SOURCE_MAX_IDLE_DAYS', None),
+        help='idle days after which a pending source is deleted '
+        '(default %(default)s)')
+    reap_subp.set_defaults(func=reap_pending_sources)
+
+    upgrade_db_subp = subps.add_parser(
+        'upgrade-db', help='Add the columns and indexes a database created '
+        'by an older release lacks.')
+    upgrade_db_subp.set_defaults(func=upgrade_db)
+
+    scheduled_jobs_subp = subps.add_parser(
+        'scheduled-jobs', help='Show the status of the recurring jobs run '
+        'by the worker.')
+    scheduled_jobs_subp.add_argument(
+        '--state-dir',
+        help='scheduler state directory (default SCHEDULER_STATE_DIR of '
+        'config.py)')
+    scheduled_jobs_subp.set_defaults(func=scheduled_jobs)
+
     init_db_subp = subps.add_parser('init-db', help='initialize the DB')
     init_db_subp.add_argument('-u', '--user',
                               help='Unix user for the DB',
@@ -5,9 +5,6 @@ import base64
 import os
 import scrypt
 import pyotp
-import qrcode
-# Using svg because it doesn't require additional dependencies
-import qrcode.image.svg
 
 # Find the best implementation available on this platform
 try:
@@ -16,12 +13,16 @@ except ImportError:
     from StringIO import StringIO  # type: ignore
 
 from flask import current_app
+from itsdangerous import BadData, TimedJSONWebSignatureSerializer
 from jinja2 import Markup
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, event, func, select
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Binary
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
+import store
+
 from db import db
 
 
@@ -52,7 +53,8 @@ class Source(db.Model):
     filesystem_id = Column(String(96), unique=True)
     journalist_designation = Column(String(255), nullable=False)
     flagged = Column(Boolean, default=False)
-    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow,
+                          index=True)
     star = relationship("SourceStar", uselist=False, backref="source")
 
     # sources are "pending" and don't get displayed to journalists until they
@@ -73,6 +75,26 @@ class Source(db.Model):
     def __repr__(self):
         return '<Source %r>' % (self.journalist_designation)
 
+    def allocate_interactions(self, count=1):
+        """Reserve the next `count` interaction numbers, for the filenames of
+        new submissions and replies, and return them in order.
+
+        The counter is incremented by the database, in a short transaction
+        of its own, so concurrent requests for the same source never get the
+        same numbers, and it isn't held while the files are encrypted.
+        """
+        table = Source.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(
+                table.c.id == self.id).values(
+                    interaction_count=table.c.interaction_count + count))
+            last = connection.execute(
+                select([table.c.interaction_count]).where(
+                    table.c.id == self.id)).scalar()
+        # Not a change to flush, the database has it already
+        set_committed_value(self, 'interaction_count', last)
+        return list(range(last - count + 1, last + 1))
+
     @property
     def journalist_filename(self):
         valid_chars = 'abcdefghijklmnopqrstuvwxyz1234567890-_'
@@ -115,16 +137,47 @@ class Submission(db.Model):
     filename = Column(String(255), nullable=False)
     size = Column(Integer, nullable=False)
     downloaded = Column(Boolean, default=False)
-
-    def __init__(self, source, filename):
+    # When a journalist first downloaded it, for the retention policy
+    downloaded_at = Column(DateTime, nullable=True, index=True)
+    # `PROCESSING` while it waits to be encrypted by the worker (see
+    # `spool`), `FAILED` if that failed, and `None` once it's stored
+    state = Column(String(16), nullable=True)
+    # Keyed digest of a document's plaintext, to recognize the source
+    # uploading it again (see `DEDUPLICATE_SUBMISSIONS`)
+    digest = Column(String(64), nullable=True)
+
+    PROCESSING = 'processing'
+    FAILED = 'failed'
+
+    def __init__(self, source, filename, size=None):
         self.source_id = source.id
         self.filename = filename
-        self.size = os.stat(current_app.storage.path(source.filesystem_id,
-                                                     filename)).st_size
+        if size is None:
+            size = current_app.storage.stat(source.filesystem_id,
+                                            filename).size
+        self.size = size
 
     def __repr__(self):
         return '<Submission %r>' % (self.filename)
 
+    @property
+    def processing(self):
+        return self.state == Submission.PROCESSING
+
+    @property
+    def failed(self):
+        return self.state == Submission.FAILED
+
+    def mark_downloaded(self):
+        self.downloaded = True
+        if self.downloaded_at is None:
+            self.downloaded_at = datetime.datetime.utcnow()
+
+    @property
+    def display_filename(self):
+        return store.display_filename(self.filename,
+                                      self.source.journalist_filename)
+
 
 class Reply(db.Model):
     __tablename__ = "replies"
@@ -145,17 +198,80 @@ class Reply(db.Model):
 
     filename = Column(String(255), nullable=False)
     size = Column(Integer, nullable=False)
+    # Replies sent by older releases don't have it
+    created_on = Column(DateTime, nullable=True,
+                        default=datetime.datetime.utcnow)
 
     def __init__(self, journalist, source, filename):
         self.journalist_id = journalist.id
         self.source_id = source.id
         self.filename = filename
-        self.size = os.stat(current_app.storage.path(source.filesystem_id,
-                                                     filename)).st_size
+        self.size = current_app.storage.stat(source.filesystem_id,
+                                             filename).size
 
     def __repr__(self):
         return '<Reply %r>' % (self.filename)
 
+    @property
+    def display_filename(self):
+        return store.display_filename(self.filename,
+                                      self.source.journalist_filename)
+
+
+class Change(db.Model):
+
+    """An entry in the journal of changes to sources, submissions and replies
+    that API clients sync from (see `journalist_app.api`), with `id` as the
+    cursor. Entries are added by the mapper events below, in the
+    transaction making the change, and SQLite serializes those, so the ids
+    of committed changes only ever increase."""
+    __tablename__ = 'changes'
+    __table_args__ = (Index('ix_changes_object', 'kind', 'object_id'),
+                      {'sqlite_autoincrement': True})
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)
+    object_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, default=False, nullable=False)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+
+    SOURCE = 'source'
+    SUBMISSION = 'submission'
+    REPLY = 'reply'
+
+    @classmethod
+    def latest_id(cls):
+        """Return the cursor of the latest change, 0 if there are none."""
+        return db.session.query(func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def record(cls, connection, kind, object_ids, deleted=False):
+        """Journal changes to the `kind` of objects `object_ids` made on
+        `connection` (or a session) other than through the ORM, e.g. with
+        a bulk delete."""
+        if not object_ids:
+            return
+        connection.execute(cls.__table__.insert(), [
+            {'kind': kind, 'object_id': object_id, 'deleted': deleted,
+             'timestamp': datetime.datetime.utcnow()}
+            for object_id in object_ids])
+
+
+def _journal(kind, deleted=False, object_id=lambda target: target.id):
+    def listener(mapper, connection, target):
+        # A star is orphaned when its source is deleted, which is journaled
+        # on its own
+        if object_id(target) is not None:
+            Change.record(connection, kind, [object_id(target)], deleted)
+    return listener
+
+
+for _model, _kind in ((Source, Change.SOURCE),
+                      (Submission, Change.SUBMISSION),
+                      (Reply, Change.REPLY)):
+    event.listen(_model, 'after_insert', _journal(_kind))
+    event.listen(_model, 'after_update', _journal(_kind))
+    event.listen(_model, 'after_delete', _journal(_kind, deleted=True))
+
 
 class SourceStar(db.Model):
     __tablename__ = 'source_stars'
@@ -174,6 +290,13 @@ class SourceStar(db.Model):
         self.starred = starred
 
 
+# Whether it's starred is part of the source's state
+for _event in ('after_insert', 'after_update'):
+    event.listen(SourceStar, _event,
+                 _journal(Change.SOURCE,
+                          object_id=lambda target: target.source_id))
+
+
 class InvalidUsernameException(Exception):
 
     """Raised when a user logs in with an invalid username"""
@@ -335,6 +458,11 @@ class Journalist(db.Model):
 
     @property
     def shared_secret_qrcode(self):
+        # Only needed to set up two-factor authentication, so not imported
+        # by every web server process. Using svg because it doesn't require
+        # additional dependencies
+        import qrcode.image.svg
+
         uri = self.totp.provisioning_uri(
             self.username,
             issuer_name="SecureDrop")
@@ -430,6 +558,25 @@ class Journalist(db.Model):
             raise WrongPasswordException("invalid password")
         return user
 
+    def generate_api_token(self, expiration):
+        """Return a token authenticating API requests as this journalist
+        for `expiration` seconds."""
+        serializer = TimedJSONWebSignatureSerializer(
+            current_app.config['SECRET_KEY'], expires_in=expiration)
+        return serializer.dumps({'id': self.id}).decode('ascii')
+
+    @staticmethod
+    def validate_api_token_and_get_user(token):
+        """Return the journalist the API `token` was generated for, or `None`
+        if it's invalid or expired."""
+        serializer = TimedJSONWebSignatureSerializer(
+            current_app.config['SECRET_KEY'])
+        try:
+            data = serializer.loads(token)
+        except BadData:
+            return None
+        return Journalist.query.get(data['id'])
+
 
 class JournalistLoginAttempt(db.Model):
 
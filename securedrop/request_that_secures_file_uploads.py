@@ -1,9 +1,16 @@
 from io import BytesIO
 
-from flask import wrappers
+from flask import g, wrappers
 
 from secure_tempfile import SecureTemporaryFile
 
+# We don't use `config.TEMP_DIR` here because that directory is exposed via
+# X-Send-File and there is no reason for these files to be publicly
+# accessible. See note in `config.py` for more info. Instead, we just use
+# `/tmp`, which has the additional benefit of being automatically cleared on
+# reboot.
+SPOOL_DIR = '/tmp'  # nosec
+
 
 class RequestThatSecuresFileUploads(wrappers.Request):
 
@@ -16,15 +23,16 @@ class RequestThatSecuresFileUploads(wrappers.Request):
         it on disk, encrypted with an ephemeral key to mitigate
         forensic recovery of the plaintext.
 
+        The documents of a submission are instead compressed and encrypted
+        to the journalist key as they are received, if the view set
+        `g.spool_upload` to open a `spool.SpoolFile` for them.
+
         """
+        spool_upload = g.get('spool_upload')
+        if spool_upload is not None and filename:
+            return spool_upload(filename)
         if total_content_length > 1024 * 512:
-            # We don't use `config.TEMP_DIR` here because that
-            # directory is exposed via X-Send-File and there is no
-            # reason for these files to be publicly accessible. See
-            # note in `config.py` for more info. Instead, we just use
-            # `/tmp`, which has the additional benefit of being
-            # automatically cleared on reboot.
-            return SecureTemporaryFile('/tmp')  # nosec
+            return SecureTemporaryFile(SPOOL_DIR)
         return BytesIO()
 
     def make_form_data_parser(self):
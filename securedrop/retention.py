@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Delete submissions and sources once they are past the retention policy
+set in `config.py`:
+
+* `RETENTION_DOWNLOADED_SUBMISSION_DAYS`: submissions are deleted that many
+  days after a journalist first downloaded them. Submissions that were
+  never downloaded are kept.
+* `RETENTION_INACTIVE_SOURCE_DAYS`: sources, with all their submissions,
+  replies and their reply key, are deleted when they have been inactive for
+  that many days. Sources that never submitted anything are left to
+  `maintenance.reap_pending_sources`.
+
+Either is disabled when `None`. The policy is applied daily by the worker's
+scheduler, and can be previewed with `./manage.py retention --dry-run`.
+
+Candidates are selected with indexed queries, `RETENTION_BATCH_SIZE` at a
+time, and each batch is deleted from the database and queued for secure
+deletion as a single `rm.srm_batch` job before the next one is selected.
+After every run a summary, with counts only so it doesn't keep track of
+what was deleted, is appended to `RETENTION_AUDIT_LOG`.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+
+from flask import current_app
+from sqlalchemy import false
+from sqlalchemy.orm import joinedload
+
+from db import db
+from models import Source, Submission
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Any, Dict, List, Optional  # noqa: F401
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+class Policy(collections.namedtuple('Policy', [
+        'downloaded_submission_days', 'inactive_source_days', 'batch_size',
+        'audit_log'])):
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            downloaded_submission_days=getattr(
+                config, 'RETENTION_DOWNLOADED_SUBMISSION_DAYS', None),
+            inactive_source_days=getattr(
+                config, 'RETENTION_INACTIVE_SOURCE_DAYS', None),
+            batch_size=getattr(config, 'RETENTION_BATCH_SIZE',
+                               DEFAULT_BATCH_SIZE),
+            audit_log=getattr(config, 'RETENTION_AUDIT_LOG', os.path.join(
+                config.SECUREDROP_DATA_ROOT, 'retention.log')))
+
+    @property
+    def enabled(self):
+        return (self.downloaded_submission_days is not None or
+                self.inactive_source_days is not None)
+
+
+def apply(policy, dry_run=False, now=None):
+    """Delete what is past `policy`, or with `dry_run` only report it.
+    Returns the summary, which with `dry_run` also lists the candidates.
+    Needs an application context."""
+    now = now or datetime.datetime.utcnow()
+    summary = {
+        'started_at': now.isoformat(),
+        'dry_run': dry_run,
+        'policy': {
+            'downloaded_submission_days': policy.downloaded_submission_days,
+            'inactive_source_days': policy.inactive_source_days,
+        },
+        'sources': {'count': 0},
+        'submissions': {'count': 0, 'bytes': 0},
+        'jobs': [],
+    }  # type: Dict[str, Any]
+    candidates = {'sources': [], 'submissions': []}  # type: Dict[str, List]
+
+    # Sources first, so their submissions aren't deleted one by one
+    if policy.inactive_source_days is not None:
+        cutoff = now - datetime.timedelta(days=policy.inactive_source_days)
+        query = Source.query.filter(Source.pending == false(),
+                                    Source.last_updated < cutoff)
+        for batch in _batches(query, Source.id, policy.batch_size, dry_run):
+            summary['sources']['count'] += len(batch)
+            if dry_run:
+                candidates['sources'].extend(
+                    source.journalist_designation for source in batch)
+                continue
+            summary['jobs'].append(_delete_sources(batch))
+
+    if policy.downloaded_submission_days is not None:
+        cutoff = now - datetime.timedelta(
+            days=policy.downloaded_submission_days)
+        query = Submission.query.options(joinedload(Submission.source)).filter(
+            Submission.downloaded_at < cutoff)
+        for batch in _batches(query, Submission.id, policy.batch_size,
+                              dry_run):
+            summary['submissions']['count'] += len(batch)
+            summary['submissions']['bytes'] += sum(
+                submission.size for submission in batch)
+            if dry_run:
+                candidates['submissions'].extend(
+                    (submission.source.journalist_designation,
+                     submission.display_filename) for submission in batch)
+                continue
+            summary['jobs'].append(_delete_submissions(batch))
+
+    summary['finished_at'] = datetime.datetime.utcnow().isoformat()
+    _audit(policy, summary)
+    if dry_run:
+        summary['candidates'] = candidates
+    return summary
+
+
+def apply_from_config(config):
+    """Scheduler job applying the policy in `config`."""
+    policy = Policy.from_config(config)
+    if policy.enabled:
+        apply(policy)
+
+
+def _batches(query, key, size, dry_run):
+    """Yield the results of `query` `size` at a time, ordered by `key`.
+
+    When deleting, each batch is gone by the time the next one is selected,
+    so the query is simply run again; a dry run carries on after the last
+    `key` seen instead.
+    """
+    last = None
+    while True:
+        batch_query = query
+        if dry_run and last is not None:
+            batch_query = batch_query.filter(key > last)
+        batch = batch_query.order_by(key).limit(size).all()
+        if not batch:
+            return
+        last = getattr(batch[-1], key.key)
+        yield batch
+
+
+def _delete_sources(sources):
+    items = []
+    for source in sources:
+        current_app.crypto_util.delete_reply_keypair(source.filesystem_id)
+        items.append((source.filesystem_id,))
+        db.session.delete(source)
+    db.session.commit()
+    return current_app.storage.secure_delete(items).id
+
+
+def _delete_submissions(submissions):
+    items = []
+    for submission in submissions:
+        items.append((submission.source.filesystem_id, submission.filename))
+        db.session.delete(submission)
+    db.session.commit()
+    return current_app.storage.secure_delete(items).id
+
+
+def _audit(policy, summary):
+    log.info('Retention policy {}: {} sources and {} submissions ({} bytes) '
+             '{}'.format(
+                 'dry run' if summary['dry_run'] else 'applied',
+                 summary['sources']['count'], summary['submissions']['count'],
+                 summary['submissions']['bytes'],
+                 'would be deleted' if summary['dry_run'] else 'deleted'))
+    with open(policy.audit_log, 'a') as f:
+        f.write(json.dumps(summary, sort_keys=True) + '\n')
@@ -16,9 +16,187 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import subprocess
+import logging
+import os
+import stat
+import string
+import time
+
+from Cryptodome.Random import random
+
+import store_pack
+import worker
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Optional  # noqa: F401
+
+
+class SecureDeleter(object):
+
+    """Securely delete files and directory trees without shelling out to
+    `srm`.
+
+    Every file is overwritten `passes` times with random data. The file is
+    flushed to disk with a single `fdatasync` at the end of each pass rather
+    than after every chunk. It is then renamed to a random name of the same
+    length, so the original filename does not linger in the directory, and
+    unlinked. Directories are handled recursively, bottom up, and each one
+    is synced once after all of its entries are gone.
+
+    Setting `max_bytes_per_second` caps the overwrite throughput so a large
+    deletion does not saturate the disk while uploads are being written.
+    """
+
+    # `srm` defaults to the 38 pass Gutmann method, which is pointless on
+    # modern disks and very slow. Three random passes is plenty for spinning
+    # disks, and a single pass is enough for SSD backed stores, where the
+    # flash translation layer makes further passes ineffective anyway.
+    DEFAULT_PASSES = 3
+    CHUNK_SIZE = 1024 * 1024
+    NAME_CHARS = string.ascii_letters + string.digits
+
+    def __init__(self, passes=DEFAULT_PASSES, max_bytes_per_second=None,
+                 chunk_size=CHUNK_SIZE):
+        # type: (int, Optional[int], int) -> None
+        if passes < 1:
+            raise ValueError("at least one overwrite pass is required")
+        self.passes = passes
+        self.max_bytes_per_second = max_bytes_per_second
+        self.chunk_size = chunk_size
+        self.bytes_written = 0
+        self.__started = None  # type: Optional[float]
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            passes=getattr(config, 'SECURE_DELETE_PASSES',
+                           cls.DEFAULT_PASSES),
+            max_bytes_per_second=getattr(
+                config, 'SECURE_DELETE_MAX_BYTES_PER_SECOND', None))
+
+    def delete(self, path):
+        # type: (str) -> None
+        """Securely delete the file or directory tree at `path`."""
+        mode = os.lstat(path).st_mode
+        if stat.S_ISDIR(mode):
+            self._delete_tree(path)
+        else:
+            self._delete_file(path, mode)
+        self._sync_dir(os.path.dirname(path))
+
+    def _delete_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                self._delete_file(path, os.lstat(path).st_mode)
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                # os.walk lists symlinks to directories as directories
+                if os.path.islink(path):
+                    os.unlink(self._rename(path))
+                else:
+                    os.rmdir(self._rename(path))
+            self._sync_dir(dirpath)
+        os.rmdir(self._rename(top))
+
+    def _delete_file(self, path, mode):
+        # Only regular files have contents of their own worth overwriting
+        if stat.S_ISREG(mode):
+            self._overwrite(path)
+        os.unlink(self._rename(path))
+
+    def _overwrite(self, path):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            size = os.fstat(fd).st_size
+            for _ in range(self.passes):
+                os.lseek(fd, 0, os.SEEK_SET)
+                remaining = size
+                while remaining > 0:
+                    n = min(self.chunk_size, remaining)
+                    self._throttle(n)
+                    os.write(fd, os.urandom(n))
+                    remaining -= n
+                os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+    def _rename(self, path):
+        dirname, basename = os.path.split(path)
+        while True:
+            name = ''.join(random.choice(self.NAME_CHARS)
+                           for _ in range(len(basename)))
+            new_path = os.path.join(dirname, name)
+            if not os.path.lexists(new_path):
+                break
+        os.rename(path, new_path)
+        return new_path
+
+    def _sync_dir(self, path):
+        fd = os.open(path or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _throttle(self, nbytes):
+        now = time.time()
+        if self.__started is None:
+            self.__started = now
+        if self.max_bytes_per_second:
+            # Sleep until writing `nbytes` more stays within the budget
+            earliest = (self.__started +
+                        float(self.bytes_written + nbytes) /
+                        self.max_bytes_per_second)
+            if earliest > now:
+                time.sleep(earliest - now)
+        self.bytes_written += nbytes
+
+
+def _get_deleter():
+    # The worker has no application context, so read the settings from the
+    # configuration module directly
+    from sdconfig import config
+    return SecureDeleter.from_config(config)
 
 
 def srm(fn):
-    subprocess.check_call(['srm', '-r', fn])
+    _get_deleter().delete(fn)
+    return "success"
+
+
+def srm_batch(paths, compact=()):
+    """Securely delete every path in *paths* within a single worker job,
+    then compact the packs of the source directories in *compact* (see
+    :meth:`store_pack.Pack.compact`) so the ciphertext of their deleted
+    entries is shredded too.
+
+    Progress is stored in the job's ``meta`` after each path and pack, so
+    that it can be polled with :func:`worker.job_progress` while a large
+    batch is being shredded. Paths that are already gone are skipped.
+    """
+    job = worker.get_current_job()
+    deleter = _get_deleter()
+    total = len(paths) + len(compact)
+    worker.set_progress(job, 0, total)
+    done = 0
+    for path in paths:
+        if os.path.lexists(path):
+            deleter.delete(path)
+        else:
+            logging.getLogger(__name__).warning(
+                "srm_batch: {} no longer exists, skipping".format(path))
+        done += 1
+        worker.set_progress(job, done, total)
+    for directory in compact:
+        if os.path.isdir(directory):
+            store_pack.Pack(directory).compact(deleter)
+        done += 1
+        worker.set_progress(job, done, total)
     return "success"
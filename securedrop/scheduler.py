@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""A small cron-style scheduler for recurring maintenance jobs.
+
+It runs as a thread inside the worker process (see
+:class:`worker.SchedulingWorker`), so housekeeping is registered in code
+(see :mod:`maintenance`) rather than in cron templates.
+
+Each job holds an exclusive lock file while it runs, so a job never runs
+concurrently with itself, even if more than one scheduler is running. The
+last run, duration and outcome of every job is written to a state file
+which `./manage.py scheduled-jobs` reports on.
+"""
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from Cryptodome.Random import random
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Any, Callable, Dict, Optional  # noqa: F401
+
+STATE_FILE = 'state.json'
+
+log = logging.getLogger(__name__)
+
+
+def _jitter(seconds):
+    # type: (float) -> float
+    if not seconds:
+        return 0
+    return random.randint(0, int(seconds * 1000)) / 1000.0
+
+
+class Interval(object):
+
+    """Run every `seconds` seconds, delayed by up to `jitter` seconds."""
+
+    def __init__(self, seconds, jitter=0):
+        self.seconds = seconds
+        self.jitter = jitter
+
+    def next_run(self, last_run, now):
+        # type: (Optional[float], float) -> float
+        if last_run is None:
+            # Spread out the first runs rather than running everything as
+            # soon as the worker starts
+            return now + _jitter(self.jitter or self.seconds)
+        return max(now, last_run + self.seconds) + _jitter(self.jitter)
+
+
+class Daily(object):
+
+    """Run once a day at `hour`:`minute` local time, delayed by up to
+    `jitter` seconds. A run that was missed, because the worker was down at
+    the time, is caught up on immediately."""
+
+    def __init__(self, hour, minute=0, jitter=0):
+        self.hour = hour
+        self.minute = minute
+        self.jitter = jitter
+
+    def next_run(self, last_run, now):
+        # type: (Optional[float], float) -> float
+        current = datetime.datetime.fromtimestamp(now)
+        candidate = current.replace(hour=self.hour, minute=self.minute,
+                                    second=0, microsecond=0)
+        if candidate <= current:
+            if (last_run is not None and
+                    last_run < time.mktime(candidate.timetuple())):
+                return now + _jitter(self.jitter)
+            candidate += datetime.timedelta(days=1)
+        return time.mktime(candidate.timetuple()) + _jitter(self.jitter)
+
+
+class ScheduledJob(object):
+
+    def __init__(self, name, schedule, func):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.next_run = None  # type: Optional[float]
+        self.last_run = None  # type: Optional[float]
+        self.last_duration = None  # type: Optional[float]
+        self.last_status = None  # type: Optional[str]
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def status(self):
+        # type: () -> Dict[str, Any]
+        return {'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'last_status': self.last_status,
+                'next_run': self.next_run,
+                'runs': self.runs,
+                'running': self.lock.locked()}
+
+
+class Scheduler(object):
+
+    """Run registered jobs when their schedule says they are due.
+
+    `state_dir` holds one lock file per job plus the state file. Due jobs
+    are started in their own thread, so a long job doesn't delay the
+    others.
+    """
+
+    def __init__(self, state_dir, tick=30, clock=time.time):
+        self.state_dir = state_dir
+        self.tick = tick
+        self.clock = clock
+        self.jobs = {}  # type: Dict[str, ScheduledJob]
+        self.__stopped = threading.Event()
+        self.__thread = None  # type: Optional[threading.Thread]
+        self.__state_lock = threading.Lock()
+
+    def register(self, name, schedule, func):
+        # type: (str, Any, Callable) -> ScheduledJob
+        job = ScheduledJob(name, schedule, func)
+        # Carry on from the last run recorded before the worker restarted
+        state = load_state(self.state_dir).get(name, {})
+        for key in ('last_run', 'last_duration', 'last_status', 'runs'):
+            if key in state:
+                setattr(job, key, state[key])
+        job.next_run = schedule.next_run(job.last_run, self.clock())
+        self.jobs[name] = job
+        return job
+
+    def run_pending(self, wait=False):
+        """Start every job that is due. With `wait`, block until they are
+        done, otherwise return the threads running them."""
+        now = self.clock()
+        threads = []
+        for job in sorted(self.jobs.values(), key=lambda j: j.next_run):
+            if job.next_run > now:
+                continue
+            job.next_run = job.schedule.next_run(now, now)
+            thread = threading.Thread(target=self.run, args=(job,),
+                                      name='scheduler-' + job.name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        if wait:
+            for thread in threads:
+                thread.join()
+        return threads
+
+    def run(self, job):
+        # type: (ScheduledJob) -> bool
+        """Run `job` now unless it's already running, here or in another
+        process. Returns whether the job ran."""
+        if not job.lock.acquire(False):
+            log.info("{} is still running, skipping".format(job.name))
+            return False
+        try:
+            with self._file_lock(job) as locked:
+                if not locked:
+                    log.info("{} is running in another process, "
+                             "skipping".format(job.name))
+                    return False
+                self._run(job)
+                return True
+        finally:
+            job.lock.release()
+
+    def _run(self, job):
+        start = self.clock()
+        try:
+            job.func()
+        except Exception as e:
+            job.last_status = 'failed'
+            log.error("Scheduled job {} failed: {}".format(job.name, e))
+        else:
+            job.last_status = 'success'
+        job.last_run = start
+        job.last_duration = self.clock() - start
+        job.runs += 1
+        self.save_state()
+
+    def _file_lock(self, job):
+        return _FileLock(os.path.join(self.state_dir, job.name + '.lock'))
+
+    def status(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        return dict((name, job.status()) for name, job in self.jobs.items())
+
+    def save_state(self):
+        path = os.path.join(self.state_dir, STATE_FILE)
+        with self.__state_lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.status(), f, indent=2, sort_keys=True)
+            os.rename(path + '.tmp', path)
+
+    def start(self):
+        """Run the scheduler in a background thread."""
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, 0o700)
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__loop, name='scheduler')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __loop(self):
+        while not self.__stopped.is_set():
+            try:
+                self.run_pending()
+            except Exception as e:
+                log.error("Scheduler failed to start jobs: {}".format(e))
+            self.__stopped.wait(self.tick)
+
+
+def load_state(state_dir):
+    # type: (str) -> Dict[str, Dict[str, Any]]
+    """Read the job status last written by a scheduler using `state_dir`."""
+    try:
+        with open(os.path.join(state_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return {}
+        raise
+
+
+class _FileLock(object):
+
+    """Context manager taking a non-blocking exclusive `flock` on `path`.
+    Evaluates to whether the lock was acquired."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None  # type: Optional[int]
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -112,6 +112,18 @@ class SDConfig(object):
         except AttributeError:
             pass
 
+        try:
+            self.SECURE_DELETE_PASSES = \
+                _config.SECURE_DELETE_PASSES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SECURE_DELETE_MAX_BYTES_PER_SECOND = \
+                _config.SECURE_DELETE_MAX_BYTES_PER_SECOND  # type: ignore
+        except AttributeError:
+            pass
+
         try:
             self.SESSION_EXPIRATION_MINUTES = \
                 _config.SESSION_EXPIRATION_MINUTES  # type: ignore
@@ -155,6 +167,237 @@ class SDConfig(object):
         except AttributeError:
             pass
 
+        try:
+            self.REDIS_HOST = _config.REDIS_HOST  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.REDIS_PORT = _config.REDIS_PORT  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.REDIS_MAX_CONNECTIONS = \
+                _config.REDIS_MAX_CONNECTIONS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.WORKER_BACKEND = _config.WORKER_BACKEND  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.WORKER_THREADS = _config.WORKER_THREADS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.WORKER_MAX_QUEUE_SIZE = \
+                _config.WORKER_MAX_QUEUE_SIZE  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.WORKER_ENQUEUE_RETRIES = \
+                _config.WORKER_ENQUEUE_RETRIES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.WORKER_JOB_TIMEOUTS = \
+                _config.WORKER_JOB_TIMEOUTS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SCHEDULER_STATE_DIR = \
+                _config.SCHEDULER_STATE_DIR  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.STORAGE_BACKEND = _config.STORAGE_BACKEND  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_BUCKET = _config.S3_BUCKET  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_PREFIX = _config.S3_PREFIX  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_ENDPOINT_URL = _config.S3_ENDPOINT_URL  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_REGION_NAME = _config.S3_REGION_NAME  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_ACCESS_KEY_ID = _config.S3_ACCESS_KEY_ID  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.S3_SECRET_ACCESS_KEY = \
+                _config.S3_SECRET_ACCESS_KEY  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.STORE_PACK_MAX_SIZE = \
+                _config.STORE_PACK_MAX_SIZE  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.RETENTION_DOWNLOADED_SUBMISSION_DAYS = \
+                _config.RETENTION_DOWNLOADED_SUBMISSION_DAYS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.RETENTION_INACTIVE_SOURCE_DAYS = \
+                _config.RETENTION_INACTIVE_SOURCE_DAYS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.RETENTION_BATCH_SIZE = \
+                _config.RETENTION_BATCH_SIZE  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.RETENTION_AUDIT_LOG = \
+                _config.RETENTION_AUDIT_LOG  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.PENDING_SOURCE_MAX_IDLE_DAYS = \
+                _config.PENDING_SOURCE_MAX_IDLE_DAYS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.UPLOAD_MAX_BYTES = _config.UPLOAD_MAX_BYTES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.UPLOAD_MIN_FREE_BYTES = \
+                _config.UPLOAD_MIN_FREE_BYTES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SOURCE_QUOTA_BYTES = \
+                _config.SOURCE_QUOTA_BYTES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.STORE_QUOTA_BYTES = _config.STORE_QUOTA_BYTES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.UPLOAD_MAX_CONCURRENT = \
+                _config.UPLOAD_MAX_CONCURRENT  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.ASYNC_SUBMISSIONS = _config.ASYNC_SUBMISSIONS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SUBMISSION_SPOOL_DIR = \
+                _config.SUBMISSION_SPOOL_DIR  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SUBMISSION_ENCRYPTION_THREADS = \
+                _config.SUBMISSION_ENCRYPTION_THREADS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.DEDUPLICATE_SUBMISSIONS = \
+                _config.DEDUPLICATE_SUBMISSIONS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.SUBMISSION_DIGEST_KEY = \
+                _config.SUBMISSION_DIGEST_KEY  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.EXPORT_DIR = _config.EXPORT_DIR  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.EXPORT_VOLUME_MAX_BYTES = \
+                _config.EXPORT_VOLUME_MAX_BYTES  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.EXPORT_MAX_AGE_DAYS = \
+                _config.EXPORT_MAX_AGE_DAYS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.REPLIES_PER_PAGE = _config.REPLIES_PER_PAGE  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.REPLY_DECRYPTION_THREADS = \
+                _config.REPLY_DECRYPTION_THREADS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.API_TOKEN_EXPIRATION = \
+                _config.API_TOKEN_EXPIRATION  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.EVENT_STREAM_POLL_SECONDS = \
+                _config.EVENT_STREAM_POLL_SECONDS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.EVENT_STREAM_MAX_SECONDS = \
+                _config.EVENT_STREAM_MAX_SECONDS  # type: ignore
+        except AttributeError:
+            pass
+
+        try:
+            self.TEMPLATE_CACHE_DIR = \
+                _config.TEMPLATE_CACHE_DIR  # type: ignore
+        except AttributeError:
+            pass
+
         try:
             self.env = _config.env  # type: ignore
         except AttributeError:
@@ -1,6 +1,9 @@
+import hashlib
+import hmac
+
 from datetime import datetime, timedelta
 from flask import (Flask, render_template, flash, Markup, request, g, session,
-                   url_for, redirect)
+                   url_for, redirect, make_response)
 from flask_babel import gettext
 from flask_assets import Environment
 from flask_wtf.csrf import CSRFProtect, CSRFError
@@ -8,14 +11,18 @@ from jinja2 import evalcontextfilter
 from os import path
 from sqlalchemy.orm.exc import NoResultFound
 
+import admission
 import i18n
+import spool
+import store
 import template_filters
 import version
 
 from crypto_util import CryptoUtil
 from db import db
 from models import Source
-from request_that_secures_file_uploads import RequestThatSecuresFileUploads
+from request_that_secures_file_uploads import (RequestThatSecuresFileUploads,
+                                               SPOOL_DIR)
 from source_app import main, info, api
 from source_app.decorators import ignore_static
 from source_app.utils import logged_in
@@ -43,7 +50,8 @@ def create_app(config):
     # The default CSRF token expiration is 1 hour. Since large uploads can
     # take longer than an hour over Tor, we increase the valid window to 24h.
     app.config['WTF_CSRF_TIME_LIMIT'] = 60 * 60 * 24
-    CSRFProtect(app)
+    if getattr(config, 'UPLOAD_MAX_BYTES', None):
+        app.config['MAX_CONTENT_LENGTH'] = config.UPLOAD_MAX_BYTES
 
     if config.DATABASE_ENGINE == "sqlite":
         db_uri = (config.DATABASE_ENGINE + ":///" +
@@ -60,9 +68,7 @@ def create_app(config):
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     db.init_app(app)
 
-    app.storage = Storage(config.STORE_DIR,
-                          config.TEMP_DIR,
-                          config.JOURNALIST_KEY)
+    app.storage = Storage.from_config(config)
 
     app.crypto_util = CryptoUtil(
         scrypt_params=config.SCRYPT_PARAMS,
@@ -75,6 +81,18 @@ def create_app(config):
         gpg_key_dir=config.GPG_KEY_DIR,
     )
 
+    app.submission_spool = spool.spool_from_config(config)
+
+    app.submission_digest_key = None
+    if getattr(config, 'DEDUPLICATE_SUBMISSIONS', False):
+        app.submission_digest_key = (
+            getattr(config, 'SUBMISSION_DIGEST_KEY', None) or
+            hmac.new(config.SCRYPT_ID_PEPPER, 'submission digest',
+                     hashlib.sha256).digest())
+
+    app.admission = admission.Admission(
+        config, app.config.get('MAX_CONTENT_LENGTH'), SPOOL_DIR)
+
     @app.errorhandler(CSRFError)
     def handle_csrf_error(e):
         msg = render_template('session_timeout.html')
@@ -89,6 +107,7 @@ def create_app(config):
 
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
+    app.jinja_env.bytecode_cache = template_filters.bytecode_cache(config)
     app.jinja_env.globals['version'] = version.__version__
     if getattr(config, 'CUSTOM_HEADER_IMAGE', None):
         app.jinja_env.globals['header_image'] = \
@@ -163,6 +182,44 @@ def create_app(config):
                 return redirect(url_for('main.index'))
             g.loc = app.storage.path(g.filesystem_id)
 
+    @app.before_request
+    def admit_submission():
+        if request.method == 'POST' and request.endpoint == 'main.submit':
+            app.admission.admit(request.content_length,
+                                getattr(g, 'source', None))
+            if app.submission_spool is not None and logged_in():
+                g.spool_upload = spool_upload
+
+    def spool_upload(filename):
+        digest = None
+        if app.submission_digest_key is not None:
+            digest = store.submission_digest(app.submission_digest_key,
+                                             g.filesystem_id)
+        spool_file = app.submission_spool.open(filename, digest)
+        g.setdefault('spool_files', []).append(spool_file)
+        return spool_file
+
+    @app.teardown_request
+    def release_upload_slot(exception):
+        app.admission.done()
+        # Whatever was spooled of documents that weren't received in full
+        for spool_file in g.pop('spool_files', []):
+            spool_file.close()
+
+    # CSRFProtect checks the token in a before_request hook, which reads the
+    # form and so spools the upload to disk: it is registered after
+    # admit_submission so that a refused submission is never read.
+    CSRFProtect(app)
+
+    @app.errorhandler(admission.UploadRefused)
+    def upload_refused(error):
+        response = make_response(
+            render_template('upload_refused.html', reason=error.reason),
+            error.status)
+        if error.reason == admission.BUSY:
+            response.headers['Retry-After'] = str(admission.RETRY_AFTER)
+        return response
+
     @app.errorhandler(404)
     def page_not_found(error):
         return render_template('notfound.html'), 404
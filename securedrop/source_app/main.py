@@ -1,24 +1,28 @@
-import operator
-import os
-
 from datetime import datetime
 from flask import (Blueprint, render_template, flash, redirect, url_for, g,
                    session, current_app, request, Markup, abort)
-from flask_babel import gettext
+from flask_babel import gettext, ngettext
 from sqlalchemy.exc import IntegrityError
 
+import events
+import spool
+import store
 from db import db
 from models import Source, Submission, Reply, get_one_or_else
-from rm import srm
 from source_app.decorators import login_required
 from source_app.utils import (logged_in, generate_unique_codename,
-                              async_genkey, normalize_timestamps,
-                              valid_codename, get_entropy_estimate)
+                              async_genkey, encrypt_submissions,
+                              decrypt_replies, drop_duplicates,
+                              normalize_timestamps, valid_codename,
+                              get_entropy_estimate)
 from source_app.forms import LoginForm
 
 
 def make_blueprint(config):
     view = Blueprint('main', __name__)
+    encryption_threads = getattr(config, 'SUBMISSION_ENCRYPTION_THREADS', 4)
+    decryption_threads = getattr(config, 'REPLY_DECRYPTION_THREADS', 4)
+    replies_per_page = getattr(config, 'REPLIES_PER_PAGE', 10)
 
     @view.route('/')
     def index():
@@ -58,7 +62,7 @@ def make_blueprint(config):
             del session['codename']
             abort(500)
         else:
-            os.mkdir(current_app.storage.path(filesystem_id))
+            current_app.storage.create_source_dir(filesystem_id)
 
         session['logged_in'] = True
         return redirect(url_for('.lookup'))
@@ -66,28 +70,32 @@ def make_blueprint(config):
     @view.route('/lookup', methods=('GET',))
     @login_required
     def lookup():
+        # Only the newest replies are decrypted, older ones a page at a time
+        page = max(request.args.get('page', 1, type=int), 1)
+        query = Reply.query.filter(Reply.source_id == g.source.id)
+        reply_count = query.count()
+        page_replies = query.order_by(Reply.id.desc()).offset(
+            (page - 1) * replies_per_page).limit(replies_per_page).all()
+        plaintexts = decrypt_replies(
+            g.filesystem_id, g.codename,
+            [reply.filename for reply in page_replies],
+            decryption_threads)
+
         replies = []
-        for reply in g.source.replies:
-            reply_path = current_app.storage.path(
-                g.filesystem_id,
-                reply.filename,
-            )
+        for reply, plaintext in zip(page_replies, plaintexts):
             try:
-                with open(reply_path) as f:
-                    contents = f.read()
-                reply.decrypted = current_app.crypto_util.decrypt(
-                    g.codename,
-                    contents).decode('utf-8')
+                reply.decrypted = plaintext.decode('utf-8')
             except UnicodeDecodeError:
                 current_app.logger.error("Could not decode reply %s" %
                                          reply.filename)
-            else:
+                continue
+            reply.date = reply.created_on
+            if reply.date is None:
+                # Sent before the time was recorded
                 reply.date = datetime.utcfromtimestamp(
-                    os.stat(reply_path).st_mtime)
-                replies.append(reply)
-
-        # Sort the replies by date
-        replies.sort(key=operator.attrgetter('date'), reverse=True)
+                    current_app.storage.stat(g.filesystem_id,
+                                             reply.filename).mtime)
+            replies.append(reply)
 
         # Generate a keypair to encrypt replies from the journalist
         # Only do this if the journalist has flagged the source as one
@@ -104,7 +112,12 @@ def make_blueprint(config):
             'lookup.html',
             codename=g.codename,
             replies=replies,
+            page=page,
+            older_replies=reply_count > page * replies_per_page,
             flagged=g.source.flagged,
+            processing=Submission.query.filter(
+                Submission.source_id == g.source.id,
+                Submission.state == Submission.PROCESSING).count(),
             new_user=session.get('new_user', None),
             haskey=current_app.crypto_util.getkey(
                 g.filesystem_id))
@@ -113,57 +126,106 @@ def make_blueprint(config):
     @login_required
     def submit():
         msg = request.form['msg']
-        fh = request.files['fh']
+        # Several documents can be submitted at once. An empty file field
+        # still sends an unnamed part, which is skipped.
+        fhs = [fh for fh in request.files.getlist('fh') if fh]
 
         # Don't submit anything if it was an "empty" submission. #878
-        if not (msg or fh):
+        if not (msg or fhs):
             flash(gettext(
                 "You must enter a message or choose a file to submit."),
                   "error")
             return redirect(url_for('main.lookup'))
 
-        fnames = []
-        journalist_filename = g.source.journalist_filename
-        first_submission = g.source.interaction_count == 0
-
-        if msg:
-            g.source.interaction_count += 1
-            fnames.append(
-                current_app.storage.save_message_submission(
-                    g.filesystem_id,
-                    g.source.interaction_count,
-                    journalist_filename,
-                    msg))
-        if fh:
-            g.source.interaction_count += 1
-            fnames.append(
-                current_app.storage.save_file_submission(
-                    g.filesystem_id,
-                    g.source.interaction_count,
-                    journalist_filename,
-                    fh.filename,
-                    fh.stream))
+        # The (filename, digest) of the message and documents stored, and
+        # the (count, filename, `spool.Spooled`, digest) of those spooled
+        stored = []
+        spooled = []
+        # A number for the message and one for each document, reserved at
+        # once so concurrent submissions and replies don't get the same ones
+        counts = g.source.allocate_interactions(int(bool(msg)) + len(fhs))
+        first_submission = counts[0] == 1
+        doc_counts = counts[1:] if msg else counts
+
+        if current_app.submission_spool is None:
+            # Documents are digested as they are read, so that one the
+            # source already submitted is recognized (see
+            # `DEDUPLICATE_SUBMISSIONS`)
+            digests = [None] * len(fhs)
+            streams = [fh.stream for fh in fhs]
+            if current_app.submission_digest_key is not None:
+                digests = [store.submission_digest(
+                    current_app.submission_digest_key, g.filesystem_id)
+                    for fh in fhs]
+                streams = [store.DigestingStream(stream, digest)
+                           for stream, digest in zip(streams, digests)]
+            fnames = encrypt_submissions(
+                g.filesystem_id,
+                (counts[0], msg) if msg else None,
+                [(count, fh.filename, stream)
+                 for count, fh, stream in zip(doc_counts, fhs, streams)],
+                encryption_threads)
+            stored = zip(fnames, ([None] if msg else []) +
+                         [_hexdigest(digest) for digest in digests])
+        else:
+            if msg:
+                stored.append(
+                    (current_app.storage.save_message_submission(
+                        g.filesystem_id,
+                        counts[0],
+                        msg), None))
+            # Compressed, encrypted and digested as they were received,
+            # stored by the worker, see `spool`
+            for count, fh in zip(doc_counts, fhs):
+                spooled.append((count, fh.filename, fh.stream.finish(),
+                                _hexdigest(fh.stream.digest)))
+
+        stored, spooled, duplicates = drop_duplicates(g.source, stored,
+                                                      spooled)
 
         if first_submission:
             msg = render_template('first_submission_flashed_message.html')
             flash(Markup(msg), "success")
 
         else:
-            if msg and not fh:
+            if msg and not fhs:
                 html_contents = gettext('Thanks! We received your message.')
-            elif not msg and fh:
+            elif not msg and len(fhs) == 1:
                 html_contents = gettext('Thanks! We received your document.')
-            else:
+            elif not msg:
+                html_contents = gettext('Thanks! We received your documents.')
+            elif len(fhs) == 1:
                 html_contents = gettext('Thanks! We received your message and '
                                         'document.')
+            else:
+                html_contents = gettext('Thanks! We received your message and '
+                                        'documents.')
 
             msg = render_template('next_submission_flashed_message.html',
                                   html_contents=html_contents)
             flash(Markup(msg), "success")
 
-        for fname in fnames:
+        if duplicates:
+            flash(ngettext(
+                'You had already submitted this document, so it was not '
+                'stored again.',
+                'You had already submitted {num} of these documents, so they '
+                'were not stored again.',
+                duplicates).format(num=duplicates), "notification")
+
+        for fname, digest in stored:
             submission = Submission(g.source, fname)
+            submission.digest = digest
             db.session.add(submission)
+        processing = []
+        for count, filename, spooled_file, digest in spooled:
+            submission = Submission(g.source,
+                                    store.stored_filename(count, 'doc.gz'),
+                                    size=spooled_file.size)
+            submission.state = Submission.PROCESSING
+            submission.digest = digest
+            db.session.add(submission)
+            processing.append((submission, spooled_file))
 
         if g.source.pending:
             g.source.pending = False
@@ -187,6 +249,9 @@ def make_blueprint(config):
 
         g.source.last_updated = datetime.utcnow()
         db.session.commit()
+        events.publish()
+        for submission, spooled_file in processing:
+            spool.enqueue_storage(submission, spooled_file)
         normalize_timestamps(g.filesystem_id)
 
         return redirect(url_for('main.lookup'))
@@ -195,11 +260,12 @@ def make_blueprint(config):
     @login_required
     def delete():
         query = Reply.query.filter(
+            Reply.source_id == g.source.id,
             Reply.filename == request.form['reply_filename'])
         reply = get_one_or_else(query, current_app.logger, abort)
-        srm(current_app.storage.path(g.filesystem_id, reply.filename))
         db.session.delete(reply)
         db.session.commit()
+        current_app.storage.secure_delete([(g.filesystem_id, reply.filename)])
 
         flash(gettext("Reply deleted"), "notification")
         return redirect(url_for('.lookup'))
@@ -213,10 +279,12 @@ def make_blueprint(config):
                                      "expected")
             return redirect(url_for('.lookup'))
 
+        items = []
         for reply in replies:
-            srm(current_app.storage.path(g.filesystem_id, reply.filename))
+            items.append((g.filesystem_id, reply.filename))
             db.session.delete(reply)
         db.session.commit()
+        current_app.storage.secure_delete(items)
 
         flash(gettext("All replies have been deleted"), "notification")
         return redirect(url_for('.lookup'))
@@ -251,3 +319,7 @@ def make_blueprint(config):
         return redirect(url_for('.index'))
 
     return view
+
+
+def _hexdigest(digest):
+    return digest.hexdigest() if digest is not None else None
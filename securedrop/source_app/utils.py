@@ -1,16 +1,20 @@
 import logging
 import subprocess
 
+from contextlib import closing
 from datetime import datetime
 from flask import session, current_app, abort, g
-from sqlalchemy import create_engine
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import create_engine, or_
 from sqlalchemy.orm import sessionmaker
 from threading import Thread
 
 import i18n
 
 from crypto_util import CryptoException
-from models import Source
+from db import db
+from models import Source, Submission
 
 
 def logged_in():
@@ -94,16 +98,115 @@ def async_genkey(crypto_util_, db_uri, filesystem_id, codename):
     session.close()
 
 
-def normalize_timestamps(filesystem_id):
+def encrypt_submissions(filesystem_id, message, files, threads):
+    """Encrypt and store the `message`, a `(count, text)` pair or `None`, and
+    the `files`, as `(count, filename, stream)`, concurrently on up to
+    `threads` threads. Returns their stored filenames, in order."""
+    app = current_app._get_current_object()
+    jobs = []
+    if message is not None:
+        jobs.append(partial(app.storage.save_message_submission,
+                            filesystem_id, *message))
+    for count, filename, stream in files:
+        jobs.append(partial(app.storage.save_file_submission,
+                            filesystem_id, count, filename, stream))
+    return _run_concurrently(jobs, threads)
+
+
+def decrypt_replies(filesystem_id, codename, filenames, threads):
+    """Decrypt the replies `filenames` of the source `filesystem_id` with its
+    `codename`, concurrently on up to `threads` threads. Each is streamed
+    from storage to gpg, and the passphrase of the source's key is only
+    derived once. Returns their plaintexts, in order."""
+    app = current_app._get_current_object()
+    passphrase = app.crypto_util.reply_passphrase(codename)
+
+    def decrypt(filename):
+        with closing(app.storage.get(filesystem_id, filename)) as f:
+            return app.crypto_util.decrypt(codename, f,
+                                           passphrase=passphrase)
+
+    return _run_concurrently([partial(decrypt, filename)
+                              for filename in filenames], threads)
+
+
+def _run_concurrently(jobs, threads):
+    """Call each of `jobs` in an application context, on up to `threads`
+    threads. Returns their results, in order."""
+    if len(jobs) <= 1:
+        return [job() for job in jobs]
+    app = current_app._get_current_object()
+
+    def run(job):
+        with app.app_context():
+            return job()
+
+    pool = ThreadPool(min(threads, len(jobs)))
+    try:
+        return pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def drop_duplicates(source, stored, spooled):
+    """Drop the documents of a new submission that `source` had already
+    submitted, recognized by their digest: the files in `stored`, which are
+    `(filename, digest)` pairs, are securely deleted, and the uploads in
+    `spooled`, `(count, filename, spool.Spooled, digest)`, discarded.
+    Returns what's left of both, and how many documents were dropped."""
+    seen = set(digest for (digest,) in db.session.query(
+        Submission.digest).filter(
+            Submission.source_id == source.id,
+            Submission.digest.isnot(None),
+            # The source may well try again after it failed
+            or_(Submission.state.is_(None),
+                Submission.state != Submission.FAILED)))
+
+    def duplicate(digest):
+        if digest is None:
+            return False
+        elif digest in seen:
+            return True
+        seen.add(digest)
+        return False
+
+    kept_stored, kept_spooled, deleted = [], [], []
+    for filename, digest in stored:
+        if duplicate(digest):
+            deleted.append((source.filesystem_id, filename))
+        else:
+            kept_stored.append((filename, digest))
+    discarded = 0
+    for item in spooled:
+        if duplicate(item[3]):
+            current_app.submission_spool.discard(item[2])
+            discarded += 1
+        else:
+            kept_spooled.append(item)
+    if deleted:
+        current_app.storage.secure_delete(deleted)
+    return kept_stored, kept_spooled, len(deleted) + discarded
+
+
+def normalize_timestamps(filesystem_id, submissions=None):
     """
     Update the timestamps on all of the source's submissions to match that of
     the latest submission. This minimizes metadata that could be useful to
     investigators. See #301.
+
+    The submissions default to those of the logged in source.
     """
+    if not current_app.storage.backend.is_local:
+        # Object stores set the modification time themselves
+        return
+    if submissions is None:
+        submissions = g.source.submissions
     sub_paths = [current_app.storage.path(filesystem_id, submission.filename)
-                 for submission in g.source.submissions]
+                 for submission in submissions]
     if len(sub_paths) > 1:
-        args = ["touch"]
+        # Packed submissions have no file of their own, don't create one
+        args = ["touch", "-c"]
         args.extend(sub_paths[:-1])
         rc = subprocess.call(args)
         if rc != 0:
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Asynchronous file submissions, enabled with `ASYNC_SUBMISSIONS`.
+
+Compressing and encrypting a large document takes a while, and over Tor the
+source's circuit often times out waiting for it, even though the document
+was received. So instead each document of a submission is compressed and
+encrypted to the journalist key as it's received, by a :class:`SpoolFile`
+in `SUBMISSION_SPOOL_DIR` (see `RequestThatSecuresFileUploads`), which
+keeps up with the upload. The source interface records the submission as
+`Submission.PROCESSING` and returns, and :func:`store_submission` moves the
+encrypted document to the store in the worker.
+
+The spool only ever holds documents encrypted to the journalist key, like
+the store, so the job doesn't need any secret. Once stored the spool file is
+removed. Spool files whose job was lost are removed by the worker's
+scheduler after `SPOOL_MAX_AGE`, and their submission marked as
+`Submission.FAILED` when the job does run.
+"""
+import collections
+import errno
+import fcntl
+import gzip
+import logging
+import os
+import re
+import threading
+
+from base64 import urlsafe_b64encode
+from flask import current_app, has_app_context
+from werkzeug.utils import secure_filename
+
+import events
+import worker
+from crypto_util import CryptoException
+from db import db
+from models import Submission
+
+log = logging.getLogger(__name__)
+
+# Spool files left for longer than this were abandoned: the worker has been
+# down for that long, or lost their job
+SPOOL_MAX_AGE = 7 * 24 * 60 * 60
+
+# Name of the files in the spool, see `SpoolFile`
+SPOOL_FILENAME = re.compile(r'^[A-Za-z0-9_-]{43}\.gpg$').match
+
+Spooled = collections.namedtuple('Spooled', ['path', 'size'])
+
+
+class SubmissionSpool(object):
+
+    """The spool in `directory`, whose documents are encrypted to the
+    journalist key `fingerprint`."""
+
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self.fingerprint = fingerprint
+
+    def open(self, filename, digest=None):
+        """Return a new :class:`SpoolFile` for the document `filename`,
+        updating `digest` with what's written to it."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return SpoolFile(self.directory, self.fingerprint, filename, digest)
+
+    def discard(self, spooled):
+        """Remove a spool file that won't be stored after all."""
+        _remove(spooled.path)
+
+
+class SpoolFile(object):
+
+    """File-like object the document `filename` is written to. It's
+    compressed with its name, like `Storage.save_file_submission` does, and
+    piped to gpg, which encrypts it to `fingerprint` into a new file of
+    `directory`.
+
+    Werkzeug seeks back to the start of an upload once it's received, which
+    :meth:`finish`-es it. Closing it before then removes what was spooled.
+    """
+
+    def __init__(self, directory, fingerprint, filename, digest=None):
+        self.path = os.path.join(directory, '{}.gpg'.format(
+            urlsafe_b64encode(os.urandom(32)).rstrip('=')))
+        self.digest = digest
+        self.spooled = None  # type: Spooled
+        self.__crypto_util = current_app.crypto_util
+        self.__fingerprint = fingerprint
+        self.__result = None
+
+        read_fd, write_fd = os.pipe()
+        # Keep the other gpg processes from inheriting the pipe: the end of
+        # the document is only seen once every writer closed it
+        for fd in (read_fd, write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.__thread = threading.Thread(
+            target=self.__encrypt, args=(os.fdopen(read_fd, 'rb'),))
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.__pipe = os.fdopen(write_fd, 'wb')
+        self.__gzip = gzip.GzipFile(filename=secure_filename(filename),
+                                    mode='wb', fileobj=self.__pipe)
+
+    def write(self, data):
+        if self.digest is not None:
+            self.digest.update(data)
+        try:
+            self.__gzip.write(data)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # gpg gave up
+            self.close()
+            raise self.__error()
+
+    def seek(self, offset, whence=0):
+        self.finish()
+
+    def finish(self):
+        """Wait for the document to be encrypted, and return it as a
+        :class:`Spooled`. Raises `CryptoException` if it couldn't be."""
+        if self.spooled is None:
+            try:
+                self.__gzip.close()
+            finally:
+                self.__pipe.close()
+                self.__thread.join()
+            if self.__result is None or not self.__result.ok:
+                _remove(self.path)
+                raise self.__error()
+            self.spooled = Spooled(self.path, os.path.getsize(self.path))
+        return self.spooled
+
+    def close(self):
+        if self.spooled is not None or self.__pipe.closed:
+            return
+        # Received only in part
+        try:
+            self.__pipe.close()
+        except IOError:
+            pass
+        self.__thread.join()
+        _remove(self.path)
+
+    def __error(self):
+        return CryptoException(getattr(self.__result, 'stderr',
+                                       'Encrypting {} failed'.format(
+                                           self.path)))
+
+    def __encrypt(self, plaintext):
+        try:
+            self.__result = self.__crypto_util.gpg.encrypt(
+                plaintext, self.__fingerprint, output=self.path,
+                always_trust=True, armor=False)
+        except Exception:
+            log.exception('Encrypting {} failed'.format(self.path))
+        finally:
+            # Lets a writer that's still going fail rather than block
+            plaintext.close()
+
+
+def enqueue_storage(submission, spooled):
+    """Enqueue the job storing the `spooled` document as the `submission`,
+    which has to be committed already."""
+    return worker.enqueue(store_submission, submission.id, spooled.path)
+
+
+def store_submission(submission_id, path):
+    """Worker job storing the spooled document `path` as the submission
+    `submission_id`."""
+    if has_app_context():
+        return _store_submission(submission_id, path)
+    with worker.job_app().app_context():
+        return _store_submission(submission_id, path)
+
+
+def _store_submission(submission_id, path):
+    # Imported here because importing `source_app` imports this module
+    from source_app.utils import normalize_timestamps
+
+    submission = Submission.query.get(submission_id)
+    if submission is None:
+        # Deleted while it was waiting, with its source or on its own
+        _remove(path)
+        return
+    source = submission.source
+    try:
+        with open(path, 'rb') as f:
+            current_app.storage.put(source.filesystem_id,
+                                    submission.filename, f)
+    except Exception:
+        log.exception('Storing submission {} failed'.format(submission_id))
+        submission.state = Submission.FAILED
+        db.session.commit()
+        raise
+    _remove(path)
+    submission.size = current_app.storage.stat(source.filesystem_id,
+                                               submission.filename).size
+    submission.state = None
+    db.session.commit()
+    events.publish()
+    normalize_timestamps(source.filesystem_id, source.submissions)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def spool_dir(config):
+    return getattr(config, 'SUBMISSION_SPOOL_DIR',
+                   os.path.join(config.SECUREDROP_DATA_ROOT, 'spool'))
+
+
+def spool_from_config(config):
+    """Return the :class:`SubmissionSpool` to use, or `None` if submissions
+    are encrypted once received."""
+    if not getattr(config, 'ASYNC_SUBMISSIONS', False):
+        return None
+    return SubmissionSpool(spool_dir(config), config.JOURNALIST_KEY)
@@ -32,9 +32,70 @@ String.prototype.supplant = function (o) {
     );
 };
 
+// Poll the progress of a deletion job until the worker has finished it
+function poll_deletion_progress(notification) {
+  var text = notification.find(".deletion-progress-text");
+  $.getJSON(notification.attr("data-progress-url"))
+    .done(function(progress) {
+      if (progress.status == "finished") {
+        text.text(get_string("deletion-finished-string"));
+      } else if (progress.status == "failed") {
+        text.text(get_string("deletion-failed-string"));
+      } else {
+        text.text(get_string("deletion-progress-string").supplant(progress));
+        setTimeout(function() { poll_deletion_progress(notification); }, 2000);
+      }
+    })
+    .fail(function() {
+      notification.remove();
+    });
+}
+
+// Keep the sources list up to date as sources change, from the server-sent
+// events of the page's stream, rather than have journalists reload it
+function stream_source_events(url, on_update) {
+  var events = new EventSource(url);
+
+  events.addEventListener("source", function(event) {
+    var data = JSON.parse(event.data);
+    var list = $(data.starred ? "ul#cols.starred" : "ul#cols.unstarred");
+    if (!list.length) {
+      // The list this source goes into isn't on the page yet
+      events.close();
+      location.reload();
+      return;
+    }
+    var old = $('ul#cols li[data-source-id="' + data.id + '"]');
+    var row = $(data.row);
+    row.find(":checkbox").prop("checked", old.find(":checkbox").prop("checked"));
+    old.remove();
+
+    // The list is sorted by last update, most recent first
+    var updated = row.find("time").attr("datetime");
+    var next = list.children("li").filter(function() {
+      return $(this).find("time").attr("datetime") <= updated;
+    }).first();
+    if (next.length) {
+      next.before(row);
+    } else {
+      list.append(row);
+    }
+    on_update();
+  });
+
+  events.addEventListener("source-deleted", function(event) {
+    var data = JSON.parse(event.data);
+    $('ul#cols li[data-source-id="' + data.id + '"]').remove();
+  });
+}
+
 $(function () {
   enhance_ui();
 
+  $(".deletion-progress").each(function() {
+    poll_deletion_progress($(this));
+  });
+
   var all = $("#select_all");
   var none = $("#select_none");
   var unread = $("#select_unread");
@@ -82,6 +143,13 @@ $(function () {
     filter_codenames($('#filter').val())
   }
 
+  var events_url = $("div#content").attr("data-events-url");
+  if (events_url && window.EventSource) {
+    stream_source_events(events_url, function() {
+      filter_codenames($('#filter').val() || "")
+    });
+  }
+
   // Confirm before deleting user on admin page
   $('button.delete-user').click(function(event) {
       var username = $(this).attr('data-username');
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Report how much space the store, the database, the keyring and the
+temporary directory take, see `./manage.py stats`.
+
+The store is walked by a pool of threads, a chunk of source directories at
+a time, while the sizes recorded in the database are summed up by SQL
+aggregates, so that a store with hundreds of thousands of files is reported
+on in seconds.
+"""
+import datetime
+import heapq
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import func
+
+import store
+from db import db
+from models import Reply, Source, Submission
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Any, Dict, List, Tuple  # noqa: F401
+
+DEFAULT_TOP = 10
+DEFAULT_JOBS = 4
+
+# Upper bounds of the buckets of the age histograms, in days, with their
+# labels. Anything older falls in `OLDEST_BUCKET`.
+AGE_BUCKETS = [(1, '<1d'), (7, '<7d'), (30, '<30d'), (90, '<90d'),
+               (365, '<365d')]
+OLDEST_BUCKET = '>=365d'
+
+# How many source directories the threads of the pool scan at a time
+SCAN_CHUNK_SIZE = 64
+
+
+def report(storage, config, crypto_util=None, top=DEFAULT_TOP,
+           jobs=DEFAULT_JOBS, now=None):
+    """Return the capacity report, as a dict that can be dumped as JSON.
+    Needs an application context.
+
+    Keys are only counted if `crypto_util` is given, since listing a large
+    keyring takes a while. The store is only walked with the posix storage
+    backend; with others, sources are ranked by the sizes in the database.
+    """
+    started = time.time()
+    now = now or started
+    sources = _sources(now)
+    result = {
+        'generated_at': datetime.datetime.utcfromtimestamp(now).isoformat(),
+        'database': _database_usage(sources),
+        'store': None,
+        'keyring': _tree_usage(config.GPG_KEY_DIR, now),
+        'temp': _tree_usage(config.TEMP_DIR, now),
+    }
+
+    if storage.backend.is_local:
+        result['store'] = _store_usage(storage, sources, jobs, now)
+    if crypto_util is not None:
+        result['keyring']['keys'] = len(crypto_util.gpg.list_keys())
+
+    ranking = 'disk_bytes' if storage.backend.is_local else 'bytes'
+    result['top_sources'] = heapq.nlargest(
+        top, sources.values(), key=lambda source: source[ranking])
+    result['elapsed_seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def _sources(now):
+    """Return a dict describing each source, by filesystem id, with the
+    number and size of their submissions and replies."""
+    usage = {}  # type: Dict[int, Dict[str, Dict[str, int]]]
+    for kind, model in (('submissions', Submission), ('replies', Reply)):
+        query = db.session.query(
+            model.source_id, func.count(model.id),
+            func.coalesce(func.sum(model.size), 0)).group_by(model.source_id)
+        for source_id, count, size in query:
+            usage.setdefault(source_id, {})[kind] = {'count': count,
+                                                     'bytes': int(size)}
+
+    sources = {}  # type: Dict[str, Dict[str, Any]]
+    query = db.session.query(Source.id, Source.filesystem_id,
+                             Source.journalist_designation,
+                             Source.last_updated)
+    for source_id, filesystem_id, designation, last_updated in query:
+        source_usage = usage.get(source_id, {})
+        submissions = source_usage.get('submissions', _usage())
+        replies = source_usage.get('replies', _usage())
+        sources[filesystem_id] = {
+            'filesystem_id': filesystem_id,
+            'journalist_designation': designation,
+            'last_updated': (last_updated.isoformat() if last_updated
+                             else None),
+            'age_days': (_age(_timestamp(last_updated), now) if last_updated
+                         else None),
+            'submissions': submissions,
+            'replies': replies,
+            'bytes': submissions['bytes'] + replies['bytes'],
+            'disk_files': 0,
+            'disk_bytes': 0,
+        }
+    return sources
+
+
+def _database_usage(sources):
+    kinds = {'messages': _usage(), 'documents': _usage()}
+    query = db.session.query(
+        Submission.filename.like('%msg.gpg'), func.count(Submission.id),
+        func.coalesce(func.sum(Submission.size), 0)).group_by(
+            Submission.filename.like('%msg.gpg'))
+    for is_message, count, size in query:
+        kinds['messages' if is_message else 'documents'] = {
+            'count': count, 'bytes': int(size)}
+
+    replies = _usage()
+    by_activity = _histogram()
+    for source in sources.values():
+        replies['count'] += source['replies']['count']
+        replies['bytes'] += source['replies']['bytes']
+        if source['age_days'] is not None:
+            _add(by_activity, source['age_days'], source['bytes'])
+    return {'sources': len(sources),
+            'messages': kinds['messages'],
+            'documents': kinds['documents'],
+            'replies': replies,
+            'sources_by_last_activity': by_activity}
+
+
+def _store_usage(storage, sources, jobs, now):
+    usage = {'sources': 0, 'orphaned_sources': 0, 'files': 0, 'bytes': 0,
+             'files_by_age': _histogram()}
+    pool = ThreadPool(jobs)
+    try:
+        for filesystem_id, files in pool.imap_unordered(
+                _scan, storage.source_dirs(), SCAN_CHUNK_SIZE):
+            usage['sources'] += 1
+            source_bytes = 0
+            for size, mtime in files:
+                source_bytes += size
+                _add(usage['files_by_age'], _age(mtime, now), size)
+            usage['files'] += len(files)
+            usage['bytes'] += source_bytes
+            source = sources.get(filesystem_id)
+            if source is None:
+                usage['orphaned_sources'] += 1
+                continue
+            source['disk_files'] += len(files)
+            source['disk_bytes'] += source_bytes
+    finally:
+        pool.close()
+        pool.join()
+    return usage
+
+
+def _scan(source_dir):
+    # type: (Tuple[str, str]) -> Tuple[str, List[Tuple[int, float]]]
+    filesystem_id, path = source_dir
+    return filesystem_id, [(size, mtime) for _, size, mtime in
+                           store.list_files(path)]
+
+
+def _tree_usage(top, now):
+    """Return the number, total size and age of the oldest of the files
+    under the directory `top`."""
+    usage = {'files': 0, 'bytes': 0, 'oldest_days': None}
+    oldest = None
+    for dirpath, _, _ in os.walk(top):
+        for _, size, mtime in store.list_files(dirpath):
+            usage['files'] += 1
+            usage['bytes'] += size
+            oldest = mtime if oldest is None else min(oldest, mtime)
+    if oldest is not None:
+        usage['oldest_days'] = _age(oldest, now)
+    return usage
+
+
+def _usage():
+    return {'count': 0, 'bytes': 0}
+
+
+def _histogram():
+    return dict((label, _usage())
+                for label in [label for _, label in AGE_BUCKETS] +
+                [OLDEST_BUCKET])
+
+
+def _add(histogram, age_days, size):
+    for days, label in AGE_BUCKETS:
+        if age_days < days:
+            break
+    else:
+        label = OLDEST_BUCKET
+    histogram[label]['count'] += 1
+    histogram[label]['bytes'] += size
+
+
+def _age(timestamp, now):
+    return round(max(now - timestamp, 0) / (24 * 3600.0), 2)
+
+
+def _timestamp(dt):
+    # Timestamps in the database are naive UTC
+    return (dt - datetime.datetime(1970, 1, 1)).total_seconds()
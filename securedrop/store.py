@@ -1,21 +1,128 @@
 # -*- coding: utf-8 -*-
+import errno
 import gzip
+import hashlib
+import hmac
 import os
 import re
+import stat
 import tempfile
 import zipfile
 
+from contextlib import contextmanager
+from cStringIO import StringIO
 from flask import current_app
 from werkzeug.utils import secure_filename
 
+import store_backends
+import store_pack
 from secure_tempfile import SecureTemporaryFile
 
+try:
+    from os import scandir  # type: ignore
+except ImportError:
+    try:
+        # The backport is faster than listdir and stat, but not required
+        from scandir import scandir  # type: ignore
+    except ImportError:
+        scandir = None
+
 
 VALIDATE_FILENAME = re.compile(
     "^(?P<index>\d+)\-[a-z0-9-_]*"
     "(?P<file_type>msg|doc\.(gz|zip)|reply)\.gpg$").match
 
 
+def stored_filename(index, file_type):
+    """Return the name a submission or reply is stored under, e.g.
+    `1-msg.gpg`. It doesn't include the source's journalist designation, so
+    that giving a source a new designation doesn't rename any files."""
+    return "{0}-{1}.gpg".format(index, file_type)
+
+
+def display_filename(filename, journalist_filename):
+    """Return the name the stored file `filename` is shown and archived
+    under, e.g. `1-impartial_sugar-msg.gpg`. Files stored under the old
+    naming scheme, which included the designation at the time, get the
+    current one."""
+    match = VALIDATE_FILENAME(filename)
+    if not match:
+        return filename
+    return "{0}-{1}-{2}.gpg".format(match.group('index'), journalist_filename,
+                                    match.group('file_type'))
+
+
+def archive_name(submission, zip_directory=''):
+    """Return the path `submission` is archived under in bulk downloads, in
+    a folder per source within `zip_directory` (see #383), unless that
+    already is the source's."""
+    document_number = submission.filename.split('-')[0]
+    if zip_directory == submission.source.journalist_filename:
+        fname = zip_directory
+    else:
+        fname = os.path.join(zip_directory,
+                             submission.source.journalist_designation)
+    return os.path.join(fname,
+                        "%s_%s" % (document_number,
+                                   submission.source.last_updated.date()),
+                        submission.display_filename)
+
+
+def submission_digest(key, filesystem_id):
+    """Return a new HMAC-SHA256 for the digest of a document submitted by
+    the source `filesystem_id`. It's keyed with `key` and the source, so a
+    digest can't be compared with those of other sources, nor computed
+    without the server's key."""
+    source_key = hmac.new(key, filesystem_id, hashlib.sha256).digest()
+    return hmac.new(source_key, digestmod=hashlib.sha256)
+
+
+class DigestingStream(object):
+
+    """File-like object reading `stream`, and updating `digest` with what
+    it reads."""
+
+    def __init__(self, stream, digest):
+        self.stream = stream
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        return data
+
+
+SHARD = re.compile(r'^[0-9a-f]{2}$').match
+
+
+def shard(filesystem_id):
+    """Return the two directories a source's directory is nested in, e.g.
+    `('ab', 'cd')` for `STORE_DIR/ab/cd/<filesystem_id>`.
+
+    With one directory per source directly under `STORE_DIR`, listing or
+    looking up entries in it gets slow once there are many sources. Hashing
+    the id spreads sources evenly over 65536 directories.
+    """
+    digest = hashlib.sha256(filesystem_id.encode('utf-8')).hexdigest()
+    return digest[0:2], digest[2:4]
+
+
+def list_files(path):
+    """Yield the name, size and modification time of the regular files in
+    the directory `path`, with as few system calls as the Python version
+    allows."""
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                yield entry.name, st.st_size, st.st_mtime
+        return
+    for filename in os.listdir(path):
+        st = os.lstat(os.path.join(path, filename))
+        if stat.S_ISREG(st.st_mode):
+            yield filename, st.st_size, st.st_mtime
+
+
 class PathException(Exception):
 
     """An exception raised by `util.verify` when it encounters a bad path. A path
@@ -26,7 +133,7 @@ class PathException(Exception):
 
 class Storage:
 
-    def __init__(self, storage_path, temp_dir, gpg_key):
+    def __init__(self, storage_path, temp_dir, gpg_key, backend=None):
         if not os.path.isabs(storage_path):
             raise PathException("storage_path {} is not absolute".format(
                 storage_path))
@@ -39,6 +146,92 @@ class Storage:
 
         self.__gpg_key = gpg_key
 
+        # Where the files live, see `store_backends`
+        self.backend = backend or store_backends.PosixBackend(self)
+
+    @classmethod
+    def from_config(cls, config):
+        storage = cls(config.STORE_DIR, config.TEMP_DIR, config.JOURNALIST_KEY)
+        storage.backend = store_backends.backend_from_config(config, storage)
+        return storage
+
+    def put(self, filesystem_id, filename, stream):
+        """Store the contents of the file-like `stream` as `filename` of the
+        source `filesystem_id`."""
+        self.backend.put(filesystem_id, filename, stream)
+
+    def get(self, filesystem_id, filename):
+        """Return a file-like object to read `filename` of the source
+        `filesystem_id` from. The caller has to close it."""
+        return self.backend.get(filesystem_id, filename)
+
+    def stat(self, filesystem_id, filename):
+        """Return the `store_backends.StoredFile` describing `filename` of
+        the source `filesystem_id`. Raises `OSError` if there is no such
+        file."""
+        return self.backend.stat(filesystem_id, filename)
+
+    def delete(self, filesystem_id, filename):
+        """Delete `filename` of the source `filesystem_id` right away, without
+        shredding it."""
+        self.backend.delete(filesystem_id, filename)
+
+    def list(self, filesystem_id):
+        """Return the `store_backends.StoredFile`s of the source
+        `filesystem_id`."""
+        return self.backend.list(filesystem_id)
+
+    def secure_delete(self, items):
+        """Enqueue a single worker job securely deleting `items`, which are
+        `(filesystem_id, filename)` tuples, or `(filesystem_id,)` for all of
+        a source's files. Returns the job."""
+        return self.backend.secure_delete(items)
+
+    @contextmanager
+    def output_path(self, filesystem_id, filename):
+        """Yield a local path to write `filename` of the source
+        `filesystem_id` to, e.g. with `CryptoUtil.encrypt`. It's stored once
+        the block exits."""
+        path = self.path(filesystem_id, filename)
+        if self.backend.is_local:
+            yield path
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        try:
+            yield path
+            with open(path, 'rb') as f:
+                self.backend.put(filesystem_id, filename, f)
+        finally:
+            # Only ciphertext is staged here, so it doesn't need shredding
+            if os.path.exists(path):
+                os.remove(path)
+
+    @contextmanager
+    def local_copy(self, filesystem_id, filename):
+        """Yield a local path `filename` of the source `filesystem_id` can be
+        read from, copying it from the backend if needed."""
+        path = self.path(filesystem_id, filename)
+        if self.backend.is_local and os.path.exists(path):
+            yield path
+            return
+        copy = tempfile.NamedTemporaryFile(dir=self.__temp_dir, delete=False)
+        try:
+            source = self.backend.get(filesystem_id, filename)
+            try:
+                while True:
+                    chunk = source.read(store_backends.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    copy.write(chunk)
+            finally:
+                source.close()
+            copy.close()
+            yield copy.name
+        finally:
+            copy.close()
+            os.remove(copy.name)
+
     def verify(self, p):
         """Assert that the path is absolute, normalized, inside
            `self.__storage_path`, and matches the filename format.
@@ -53,13 +246,20 @@ class Storage:
             raise PathException("The path is not absolute and/or normalized")
 
         # Check that the path p is in self.__storage_path
-        if os.path.relpath(p, self.__storage_path).startswith('..'):
+        relpath = os.path.relpath(p, self.__storage_path)
+        if relpath.startswith('..'):
             raise PathException("Invalid directory %s" % (p, ))
 
+        # Sharded source directories must be in the shard of their id
+        parts = relpath.split(os.sep)
+        if len(parts) >= 3 and SHARD(parts[0]) and SHARD(parts[1]):
+            if shard(parts[2]) != (parts[0], parts[1]):
+                raise PathException("Invalid directory %s" % (p, ))
+
         if os.path.isfile(p):
             filename = os.path.basename(p)
             ext = os.path.splitext(filename)[-1]
-            if filename == '_FLAG':
+            if filename in ('_FLAG', store_pack.PACK_FILENAME):
                 return True
             if ext != '.gpg':
                 # if there's an extension, verify it's a GPG
@@ -69,13 +269,107 @@ class Storage:
 
     def path(self, *s):
         """Get the normalized, absolute file path, within
-           `self.__storage_path`.
+           `self.__storage_path`. The first component is the filesystem id of
+           a source, and is resolved to that source's directory.
         """
+        if s:
+            s = (self.source_dir(s[0]),) + s[1:]
         joined = os.path.join(os.path.abspath(self.__storage_path), *s)
         absolute = os.path.abspath(joined)
         self.verify(absolute)
         return absolute
 
+    def source_dir(self, filesystem_id):
+        """Return the directory of the source `filesystem_id`.
+
+        Sources live in sharded directories (see `shard`), but stores created
+        before sharding keep them directly under `self.__storage_path` until
+        `./manage.py migrate-store` moves them, so both layouts are looked
+        up. New sources get a sharded directory.
+        """
+        if (os.sep in filesystem_id or
+                filesystem_id in ('', os.curdir, os.pardir)):
+            raise PathException("Invalid filesystem id %s" % (filesystem_id,))
+        storage_path = os.path.abspath(self.__storage_path)
+        sharded = os.path.join(storage_path, os.path.join(*shard(
+            filesystem_id)), filesystem_id)
+        if os.path.isdir(sharded):
+            return sharded
+        legacy = os.path.join(storage_path, filesystem_id)
+        if os.path.isdir(legacy):
+            return legacy
+        return sharded
+
+    def create_source_dir(self, filesystem_id):
+        """Create the directory of the source `filesystem_id`, and the shard
+        directories it is in if needed."""
+        path = self.path(filesystem_id)
+        os.makedirs(path)
+        return path
+
+    def legacy_source_dirs(self):
+        """Yield the filesystem ids of the sources whose directory is still
+        directly under `self.__storage_path`."""
+        for name in os.listdir(self.__storage_path):
+            if SHARD(name):
+                continue
+            if os.path.isdir(os.path.join(self.__storage_path, name)):
+                yield name
+
+    def source_dirs(self):
+        """Yield the `(filesystem_id, path)` of every source directory, in
+        either layout. A directory found in the wrong shard, or shadowed by
+        another directory of the same source, is yielded too, so compare
+        `path` with :meth:`source_dir` to tell."""
+        storage_path = os.path.abspath(self.__storage_path)
+        for name in sorted(os.listdir(storage_path)):
+            path = os.path.join(storage_path, name)
+            if not os.path.isdir(path):
+                continue
+            if not SHARD(name):
+                yield name, path
+                continue
+            for name2 in sorted(os.listdir(path)):
+                path2 = os.path.join(path, name2)
+                if not SHARD(name2) or not os.path.isdir(path2):
+                    continue
+                for filesystem_id in sorted(os.listdir(path2)):
+                    source_path = os.path.join(path2, filesystem_id)
+                    if os.path.isdir(source_path):
+                        yield filesystem_id, source_path
+
+    def migrate_source_dir(self, filesystem_id):
+        """Move the directory of the source `filesystem_id` to its shard.
+        Returns whether anything was moved.
+
+        The directory is renamed in one step, so readers find it in one
+        layout or the other. Should a sharded directory already exist, the
+        files are moved into it one by one instead.
+        """
+        storage_path = os.path.abspath(self.__storage_path)
+        legacy = os.path.join(storage_path, filesystem_id)
+        if not os.path.isdir(legacy):
+            return False
+        self.verify(legacy)
+        parent = os.path.join(storage_path, *shard(filesystem_id))
+        sharded = os.path.join(parent, filesystem_id)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if not os.path.exists(sharded):
+            os.rename(legacy, sharded)
+            return True
+        for filename in os.listdir(legacy):
+            if not os.path.exists(os.path.join(sharded, filename)):
+                os.rename(os.path.join(legacy, filename),
+                          os.path.join(sharded, filename))
+        try:
+            os.rmdir(legacy)
+        except OSError:
+            # Files that exist in both directories are left for an admin
+            # to look at
+            pass
+        return True
+
     def get_bulk_archive(self, selected_submissions, zip_directory=''):
         """Generate a zip file from the selected submissions"""
         zip_file = tempfile.NamedTemporaryFile(
@@ -88,28 +382,16 @@ class Storage:
         # folder structure per #383
         with zipfile.ZipFile(zip_file, 'w') as zip:
             for source in sources:
-                fname = ""
                 submissions = [s for s in selected_submissions
                                if s.source.journalist_designation == source]
                 for submission in submissions:
-                    filename = self.path(submission.source.filesystem_id,
-                                         submission.filename)
-                    self.verify(filename)
-                    document_number = submission.filename.split('-')[0]
-                    if zip_directory == submission.source.journalist_filename:
-                        fname = zip_directory
-                    else:
-                        fname = os.path.join(zip_directory, source)
-                    zip.write(filename, arcname=os.path.join(
-                        fname,
-                        "%s_%s" % (document_number,
-                                   submission.source.last_updated.date()),
-                        os.path.basename(filename)
-                    ))
+                    with self.local_copy(submission.source.filesystem_id,
+                                         submission.filename) as filename:
+                        zip.write(filename, arcname=archive_name(
+                            submission, zip_directory))
         return zip_file
 
-    def save_file_submission(self, filesystem_id, count, journalist_filename,
-                             filename, stream):
+    def save_file_submission(self, filesystem_id, count, filename, stream):
         sanitized_filename = secure_filename(filename)
 
         # We store file submissions in a .gz file for two reasons:
@@ -125,10 +407,7 @@ class Storage:
         # file. Given various usability constraints in GPG and Tails, this
         # is the most user-friendly way we have found to do this.
 
-        encrypted_file_name = "{0}-{1}-doc.gz.gpg".format(
-            count,
-            journalist_filename)
-        encrypted_file_path = self.path(filesystem_id, encrypted_file_name)
+        encrypted_file_name = stored_filename(count, 'doc.gz')
         with SecureTemporaryFile("/tmp") as stf:  # nosec
             with gzip.GzipFile(filename=sanitized_filename,
                                mode='wb', fileobj=stf) as gzf:
@@ -140,35 +419,56 @@ class Storage:
                         break
                     gzf.write(buf)
 
-            current_app.crypto_util.encrypt(
-                stf, self.__gpg_key, encrypted_file_path)
+            with self.output_path(filesystem_id,
+                                  encrypted_file_name) as output:
+                current_app.crypto_util.encrypt(stf, self.__gpg_key, output)
 
         return encrypted_file_name
 
-    def save_message_submission(self, filesystem_id, count,
-                                journalist_filename, message):
-        filename = "{0}-{1}-msg.gpg".format(count, journalist_filename)
-        msg_loc = self.path(filesystem_id, filename)
-        current_app.crypto_util.encrypt(message, self.__gpg_key, msg_loc)
+    def save_message_submission(self, filesystem_id, count, message):
+        filename = stored_filename(count, 'msg')
+        self.save_encrypted(filesystem_id, filename, message, self.__gpg_key)
         return filename
 
-    def rename_submission(self,
-                          filesystem_id,
-                          orig_filename,
-                          journalist_filename):
-        check_submission_name = VALIDATE_FILENAME(orig_filename)
-        if check_submission_name:
-            parsed_filename = check_submission_name.groupdict()
-            if parsed_filename.get('file_type'):
-                new_filename = "{}-{}-{}.gpg".format(
-                    parsed_filename['index'], journalist_filename,
-                    parsed_filename['file_type'])
-                try:
-                    os.rename(self.path(filesystem_id, orig_filename),
-                              self.path(filesystem_id, new_filename))
-                except OSError:
-                    pass
-                else:
-                    # Only return new filename if successful
-                    return new_filename
-        return orig_filename
+    def save_encrypted(self, filesystem_id, filename, plaintext,
+                       fingerprints):
+        """Encrypt the message or reply `plaintext` to `fingerprints` and
+        store it as `filename` of the source `filesystem_id`.
+
+        Short ones are encrypted in memory, so the backend can pack them
+        (see `store_backends.PosixBackend`), longer ones straight to a file.
+        """
+        pack_max_size = getattr(self.backend, 'pack_max_size', 0)
+        if pack_max_size and len(plaintext) <= pack_max_size:
+            ciphertext = current_app.crypto_util.encrypt(plaintext,
+                                                         fingerprints)
+            self.put(filesystem_id, filename, StringIO(ciphertext))
+            return
+        with self.output_path(filesystem_id, filename) as output:
+            current_app.crypto_util.encrypt(plaintext, fingerprints, output)
+
+    def migrate_filename(self, filesystem_id, filename):
+        """Rename the file `filename` of the source `filesystem_id`, stored
+        under the old naming scheme that included the journalist
+        designation, to its `stored_filename`. Returns the new name, which
+        the database has to be updated with.
+
+        It's safe to call again for a file that was renamed but whose new
+        name didn't make it to the database.
+        """
+        match = VALIDATE_FILENAME(filename)
+        if not match:
+            raise PathException("Invalid filename %s" % (filename, ))
+        new_filename = stored_filename(match.group('index'),
+                                       match.group('file_type'))
+        if new_filename == filename:
+            return filename
+        old_path = self.path(filesystem_id, filename)
+        new_path = self.path(filesystem_id, new_filename)
+        if os.path.exists(old_path):
+            if os.path.exists(new_path):
+                raise OSError(errno.EEXIST, "Not overwriting", new_path)
+            os.rename(old_path, new_path)
+        elif not os.path.exists(new_path):
+            raise OSError(errno.ENOENT, "No such file", old_path)
+        return new_filename
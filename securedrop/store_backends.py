@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""Backends keeping the encrypted submissions and replies of
+:class:`store.Storage`.
+
+Files are addressed by the filesystem id of their source and their stored
+filename. The backend is chosen with `STORAGE_BACKEND` in `config.py`:
+
+* ``posix`` (the default) keeps them in `STORE_DIR`.
+* ``s3`` keeps them in a bucket of an S3-compatible object store, such as
+  MinIO, so the store isn't limited to one disk. `STORE_DIR` is then only
+  used to stage files while they are being encrypted.
+
+Reads and writes are streamed, so large submissions are never held in
+memory as a whole.
+
+With `STORE_PACK_MAX_SIZE` set, the posix backend appends messages and
+replies that aren't larger than that to the source's pack, see
+`store_pack`.
+"""
+import calendar
+import collections
+import errno
+import os
+import shutil
+
+from cStringIO import StringIO
+
+import store
+import store_pack
+import worker
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Any, IO, List, Optional, Tuple  # noqa: F401
+
+CHUNK_SIZE = 1024 * 1024
+
+# Kinds of files that are small enough to be worth packing
+PACKED_FILE_TYPES = ('msg', 'reply')
+
+# S3 deletes at most this many objects per request
+S3_DELETE_BATCH_SIZE = 1000
+
+StoredFile = collections.namedtuple('StoredFile', ['filename', 'size',
+                                                   'mtime'])
+
+
+class PosixBackend(object):
+
+    """Keep files in the local directory tree of `storage`, see
+    :meth:`store.Storage.path`.
+
+    Messages and replies of at most `pack_max_size` bytes are kept in the
+    source's pack instead of a file of their own; 0 disables packing.
+    """
+
+    name = 'posix'
+    is_local = True
+
+    def __init__(self, storage, pack_max_size=0):
+        self.storage = storage
+        self.pack_max_size = pack_max_size
+
+    def pack(self, filesystem_id):
+        return store_pack.Pack(self.storage.path(filesystem_id))
+
+    def put(self, filesystem_id, filename, stream):
+        if self._packable(filename):
+            # Only read what's needed to tell whether it fits in the pack
+            data = stream.read(self.pack_max_size + 1)
+            if len(data) <= self.pack_max_size:
+                self.pack(filesystem_id).append(filename, data)
+                return
+            stream = _Prepended(data, stream)
+        with open(self.storage.path(filesystem_id, filename), 'wb') as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+
+    def get(self, filesystem_id, filename):
+        # type: (str, str) -> IO
+        try:
+            return open(self.storage.path(filesystem_id, filename), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise OSError(e.errno, e.strerror, e.filename)
+        # Packed entries are small, so they are read into memory. That also
+        # keeps the pack from being sent as a whole by X-Sendfile, which
+        # `send_file` uses for real files.
+        return StringIO(self.pack(filesystem_id).read(filename))
+
+    def stat(self, filesystem_id, filename):
+        # type: (str, str) -> StoredFile
+        try:
+            st = os.stat(self.storage.path(filesystem_id, filename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            size, mtime = self.pack(filesystem_id).stat(filename)
+            return StoredFile(filename, size, mtime)
+        return StoredFile(filename, st.st_size, st.st_mtime)
+
+    def delete(self, filesystem_id, filename):
+        try:
+            os.remove(self.storage.path(filesystem_id, filename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._unpack(filesystem_id, filename)
+
+    def list(self, filesystem_id):
+        # type: (str) -> List[StoredFile]
+        try:
+            filenames = os.listdir(self.storage.path(filesystem_id))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        files = [self.stat(filesystem_id, filename)
+                 for filename in filenames
+                 if store.VALIDATE_FILENAME(filename)]
+        if store_pack.PACK_FILENAME in filenames:
+            files.extend(StoredFile(*entry)
+                         for entry in self.pack(filesystem_id).list())
+        return sorted(files)
+
+    def secure_delete(self, items):
+        """Enqueue a job shredding `items`, which are `(filesystem_id,
+        filename)` tuples, or `(filesystem_id,)` for all of a source's
+        files. Returns the job.
+
+        Packed files are removed from their pack right away, and the job
+        compacts the pack afterwards so their ciphertext is shredded too.
+        """
+        paths = []
+        compact = []
+        for item in items:
+            path = self.storage.path(*item)
+            if len(item) > 1 and not os.path.lexists(path):
+                try:
+                    self._unpack(*item)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    directory = self.storage.path(item[0])
+                    if directory not in compact:
+                        compact.append(directory)
+                    continue
+            paths.append(path)
+        if compact:
+            return worker.enqueue_srm(paths, compact=compact)
+        return worker.enqueue_srm(paths)
+
+    def _packable(self, filename):
+        if not self.pack_max_size:
+            return False
+        match = store.VALIDATE_FILENAME(filename)
+        return bool(match) and match.group('file_type') in PACKED_FILE_TYPES
+
+    def _unpack(self, filesystem_id, filename):
+        pack = self.pack(filesystem_id)
+        # Raises OSError if there is no such entry
+        pack.stat(filename)
+        pack.remove(filename)
+
+
+class S3Backend(object):
+
+    """Keep files in `bucket` of an S3-compatible object store, under keys
+    laid out like the paths of :class:`PosixBackend`:
+    `<prefix><shard>/<shard>/<filesystem_id>/<filename>`.
+
+    `client` is a boto3 S3 client; it is created from `client_kwargs` if
+    not given.
+    """
+
+    name = 's3'
+    is_local = False
+
+    def __init__(self, bucket, prefix='', client=None, **client_kwargs):
+        if client is None:
+            # boto3 is only needed by installs using this backend
+            import boto3
+            client = boto3.client('s3', **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.S3_BUCKET,
+                   prefix=getattr(config, 'S3_PREFIX', ''),
+                   endpoint_url=getattr(config, 'S3_ENDPOINT_URL', None),
+                   region_name=getattr(config, 'S3_REGION_NAME', None),
+                   aws_access_key_id=getattr(config, 'S3_ACCESS_KEY_ID',
+                                             None),
+                   aws_secret_access_key=getattr(
+                       config, 'S3_SECRET_ACCESS_KEY', None))
+
+    def key(self, filesystem_id, filename=None):
+        # type: (str, Optional[str]) -> str
+        parts = list(store.shard(filesystem_id)) + [filesystem_id]
+        if filename is not None:
+            parts.append(filename)
+        return self.prefix + '/'.join(parts)
+
+    def put(self, filesystem_id, filename, stream):
+        # Uploaded in parts, without reading the whole stream into memory
+        self.client.upload_fileobj(stream, self.bucket,
+                                   self.key(filesystem_id, filename))
+
+    def get(self, filesystem_id, filename):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.key(filesystem_id, filename))
+        except Exception as e:
+            raise _translate_error(e, filename)
+        return response['Body']
+
+    def stat(self, filesystem_id, filename):
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self.key(filesystem_id, filename))
+        except Exception as e:
+            raise _translate_error(e, filename)
+        return StoredFile(filename, response['ContentLength'],
+                          _timestamp(response['LastModified']))
+
+    def delete(self, filesystem_id, filename):
+        self.client.delete_object(Bucket=self.bucket,
+                                  Key=self.key(filesystem_id, filename))
+
+    def list(self, filesystem_id):
+        prefix = self.key(filesystem_id) + '/'
+        files = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                filename = obj['Key'][len(prefix):]
+                if store.VALIDATE_FILENAME(filename):
+                    files.append(StoredFile(filename, obj['Size'],
+                                            _timestamp(obj['LastModified'])))
+        return sorted(files)
+
+    def secure_delete(self, items):
+        """Enqueue a job purging `items` (see
+        :meth:`PosixBackend.secure_delete`). Returns the job."""
+        return worker.enqueue(purge_batch, list(items))
+
+    def purge(self, items):
+        """Delete every version of the objects of `items`, so nothing can be
+        restored from the bucket's history. Overwriting the underlying disks
+        is up to the object store."""
+        job = worker.get_current_job()
+        total = len(items)
+        worker.set_progress(job, 0, total)
+        for done, item in enumerate(items, 1):
+            key = self.key(*item)
+            prefix = key if len(item) > 1 else key + '/'
+            versions = []
+            paginator = self.client.get_paginator('list_object_versions')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for version in (page.get('Versions', []) +
+                                page.get('DeleteMarkers', [])):
+                    if len(item) > 1 and version['Key'] != key:
+                        continue
+                    versions.append({'Key': version['Key'],
+                                     'VersionId': version['VersionId']})
+            for i in range(0, len(versions), S3_DELETE_BATCH_SIZE):
+                self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': versions[i:i + S3_DELETE_BATCH_SIZE],
+                            'Quiet': True})
+            worker.set_progress(job, done, total)
+        return "success"
+
+
+def purge_batch(items):
+    """Worker job purging `items` from the configured S3 bucket."""
+    from sdconfig import config
+    return S3Backend.from_config(config).purge(items)
+
+
+def backend_from_config(config, storage):
+    backend = getattr(config, 'STORAGE_BACKEND', 'posix')
+    if backend == 'posix':
+        return PosixBackend(storage, pack_max_size=getattr(
+            config, 'STORE_PACK_MAX_SIZE', 0))
+    elif backend == 's3':
+        return S3Backend.from_config(config)
+    raise ValueError("Unknown STORAGE_BACKEND {}".format(backend))
+
+
+class _Prepended(object):
+
+    """File-like object reading `data`, then the rest of `stream`."""
+
+    def __init__(self, data, stream):
+        self.data = data
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.data:
+            return self.stream.read(size)
+        if size < 0:
+            data, self.data = self.data + self.stream.read(), ''
+        else:
+            data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _translate_error(e, filename):
+    # Report missing objects like missing files, so callers don't need to
+    # know which backend they are using
+    response = getattr(e, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    if code in ('404', 'NoSuchKey', 'NotFound'):
+        return OSError(errno.ENOENT, "No such file", filename)
+    return e
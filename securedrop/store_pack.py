@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Append-only pack files holding a source's small ciphertexts.
+
+Chatty sources send thousands of short messages. Stored one file each, they
+waste inodes and slow down everything that walks the store. When
+`STORE_PACK_MAX_SIZE` is set, messages and replies up to that size are
+appended to a single `_PACK` file in the source's directory instead.
+
+A pack is a sequence of records, each a `<filename> <length>\\n` header
+followed by `length` bytes of ciphertext. Deleting an entry appends a
+tombstone record with a length of -1; :meth:`Pack.compact` later rewrites
+the pack without the deleted entries and shreds the old one. The records
+describe themselves, so the offset index is built by reading the headers
+only, and is kept per process and extended incrementally as the pack
+grows.
+
+Entries don't have their own modification time, they share the pack's, so
+packing doesn't reveal when each message arrived (see
+`source_app.utils.normalize_timestamps`).
+"""
+import errno
+import fcntl
+import os
+import threading
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Dict, List, Optional, Tuple  # noqa: F401
+
+PACK_FILENAME = '_PACK'
+
+DELETED = -1
+
+# Offset indexes of the packs this process has read, keyed by path. Each is
+# only valid for the inode it was built from, see `Pack._index`.
+_indexes = {}  # type: Dict[str, _Index]
+_indexes_lock = threading.Lock()
+
+
+class _Index(object):
+
+    def __init__(self, inode):
+        self.inode = inode
+        # filename -> (offset of the data, length)
+        self.entries = {}  # type: Dict[str, Tuple[int, int]]
+        # Where the last complete record ends
+        self.end = 0
+        self.deleted = 0
+
+
+class Pack(object):
+
+    """The pack in the source directory `directory`.
+
+    Every operation holds an `flock` on the pack: shared to read, exclusive
+    to write. Compaction replaces the pack file, so after taking the lock
+    the inode is checked, and the new pack opened if it changed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, PACK_FILENAME)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, filename, data):
+        """Append the entry `filename` with the contents `data`."""
+        self._append(filename, data)
+
+    def remove(self, filename):
+        """Mark the entry `filename` deleted. Its data stays in the pack
+        until the next :meth:`compact`."""
+        self._append(filename, '', length=DELETED)
+
+    def read(self, filename):
+        # type: (str) -> str
+        """Return the contents of the entry `filename`. Raises `OSError` if
+        there is no such entry."""
+        with self._locked(fcntl.LOCK_SH) as f:
+            if f is None:
+                raise _not_found(filename)
+            index = self._index(f)
+            if filename not in index.entries:
+                raise _not_found(filename)
+            offset, length = index.entries[filename]
+            f.seek(offset)
+            return f.read(length)
+
+    def stat(self, filename):
+        # type: (str) -> Tuple[int, float]
+        """Return the size and modification time of the entry `filename`.
+        Raises `OSError` if there is no such entry."""
+        with self._locked(fcntl.LOCK_SH) as f:
+            if f is None:
+                raise _not_found(filename)
+            index = self._index(f)
+            if filename not in index.entries:
+                raise _not_found(filename)
+            return index.entries[filename][1], os.fstat(f.fileno()).st_mtime
+
+    def list(self):
+        # type: () -> List[Tuple[str, int, float]]
+        """Return the `(filename, size, mtime)` of every entry."""
+        with self._locked(fcntl.LOCK_SH) as f:
+            if f is None:
+                return []
+            index = self._index(f)
+            mtime = os.fstat(f.fileno()).st_mtime
+            return sorted((filename, length, mtime)
+                          for filename, (_, length) in index.entries.items())
+
+    def compact(self, deleter):
+        """Rewrite the pack without its deleted entries, then securely
+        delete the old pack with the `rm.SecureDeleter` `deleter`. Returns
+        whether the pack was rewritten."""
+        with self._locked(fcntl.LOCK_EX) as f:
+            if f is None:
+                return False
+            index = self._index(f)
+            if not index.deleted and index.end == _size(f):
+                return False
+
+            new_path = self.path + '.new'
+            with open(new_path, 'wb') as new:
+                for filename, (offset, length) in sorted(
+                        index.entries.items(), key=lambda e: e[1][0]):
+                    f.seek(offset)
+                    new.write(_header(filename, length))
+                    new.write(f.read(length))
+                new.flush()
+                os.fsync(new.fileno())
+
+            # Keep a name for the old pack so it can be shredded once the
+            # new one has atomically taken its place
+            old_path = self.path + '.old'
+            if os.path.lexists(old_path):
+                os.remove(old_path)
+            os.link(self.path, old_path)
+            os.rename(new_path, self.path)
+            _fsync_directory(self.directory)
+            deleter.delete(old_path)
+            return True
+
+    def _append(self, filename, data, length=None):
+        if length is None:
+            length = len(data)
+        with self._locked(fcntl.LOCK_EX, create=True) as f:
+            index = self._index(f)
+            # Drop whatever is left of a record an interrupted append didn't
+            # finish writing
+            if _size(f) != index.end:
+                f.truncate(index.end)
+            f.seek(index.end)
+            f.write(_header(filename, length))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self._index(f)
+
+    def _locked(self, operation, create=False):
+        return _Locked(self.path, operation, create)
+
+    def _index(self, f):
+        # type: (file) -> _Index
+        """Return the offset index of the open pack `f`, reading the records
+        that were added since it was last read."""
+        inode = os.fstat(f.fileno()).st_ino
+        with _indexes_lock:
+            index = _indexes.get(self.path)
+            if index is None or index.inode != inode:
+                index = _indexes[self.path] = _Index(inode)
+            # Other threads of this process may be reading the pack too,
+            # holding the same shared flock, so only one extends the index
+            # at a time
+            f.seek(index.end)
+            while True:
+                header = f.readline()
+                if not header.endswith('\n'):
+                    break
+                filename, length = header.split(' ')
+                length = int(length)
+                if length == DELETED:
+                    index.entries.pop(filename, None)
+                    index.deleted += 1
+                    index.end = f.tell()
+                    continue
+                offset = f.tell()
+                f.seek(length, os.SEEK_CUR)
+                if f.tell() > _size(f):
+                    # A record an interrupted append didn't finish writing
+                    break
+                index.entries[filename] = (offset, length)
+                index.end = offset + length
+        return index
+
+
+class _Locked(object):
+
+    """Context manager opening the pack at `path` and taking an `flock` on
+    it. Evaluates to the open file, or `None` if there is no pack and
+    `create` is false."""
+
+    def __init__(self, path, operation, create):
+        self.path = path
+        self.operation = operation
+        self.create = create
+        self.f = None  # type: Optional[file]
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR | (
+                    os.O_CREAT if self.create else 0), 0o600)
+            except OSError as e:
+                if e.errno == errno.ENOENT and not self.create:
+                    return None
+                raise
+            f = os.fdopen(fd, 'r+b')
+            fcntl.flock(f.fileno(), self.operation)
+            try:
+                current = os.stat(self.path).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(f.fileno()).st_ino:
+                self.f = f
+                return f
+            # The pack was compacted while we waited for the lock
+            f.close()
+
+    def __exit__(self, *exc):
+        if self.f is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+
+def _header(filename, length):
+    return '{} {}\n'.format(filename, length)
+
+
+def _size(f):
+    return os.fstat(f.fileno()).st_size
+
+
+def _not_found(filename):
+    return OSError(errno.ENOENT, "No such file", filename)
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
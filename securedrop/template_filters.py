@@ -2,8 +2,11 @@
 from flask_babel import gettext, get_locale
 from babel import units, dates
 from datetime import datetime
-from jinja2 import Markup, escape
+from jinja2 import FileSystemBytecodeCache, Markup, escape
+import errno
 import math
+import os
+import tempfile
 
 
 def rel_datetime_format(dt, fmt=None, relative=False):
@@ -45,3 +48,46 @@ def filesizeformat(value):
         prefix = prefixes[i]
         bytes = float(value) / base ** (i + 1)
         return units.format_unit(bytes, prefix, locale=locale, length="short")
+
+
+class _BytecodeCache(FileSystemBytecodeCache):
+
+    """Cache of compiled templates shared by processes. Each one is written
+    to a temporary file renamed into place, so it's never seen in part, and
+    not being able to load or write one is no reason to fail the page."""
+
+    def load_bytecode(self, bucket):
+        try:
+            super(_BytecodeCache, self).load_bytecode(bucket)
+        except Exception:
+            # Compiled again, and written anew
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmp, self._get_cache_filename(bucket))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def bytecode_cache(config):
+    """Return a cache of compiled templates in `TEMPLATE_CACHE_DIR`, so each
+    new worker loads them instead of compiling them again."""
+    cache_dir = getattr(config, 'TEMPLATE_CACHE_DIR',
+                        os.path.join(config.SECUREDROP_DATA_ROOT,
+                                     'template-cache'))
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return _BytecodeCache(cache_dir)
@@ -3,11 +3,8 @@
 import gnupg
 import logging
 import os
-import psutil
 import pytest
 import shutil
-import signal
-import subprocess
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 from sdconfig import SDConfig, config as original_config
@@ -19,12 +16,6 @@ from journalist_app import create_app as create_journalist_app
 from source_app import create_app as create_source_app
 import utils
 
-# TODO: the PID file for the redis worker is hard-coded below.
-# Ideally this constant would be provided by a test harness.
-# It has been intentionally omitted from `config.py.example`
-# in order to isolate the test vars from prod vars.
-TEST_WORKER_PIDFILE = '/tmp/securedrop_test_worker.pid'
-
 # Quiet down gnupg output. (See Issue #2595)
 gnupg_logger = logging.getLogger(gnupg.__name__)
 gnupg_logger.setLevel(logging.ERROR)
@@ -52,9 +43,10 @@ def pytest_collection_modifyitems(config, items):
 
 @pytest.fixture(scope='session')
 def setUpTearDown():
-    _start_test_rqworker(original_config)
+    # Background jobs run on the in-process thread pool in the test
+    # environment (see `worker.backend_from_config`), so no rqworker needs
+    # to be started
     yield
-    _stop_test_rqworker()
     _cleanup_test_securedrop_dataroot(original_config)
 
 
@@ -133,33 +125,6 @@ def test_source(journalist_app):
                 'filesystem_id': filesystem_id}
 
 
-def _start_test_rqworker(config):
-    if not psutil.pid_exists(_get_pid_from_file(TEST_WORKER_PIDFILE)):
-        tmp_logfile = open('/tmp/test_rqworker.log', 'w')
-        subprocess.Popen(['rqworker', 'test',
-                          '-P', config.SECUREDROP_ROOT,
-                          '--pid', TEST_WORKER_PIDFILE],
-                         stdout=tmp_logfile,
-                         stderr=subprocess.STDOUT)
-
-
-def _stop_test_rqworker():
-    rqworker_pid = _get_pid_from_file(TEST_WORKER_PIDFILE)
-    if rqworker_pid:
-        os.kill(rqworker_pid, signal.SIGTERM)
-        try:
-            os.remove(TEST_WORKER_PIDFILE)
-        except OSError:
-            pass
-
-
-def _get_pid_from_file(pid_file_name):
-    try:
-        return int(open(pid_file_name).read())
-    except IOError:
-        return None
-
-
 def _cleanup_test_securedrop_dataroot(config):
     # Keyboard interrupts or dropping to pdb after a test failure sometimes
     # result in the temporary test SecureDrop data root not being deleted.
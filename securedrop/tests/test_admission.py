@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from cStringIO import StringIO
+from flask import session
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import admission
+import spool
+
+from db import db
+from models import Submission
+from source_app import create_app
+from utils.db_helper import new_codename
+
+
+def _source_app(config):
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _submit(app, size=100):
+    return app.post('/submit', data=dict(
+        msg='',
+        fh=(StringIO('x' * size), 'document.txt'),
+    ), follow_redirects=True)
+
+
+def test_upload_too_large(config):
+    config.UPLOAD_MAX_BYTES = 10 * 1024
+    source_app = _source_app(config)
+
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        with patch('request_that_secures_file_uploads.SecureTemporaryFile') \
+                as spool:
+            resp = _submit(app, size=20 * 1024)
+        assert resp.status_code == 413
+        assert 'too large' in resp.data.decode('utf-8')
+        # Refused before anything was read
+        assert not spool.called
+        assert Submission.query.count() == 0
+
+        resp = _submit(app)
+        assert resp.status_code == 200
+        assert Submission.query.count() == 1
+
+
+def test_upload_without_content_length(config):
+    source_app = _source_app(config)
+
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        resp = app.post('/submit', environ_overrides={'CONTENT_LENGTH': ''})
+        assert resp.status_code == 411
+
+
+def test_upload_disk_full(config):
+    config.UPLOAD_MIN_FREE_BYTES = 1024
+    source_app = _source_app(config)
+
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        with patch('admission.os.statvfs') as statvfs:
+            statvfs.return_value.f_bavail = 1
+            statvfs.return_value.f_frsize = 1024
+            resp = _submit(app)
+        assert resp.status_code == 507
+        assert 'does not have room' in resp.data.decode('utf-8')
+        assert Submission.query.count() == 0
+
+
+def test_upload_quotas(config):
+    source_app = _source_app(config)
+
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        assert _submit(app).status_code == 200
+        stored = Submission.query.one().size
+
+        source_app.admission.source_quota = stored + 1000
+        assert _submit(app, size=10 * 1024).status_code == 507
+        source_app.admission.source_quota = None
+        source_app.admission.store_quota = stored + 1000
+        assert _submit(app, size=10 * 1024).status_code == 507
+        assert Submission.query.count() == 1
+
+        source_app.admission.store_quota = stored + 100 * 1024
+        assert _submit(app, size=10 * 1024).status_code == 200
+
+
+def test_upload_busy(config):
+    config.UPLOAD_MAX_CONCURRENT = 1
+    source_app = _source_app(config)
+    slots = admission.UploadSlots(
+        os.path.join(config.SECUREDROP_DATA_ROOT, 'upload-slots'), 1)
+
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        # The slot is released at the end of each request
+        assert _submit(app).status_code == 200
+        assert _submit(app).status_code == 200
+
+        # Taken by another process
+        slot = slots.acquire()
+        resp = _submit(app)
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == str(admission.RETRY_AFTER)
+        slots.release(slot)
+
+        assert _submit(app).status_code == 200
+        assert Submission.query.count() == 3
+
+
+def test_upload_slots(tmpdir):
+    slots = admission.UploadSlots(str(tmpdir.join('slots')), 2)
+    first = slots.acquire()
+    second = slots.acquire()
+    assert first and second
+    assert slots.acquire() is None
+    slots.release(first)
+    assert slots.acquire() is not None
+
+
+def test_free_space_where_async_submissions_are_spooled(config):
+    config.ASYNC_SUBMISSIONS = True
+    policy = admission.Admission(config, None, config.TEMP_DIR)
+    assert policy.directories == [spool.spool_dir(config), config.STORE_DIR]
+    # Not created before the first submission
+    assert not os.path.isdir(spool.spool_dir(config))
+    policy.admit(100)
+
+    with patch('admission.os.statvfs') as statvfs:
+        statvfs.return_value.f_bavail = 0
+        with pytest.raises(admission.UploadRefused) as e:
+            policy.admit(100)
+    assert e.value.reason == admission.DISK_FULL
+
+
+def test_store_bytes_are_summed_again_after_a_while(config):
+    config.STORE_QUOTA_BYTES = 1000
+    policy = admission.Admission(config, None, config.TEMP_DIR)
+
+    with patch('admission._stored_bytes', return_value=500) as stored_bytes:
+        policy.admit(300)
+        # Counting what was just admitted, without summing again
+        with pytest.raises(admission.UploadRefused) as e:
+            policy.admit(300)
+        assert e.value.reason == admission.STORE_QUOTA
+        assert stored_bytes.call_count == 1
+
+        policy._store_bytes_at -= admission.STORE_BYTES_MAX_AGE + 1
+        policy.admit(300)
+        assert stored_bytes.call_count == 2
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from flask import url_for
+from mock import patch
+from pyotp import TOTP
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import utils
+
+from db import db
+from models import Journalist, Reply, Source, Submission
+
+
+def _token(app, journo):
+    resp = app.post('/api/v1/token', data=json.dumps({
+        'username': journo['username'],
+        'passphrase': journo['password'],
+        'one_time_code': TOTP(journo['otp_secret']).now()}))
+    assert resp.status_code == 200
+    return {'Authorization': 'Token ' + json.loads(resp.data)['token']}
+
+
+def _get(app, headers, endpoint, **values):
+    resp = app.get(url_for(endpoint, **values), headers=headers)
+    assert resp.status_code == 200
+    return json.loads(resp.data)
+
+
+def _post(app, headers, endpoint, data):
+    return app.post(url_for(endpoint), data=json.dumps(data),
+                    headers=headers)
+
+
+def _sources(test_source, replies_from=None):
+    """Give the `test_source` two submissions, and a reply if
+    `replies_from` a journalist id, as a source that has submitted, and add
+    a pending source. Return the ids of the source, of its submissions and
+    of the pending source."""
+    source = Source.query.get(test_source['source'].id)
+    source.pending = False
+    submissions = utils.db_helper.submit(source, 2)
+    if replies_from is not None:
+        utils.db_helper.reply(Journalist.query.get(replies_from), source, 1)
+    pending = Source('PENDING', 'pending')
+    db.session.add(pending)
+    db.session.commit()
+    return source.id, [s.id for s in submissions], pending.id
+
+
+def _ids(changes):
+    return [(c['type'], c['id']) for c in changes['changes']]
+
+
+def test_token_is_required(journalist_app, test_journo):
+    with journalist_app.test_client() as app:
+        resp = app.get('/api/v1/sources')
+        assert resp.status_code == 403
+        resp = app.get('/api/v1/sources',
+                       headers={'Authorization': 'Token nope'})
+        assert resp.status_code == 403
+        assert json.loads(resp.data)['error'] == 'Forbidden'
+
+
+def test_token_with_wrong_credentials(journalist_app, test_journo):
+    with journalist_app.test_client() as app:
+        resp = app.post('/api/v1/token', data=json.dumps({
+            'username': test_journo['username'],
+            'passphrase': 'wrong',
+            'one_time_code': TOTP(test_journo['otp_secret']).now()}))
+        assert resp.status_code == 403
+        resp = app.post('/api/v1/token', data=json.dumps({
+            'username': test_journo['username']}))
+        assert resp.status_code == 400
+
+
+def test_token_authenticates_its_journalist(journalist_app, test_journo):
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+        token = headers['Authorization'].split()[1]
+        assert Journalist.validate_api_token_and_get_user(token).id == \
+            test_journo['id']
+        assert _get(app, headers, 'api.get_endpoints')['version'] == 1
+
+
+def test_sources_submissions_and_replies(journalist_app, test_journo,
+                                         test_source):
+    with journalist_app.app_context():
+        source_id, submission_ids, pending_id = _sources(
+            test_source, replies_from=test_journo['id'])
+
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+
+        sources = _get(app, headers, 'api.get_all_sources')['sources']
+        assert [s['id'] for s in sources] == [source_id]
+        assert sources[0]['number_of_messages'] == 2
+        assert not sources[0]['is_starred']
+        resp = app.get(url_for('api.single_source', source_id=pending_id),
+                       headers=headers)
+        assert resp.status_code == 404
+
+        submissions = _get(app, headers, 'api.get_source_submissions',
+                           source_id=source_id)['submissions']
+        assert [s['id'] for s in submissions] == submission_ids
+        assert not any(s['is_read'] for s in submissions)
+        assert _get(app, headers, 'api.get_all_submissions')['submissions'] \
+            == submissions
+
+        replies = _get(app, headers, 'api.get_all_replies')['replies']
+        assert [r['journalist_id'] for r in replies] == [test_journo['id']]
+
+        resp = app.get(submissions[0]['download_url'], headers=headers)
+        assert resp.status_code == 200
+        assert len(resp.data) == submissions[0]['size']
+        assert Submission.query.get(submission_ids[0]).downloaded
+
+        resp = app.post(sources[0]['star_url'], headers=headers)
+        assert json.loads(resp.data)['is_starred']
+
+
+def test_changes_since_cursor(journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        source_id, submission_ids, _ = _sources(test_source)
+
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+
+        changes = _get(app, headers, 'api.get_changes')
+        assert _ids(changes) == [('source', source_id)] + \
+            [('submission', i) for i in submission_ids]
+        assert not changes['more']
+        cursor = changes['cursor']
+
+        assert _get(app, headers, 'api.get_changes',
+                    since=cursor)['changes'] == []
+
+        Submission.query.get(submission_ids[0]).mark_downloaded()
+        db.session.commit()
+        app.post(url_for('api.star', source_id=source_id), headers=headers)
+
+        changes = _get(app, headers, 'api.get_changes', since=cursor)
+        assert _ids(changes) == [('submission', submission_ids[0]),
+                                 ('source', source_id)]
+        assert changes['changes'][0]['submission']['is_read']
+        assert changes['changes'][1]['source']['is_starred']
+
+        with patch.object(journalist_app.storage,
+                          'secure_delete') as secure_delete:
+            secure_delete.return_value.id = 'job'
+            resp = app.delete(changes['changes'][0]['submission']['url'],
+                              headers=headers)
+        assert json.loads(resp.data)['job_id'] == 'job'
+
+        changes = _get(app, headers, 'api.get_changes',
+                       since=changes['cursor'])
+        assert changes['changes'] == [{'cursor': changes['cursor'],
+                                       'type': 'submission',
+                                       'id': submission_ids[0],
+                                       'deleted': True}]
+
+
+def test_delete_starred_source(journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        source_id, _, _ = _sources(test_source)
+
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+        app.post(url_for('api.star', source_id=source_id), headers=headers)
+        cursor = _get(app, headers, 'api.get_changes')['cursor']
+
+        with patch.object(journalist_app.storage,
+                          'secure_delete') as secure_delete:
+            secure_delete.return_value.id = 'job'
+            resp = app.delete(url_for('api.single_source',
+                                      source_id=source_id),
+                              headers=headers)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['job_id'] == 'job'
+
+        changes = _get(app, headers, 'api.get_changes', since=cursor)
+        assert ('source', source_id) in _ids(changes)
+        assert all(c['deleted'] for c in changes['changes'])
+        assert Source.query.get(source_id) is None
+
+
+def test_changes_in_pages(journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        _, submission_ids, _ = _sources(test_source)
+
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+
+        changes = _get(app, headers, 'api.get_changes', limit=2)
+        assert changes['more']
+        rest = _get(app, headers, 'api.get_changes', since=changes['cursor'])
+        assert not rest['more']
+        assert [i for kind, i in _ids(changes) + _ids(rest)
+                if kind == 'submission'] == submission_ids
+
+
+def test_bulk_mark_downloaded_and_delete(journalist_app, test_journo,
+                                         test_source):
+    with journalist_app.app_context():
+        _, submission_ids, _ = _sources(test_source,
+                                        replies_from=test_journo['id'])
+        reply_ids = [r.id for r in Reply.query.all()]
+
+    with journalist_app.test_client() as app:
+        headers = _token(app, test_journo)
+
+        resp = _post(app, headers, 'api.mark_submissions_downloaded',
+                     {'ids': submission_ids})
+        assert resp.status_code == 200
+        assert all(s['is_read']
+                   for s in json.loads(resp.data)['submissions'])
+
+        resp = _post(app, headers, 'api.delete_submissions',
+                     {'ids': submission_ids + [12345]})
+        assert resp.status_code == 404
+        resp = _post(app, headers, 'api.delete_submissions',
+                     {'ids': 'all'})
+        assert resp.status_code == 400
+
+        with patch.object(journalist_app.storage,
+                          'secure_delete') as secure_delete:
+            secure_delete.return_value.id = 'job'
+            resp = _post(app, headers, 'api.delete_submissions',
+                         {'ids': submission_ids})
+            assert resp.status_code == 200
+            resp = _post(app, headers, 'api.delete_replies',
+                         {'ids': reply_ids})
+            assert resp.status_code == 200
+
+        assert Submission.query.count() == 0
+        assert Reply.query.count() == 0
+        assert len(secure_delete.call_args_list[0][0][0]) == 2
@@ -206,6 +206,15 @@ class TestCryptoUtil(unittest.TestCase):
         """
         current_app.crypto_util.delete_reply_keypair('Reality Winner')
 
+    def test_source_keys(self):
+        source, _ = utils.db_helper.init_source()
+
+        keys = current_app.crypto_util.source_keys()
+
+        self.assertEqual(keys[source.filesystem_id],
+                         current_app.crypto_util.getkey(source.filesystem_id))
+        self.assertNotIn(config.JOURNALIST_KEY, keys.values())
+
     def test_getkey(self):
         source, _ = utils.db_helper.init_source()
 
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+from datetime import datetime, timedelta
+from flask import url_for
+from mock import patch
+from redis.exceptions import ConnectionError
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import events
+import utils
+
+from db import db
+from models import Change, Source
+from test_journalist import _login_user
+
+
+def test_local_listener_wakes_up_on_publish():
+    broadcaster = events.LocalBroadcaster()
+    listener = broadcaster.listener()
+    assert not listener.wait(0.01)
+
+    broadcaster.publish()
+    broadcaster.publish()
+    assert listener.wait(0.01)
+    assert not listener.wait(0.01)
+
+    timer = threading.Timer(0.05, broadcaster.publish)
+    timer.start()
+    assert listener.wait(5)
+    timer.join()
+
+
+def test_publish_without_redis():
+    with patch.object(events, 'get_broadcaster') as get_broadcaster:
+        get_broadcaster.return_value.publish.side_effect = ConnectionError
+        events.publish()
+
+
+def _events(data):
+    """Parse a stream of server-sent events into (name, id, data) tuples."""
+    parsed = []
+    for block in data.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines()
+                      if not line.startswith(':') and ': ' in line)
+        if 'event' in fields:
+            parsed.append((fields['event'], int(fields['id']),
+                           json.loads(fields['data'])))
+    return parsed
+
+
+def _stream(app, **kwargs):
+    resp = app.get(url_for('main.events', **kwargs.pop('query', {})),
+                   **kwargs)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+    return _events(resp.data)
+
+
+def test_index_streams_source_changes(config, journalist_app, test_journo,
+                                      test_source):
+    config.EVENT_STREAM_MAX_SECONDS = 0
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        resp = app.get(url_for('main.index'))
+        since = Change.latest_id()
+        assert url_for('main.events', since=since) in resp.data
+
+        source = Source.query.get(test_source['source'].id)
+        source.pending = False
+        utils.db_helper.submit(source, 2)
+        source_id = source.id
+
+        streamed = _stream(app, query={'since': since})
+        assert [(e[0], e[2]['id']) for e in streamed] == [
+            ('source', source_id)]
+        _, cursor, data = streamed[0]
+        assert not data['starred']
+        assert 'data-source-id="{}"'.format(source_id) in data['row']
+        assert '2 unread' in data['row']
+
+        # Nothing new since
+        assert _stream(app, headers={'Last-Event-ID': str(cursor)}) == []
+
+        app.post(url_for('col.add_star',
+                         filesystem_id=test_source['filesystem_id']))
+        streamed = _stream(app, headers={'Last-Event-ID': str(cursor)})
+        assert [(e[0], e[2]['starred']) for e in streamed] == [
+            ('source', True)]
+
+        db.session.delete(Source.query.get(source_id))
+        db.session.commit()
+        streamed = _stream(app, query={'since': streamed[-1][1]})
+        assert streamed[-1][0] == 'source-deleted'
+        assert streamed[-1][2] == {'id': source_id}
+
+
+def test_pending_sources_are_not_streamed(config, journalist_app,
+                                          test_journo):
+    config.EVENT_STREAM_MAX_SECONDS = 0
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        since = Change.latest_id()
+        db.session.add(Source('PENDING', 'pending'))
+        db.session.commit()
+
+        assert _stream(app, query={'since': since}) == []
+
+
+def test_stream_does_not_extend_the_session(config, journalist_app,
+                                            test_journo):
+    config.EVENT_STREAM_MAX_SECONDS = 60
+    config.EVENT_STREAM_POLL_SECONDS = 0.1
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        # Before the session transaction, which pops the request context
+        events_url = url_for('main.events')
+        # The session cookie keeps whole seconds
+        expires = (datetime.utcnow() +
+                   timedelta(seconds=2)).replace(microsecond=0)
+        with app.session_transaction() as session:
+            session['expires'] = expires
+
+        # Ends with the session rather than after a minute
+        started = time.time()
+        resp = app.get(events_url)
+        assert resp.status_code == 200
+        resp.data
+        assert time.time() - started < 30
+        with app.session_transaction() as session:
+            assert session['expires'] == expires
+
+        # And the browser reconnects to the login page
+        resp = app.get(events_url)
+        assert resp.status_code == 302
+        assert resp.location.endswith('/login')
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import time
+import zipfile
+
+import pytest
+from cStringIO import StringIO
+from flask import current_app, url_for
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import export
+import utils
+import worker
+
+from models import Journalist, Source, Submission
+from test_journalist import _login_user
+
+
+def _files(*sizes):
+    return [('source/{}-doc.gz.gpg'.format(i), 'FSID',
+             '{}-doc.gz.gpg'.format(i), size)
+            for i, size in enumerate(sizes, 1)]
+
+
+def _volume_size(volume):
+    return export.VOLUME_OVERHEAD + sum(
+        export.ENTRY_OVERHEAD + len(entry['path']) + entry['length']
+        for entry in volume)
+
+
+def test_plan_fills_volumes_in_order():
+    volumes = export.plan(_files(40000, 40000, 40000, 10), 100000)
+
+    assert [[entry['filename'] for entry in volume] for volume in volumes] \
+        == [['1-doc.gz.gpg', '2-doc.gz.gpg'], ['3-doc.gz.gpg', '4-doc.gz.gpg']]
+    for volume in volumes:
+        assert _volume_size(volume) <= 100000
+
+
+def test_plan_splits_files_larger_than_a_volume():
+    volumes = export.plan(_files(10, 250000), 100000)
+
+    parts = [entry for volume in volumes for entry in volume
+             if entry['filename'] == '2-doc.gz.gpg']
+    assert [part['path'] for part in parts] == [
+        'source/2-doc.gz.gpg.001', 'source/2-doc.gz.gpg.002',
+        'source/2-doc.gz.gpg.003']
+    # The parts are contiguous, and start where the first file left room
+    assert parts[0] in volumes[0]
+    assert [part['offset'] for part in parts] == [
+        0, parts[0]['length'], parts[0]['length'] + parts[1]['length']]
+    assert sum(part['length'] for part in parts) == 250000
+    for volume in volumes:
+        assert _volume_size(volume) <= 100000
+
+
+def test_plan_rejects_tiny_volumes():
+    with pytest.raises(ValueError):
+        export.plan(_files(10), 1024)
+
+
+def _submissions(test_source, large_size):
+    source = test_source['source']
+    submissions = utils.db_helper.submit(source, 3)
+    # Make one of them larger than a volume
+    with open(current_app.storage.path(source.filesystem_id,
+                                       submissions[0].filename), 'wb') as f:
+        f.write(os.urandom(large_size))
+    return submissions
+
+
+def _stored(submission):
+    with open(current_app.storage.path(submission.source.filesystem_id,
+                                       submission.filename), 'rb') as f:
+        return f.read()
+
+
+def test_export_selected(config, journalist_app, test_journo, test_source):
+    config.EXPORT_VOLUME_MAX_BYTES = 100 * 1024
+    with journalist_app.app_context():
+        submissions = _submissions(test_source, 250 * 1024)
+        filenames = [submission.filename for submission in submissions]
+        large_filename = submissions[0].display_filename
+        large_data = _stored(submissions[0])
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        with patch('export.worker.enqueue') as enqueue:
+            enqueue.return_value.id = 'job'
+            resp = app.post('/bulk', data=dict(
+                action='export',
+                filesystem_id=test_source['filesystem_id'],
+                doc_names_selected=filenames))
+        assert resp.status_code == 302
+        export_id = resp.location.split('/')[-1]
+
+        # Exported submissions count as downloaded
+        assert all(s.downloaded for s in Submission.query.all())
+
+        with patch('worker.job_progress') as job_progress:
+            job_progress.return_value = {'status': 'queued', 'done': 0,
+                                         'total': 4}
+            resp = app.get(resp.location)
+        assert 'Being prepared' in resp.data.decode('utf-8')
+
+        (job, directory, job_export_id), _ = enqueue.call_args
+        assert job is export.build_export
+        assert job_export_id == export_id
+        job(directory, export_id)
+
+        manifest = json.loads(app.get(url_for(
+            'main.download_export_file', export_id=export_id,
+            filename='MANIFEST.json')).data)
+        checksums = app.get(url_for(
+            'main.download_export_file', export_id=export_id,
+            filename='SHA256SUMS')).data.splitlines()
+        assert len(manifest['volumes']) == len(checksums) == 3
+
+        files = {}
+        for volume, line in zip(manifest['volumes'], checksums):
+            resp = app.get(url_for('main.download_export_file',
+                                   export_id=export_id,
+                                   filename=volume['filename']))
+            assert resp.status_code == 200
+            assert len(resp.data) == volume['size'] <= 100 * 1024
+            assert hashlib.sha256(resp.data).hexdigest() == volume['sha256']
+            assert line == '{}  {}'.format(volume['sha256'],
+                                           volume['filename'])
+
+            archive = zipfile.ZipFile(StringIO(resp.data))
+            for entry in volume['files']:
+                data = archive.read(entry['path'])
+                assert hashlib.sha256(data).hexdigest() == entry['sha256']
+                files[entry['path']] = data
+
+        # The documents are in the source's folder, the large one in parts
+        assert len(files) == 5
+        for path in files:
+            assert path.startswith(
+                test_source['source'].journalist_filename + '/')
+        large = [path for path in files if path.endswith('.001')][0][:-4]
+        assert large.endswith(large_filename)
+        assert ''.join(files['{}.{:03d}'.format(large, part)]
+                       for part in (1, 2, 3)) == large_data
+
+        # Copying a volume can be resumed
+        volume = manifest['volumes'][1]
+        resp = app.get(url_for('main.download_export_file',
+                               export_id=export_id,
+                               filename=volume['filename']),
+                       headers={'Range': 'bytes=1000-'})
+        assert resp.status_code == 206
+        assert len(resp.data) == volume['size'] - 1000
+
+
+def test_export_with_reply(config, journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = utils.db_helper.submit(source, 1)[0]
+        reply = utils.db_helper.reply(
+            Journalist.query.get(test_journo['id']), source, 1)[0]
+        filenames = [submission.filename, reply.filename]
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        with patch('export.worker.enqueue') as enqueue:
+            enqueue.return_value.id = 'job'
+            resp = app.post('/bulk', data=dict(
+                action='export',
+                filesystem_id=test_source['filesystem_id'],
+                doc_names_selected=filenames))
+        assert resp.status_code == 302
+        export_id = resp.location.split('/')[-1]
+
+        exported = export.Export(export.export_dir(config), export_id)
+        assert len(exported.volumes[0]['files']) == 2
+        assert Submission.query.get(submission.id).downloaded
+
+
+def test_export_is_only_for_its_journalist(journalist_app, test_journo,
+                                           test_admin, test_source):
+    with journalist_app.test_client() as app:
+        with journalist_app.test_request_context('/'):
+            submissions = utils.db_helper.submit(test_source['source'], 1)
+            exported = export.Export.create(
+                export.export_dir(journalist_app.sdconfig), 'all',
+                submissions, export.DEFAULT_VOLUME_MAX_BYTES,
+                test_journo['id'])
+        _login_user(app, test_admin['username'], test_admin['password'],
+                    test_admin['otp_secret'])
+        resp = app.get(url_for('main.export_volumes', export_id=exported.id))
+        assert resp.status_code == 404
+        resp = app.get(url_for('main.export_volumes', export_id='nothing'))
+        assert resp.status_code == 404
+
+
+def test_export_resumes_with_missing_volumes(config, journalist_app,
+                                             test_source):
+    with journalist_app.app_context():
+        submissions = _submissions(test_source, 250 * 1024)
+        exported = export.Export.create(export.export_dir(config), 'all',
+                                        submissions, 100 * 1024, 1)
+        exported.build_volume(exported.volumes[0])
+        built = exported.volume_path(exported.volumes[0])
+        mtime = os.path.getmtime(built)
+        # Interrupted while building the second one
+        with open(exported.volume_path(exported.volumes[1]) + '.partial',
+                  'wb') as f:
+            f.write('PK')
+        assert not exported.complete
+
+        # Picked up by the next job
+        exported = export.Export(export.export_dir(config), exported.id)
+        exported.build()
+        assert exported.complete
+        assert os.path.getmtime(built) == mtime
+        assert not [name for name in os.listdir(exported.path)
+                    if name.endswith('.partial')]
+        for volume in exported.volumes:
+            assert zipfile.is_zipfile(exported.volume_path(volume))
+
+
+def test_export_of_deleted_submission(config, journalist_app, test_source):
+    with journalist_app.app_context():
+        submissions = utils.db_helper.submit(test_source['source'], 2)
+        exported = export.Export.create(export.export_dir(config), 'all',
+                                        submissions, 100 * 1024, 1)
+        os.remove(current_app.storage.path(test_source['filesystem_id'],
+                                           submissions[1].filename))
+        exported.build()
+
+        entries = exported.manifest()['volumes'][0]['files']
+        assert [entry['missing'] for entry in entries] == [False, True]
+        archive = zipfile.ZipFile(exported.volume_path(exported.volumes[0]))
+        assert archive.namelist() == [entries[0]['path']]
+
+
+def test_clean_exports(config, journalist_app, test_source):
+    with journalist_app.app_context():
+        directory = export.export_dir(config)
+        old = export.Export.create(directory, 'old', [], 100 * 1024, 1)
+        new = export.Export.create(directory, 'new', [], 100 * 1024, 1)
+        old.state['created'] = time.time() - 2 * export.EXPORT_MAX_AGE
+        old._save()
+
+        expired = os.path.join(directory, export.EXPIRED_PREFIX + old.id)
+        with patch('worker.enqueue_srm') as enqueue_srm:
+            enqueue_srm.return_value.id = 'job'
+            assert export.clean_exports(directory) == 1
+        enqueue_srm.assert_called_once_with([expired])
+        assert sorted(os.listdir(directory)) == sorted([
+            new.id, os.path.basename(expired), export.EXPIRED_JOBS_FILENAME])
+
+        # Not queued again while its job is pending
+        with patch('worker.enqueue_srm') as enqueue_srm, \
+                patch('worker.job_progress') as job_progress:
+            job_progress.return_value = {'status': 'queued', 'done': 0,
+                                         'total': 1}
+            assert export.clean_exports(directory) == 0
+        job_progress.assert_called_once_with('job')
+        assert not enqueue_srm.called
+
+        # But once it's lost
+        with patch('worker.enqueue_srm') as enqueue_srm, \
+                patch('worker.job_progress') as job_progress:
+            enqueue_srm.return_value.id = 'another-job'
+            job_progress.return_value = None
+            assert export.clean_exports(directory) == 0
+        enqueue_srm.assert_called_once_with([expired])
+
+        # Shredded for real, and forgotten
+        backend = worker.ThreadPoolBackend()
+        with patch.object(worker, '_backend', backend):
+            export.clean_exports(directory)
+            backend.join()
+        assert sorted(os.listdir(directory)) == sorted([
+            new.id, export.EXPIRED_JOBS_FILENAME])
+        export.clean_exports(directory)
+        with open(os.path.join(directory, export.EXPIRED_JOBS_FILENAME)) as f:
+            assert json.load(f) == {}
+        assert export.clean_exports(os.path.join(directory, 'nowhere')) == 0
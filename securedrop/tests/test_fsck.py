@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import time
+
+from flask import current_app
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import fsck
+import manage
+import utils
+
+from db import db
+from models import Source, Submission
+
+
+def _issues(**kwargs):
+    return sorted((issue.type, issue.filesystem_id, issue.filename)
+                  for issue in fsck.check(current_app.storage, **kwargs))
+
+
+def test_check_clean_store(journalist_app, test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        utils.db_helper.submit(source, 2)
+
+        assert _issues(crypto_util=current_app.crypto_util,
+                       check_headers=True) == []
+
+
+def test_check_reports_drift(journalist_app, test_source):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        source = Source.query.get(test_source['source'].id)
+        filesystem_id = source.filesystem_id
+        missing, resized = utils.db_helper.submit(source, 2)
+        os.remove(storage.path(filesystem_id, missing.filename))
+        with open(storage.path(filesystem_id, resized.filename), 'ab') as f:
+            f.write('x')
+        with open(storage.path(filesystem_id, '5-msg.gpg'), 'w') as f:
+            f.write('not encrypted')
+        open(os.path.join(storage.path(filesystem_id), 'notes.txt'),
+             'w').close()
+        storage.create_source_dir('ORPHAN')
+        db.session.add(Source('NODIR', 'no dir'))
+        db.session.commit()
+
+        issues = _issues(check_headers=True, batch_size=1, jobs=2)
+
+        assert issues == sorted([
+            ('missing_file', filesystem_id, missing.filename),
+            ('size_mismatch', filesystem_id, resized.filename),
+            ('orphaned_file', filesystem_id, '5-msg.gpg'),
+            ('bad_header', filesystem_id, '5-msg.gpg'),
+            ('unexpected_file', filesystem_id, 'notes.txt'),
+            ('orphaned_source_dir', 'ORPHAN', None),
+            ('missing_source_dir', 'NODIR', None),
+        ])
+
+
+def test_check_reads_packs(journalist_app, test_source):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        source = Source.query.get(test_source['source'].id)
+        filesystem_id = source.filesystem_id
+        storage.backend.pack_max_size = 4096
+        try:
+            utils.db_helper.submit(source, 1)
+            storage.put(filesystem_id, '2-msg.gpg', open(os.devnull))
+        finally:
+            storage.backend.pack_max_size = 0
+
+        assert _issues(check_headers=True) == [
+            ('bad_header', filesystem_id, '2-msg.gpg'),
+            ('orphaned_file', filesystem_id, '2-msg.gpg')]
+
+
+def test_check_keyring(journalist_app, test_source):
+    with journalist_app.app_context():
+        crypto_util = current_app.crypto_util
+        source = Source.query.get(test_source['source'].id)
+        filesystem_id = source.filesystem_id
+        db.session.delete(source)
+        db.session.commit()
+
+        # The journalist key is not mistaken for a source key
+        assert [issue for issue in fsck.check(
+            current_app.storage, crypto_util=crypto_util,
+            journalist_key=current_app.config.get('JOURNALIST_KEY'))
+            if issue.type != 'orphaned_source_dir'] == [
+            fsck.Issue('orphaned_key', filesystem_id, None, None)]
+
+
+def _age(path, seconds=fsck.ORPHAN_MIN_AGE + 60):
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_repair(journalist_app, test_source):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        source = Source.query.get(test_source['source'].id)
+        filesystem_id = source.filesystem_id
+        for filename in ('1-msg.gpg', '2-msg.gpg', '3-msg.gpg'):
+            with open(storage.path(filesystem_id, filename), 'w') as f:
+                f.write('orphan')
+        _age(storage.path(filesystem_id, '1-msg.gpg'))
+        _age(storage.path(filesystem_id, '3-msg.gpg'))
+        # Stored while the submission is being added
+        submission = Submission(source, '3-msg.gpg')
+        db.session.add(submission)
+        db.session.commit()
+        storage.create_source_dir('ORPHAN')
+        _age(storage.path('ORPHAN'))
+        storage.create_source_dir('NEW')
+
+        issues = [fsck.Issue('orphaned_file', filesystem_id, filename, None)
+                  for filename in ('1-msg.gpg', '2-msg.gpg', '3-msg.gpg',
+                                   '4-msg.gpg')]
+        issues += [fsck.Issue('orphaned_source_dir', 'ORPHAN', None, None),
+                   fsck.Issue('orphaned_source_dir', 'NEW', None, None),
+                   fsck.Issue('missing_file', filesystem_id, '5-msg.gpg',
+                              None)]
+        with patch.object(storage, 'secure_delete') as secure_delete:
+            fsck.repair(storage, issues)
+        secure_delete.assert_called_once_with([(filesystem_id, '1-msg.gpg'),
+                                               ('ORPHAN',)])
+        assert fsck.repair(storage, issues[-1:]) is None
+
+
+def test_is_encrypted():
+    assert fsck._is_encrypted('\x85\x02')  # old format, tag 1
+    assert fsck._is_encrypted('\xc1\x02')  # new format, tag 1
+    assert fsck._is_encrypted('\x8c\x0d')  # old format, tag 3
+    assert not fsck._is_encrypted('\xa3\x01')  # compressed data
+    assert not fsck._is_encrypted('plaintext')
+    assert not fsck._is_encrypted('')
+
+
+def test_manage_fsck(journalist_app, test_source, capsys):
+    with journalist_app.app_context():
+        current_app.storage.create_source_dir('ORPHAN')
+        _age(current_app.storage.path('ORPHAN'))
+    args = argparse.Namespace(jobs=1, batch_size=10, check_headers=False,
+                              skip_keyring=True, json=True, repair=True)
+
+    with patch('manage.app_context', journalist_app.app_context), \
+            patch('worker.enqueue_srm') as enqueue_srm:
+        enqueue_srm.return_value.id = 'job-id'
+        assert manage.fsck(args) == 1
+
+    out = [json.loads(line) for line in
+           capsys.readouterr()[0].splitlines()]
+    assert out[0] == {'type': 'orphaned_source_dir',
+                      'filesystem_id': 'ORPHAN', 'filename': None,
+                      'detail': '0 files'}
+    assert out[-1]['type'] == 'summary'
+    assert out[-1]['issues'] == {'orphaned_source_dir': 1}
+    assert out[-1]['repair_job'] == 'job-id'
@@ -24,6 +24,7 @@ import unittest
 
 from flask import request, session, render_template_string, render_template
 from flask_babel import gettext
+from mock import patch
 from werkzeug.datastructures import Headers
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
@@ -254,6 +255,45 @@ class TestI18N(unittest.TestCase):
             c.get('/')
             assert not_translated == gettext(not_translated)
 
+    def test_locale_tables_are_cached(self):
+        fake_config = self.get_fake_config()
+        fake_config.SUPPORTED_LOCALES = ['en_US', 'fr_FR', 'ar', 'nb_NO']
+        fake_config.TRANSLATION_DIRS = os.path.join(
+            os.path.dirname(i18n.__file__), 'translations')
+        app = journalist_app.create_app(fake_config)
+        headers = Headers([('Accept-Language', 'fr-FR,en;q=0.5')])
+        with app.test_request_context(headers=headers):
+            assert i18n.get_locale(fake_config) == 'fr_FR'
+        assert i18n.get_locale2name()['nb_NO'] == 'norsk'
+        assert i18n.get_text_direction('ar') == 'rtl'
+        assert i18n.get_text_direction('fr_FR') == 'ltr'
+
+        # Nothing is parsed again
+        with patch.object(i18n.core.Locale, 'parse') as parse, \
+                patch.object(i18n.core, 'negotiate_locale') as negotiate:
+            assert list(i18n.get_locale2name()) == \
+                fake_config.SUPPORTED_LOCALES
+            assert i18n.get_locale2name()['nb_NO'] == 'norsk'
+            assert i18n.get_text_direction('ar') == 'rtl'
+            assert i18n.get_text_direction('fr_FR') == 'ltr'
+            with app.test_request_context(headers=headers):
+                assert i18n.get_locale(fake_config) == 'fr_FR'
+        assert not parse.called
+        assert not negotiate.called
+
+    def test_lru_cache(self):
+        cache = i18n._LRUCache(2)
+        computed = []
+
+        def compute(key):
+            computed.append(key)
+            return key.upper()
+
+        for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+            assert cache.get(key, compute) == key.upper()
+        # b was the least recently used when c came in
+        assert computed == ['a', 'b', 'c', 'b']
+
     def test_locale_to_rfc_5646(self):
         assert i18n.locale_to_rfc_5646('en') == 'en'
         assert i18n.locale_to_rfc_5646('en-US') == 'en'
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 import random
 import unittest
@@ -16,6 +17,7 @@ import crypto_util
 import models
 import journalist
 import journalist_app as journalist_app_module
+import store
 import utils
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
@@ -130,6 +132,314 @@ def test_nonempty_replies_are_accepted(journalist_app, test_journo,
         assert EMPTY_REPLY_TEXT not in text
 
 
+def test_bulk_delete_enqueues_single_job(journalist_app, test_journo,
+                                         test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submissions = utils.db_helper.submit(source, 3)
+        filenames = [submission.filename for submission in submissions]
+        paths = [journalist_app.storage.path(test_source['filesystem_id'], fn)
+                 for fn in filenames]
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        with patch('worker.enqueue_srm') as enqueue_srm:
+            enqueue_srm.return_value.id = 'job-id'
+            resp = app.post(url_for('main.bulk'),
+                            data=dict(action='delete',
+                                      filesystem_id=test_source[
+                                          'filesystem_id'],
+                                      doc_names_selected=filenames))
+            assert resp.status_code == 302
+            enqueue_srm.assert_called_once_with(paths)
+            assert session['deletion_jobs'] == ['job-id']
+
+    # The rows are gone before the worker has run
+    with journalist_app.app_context():
+        assert Submission.query.filter(
+            Submission.filename.in_(filenames)).count() == 0
+
+
+def test_bulk_download_with_reply(journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = utils.db_helper.submit(source, 1)[0]
+        reply = utils.db_helper.reply(
+            Journalist.query.get(test_journo['id']), source, 1)[0]
+        filenames = [submission.filename, reply.filename]
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        resp = app.post(url_for('main.bulk'),
+                        data=dict(action='download',
+                                  filesystem_id=test_source['filesystem_id'],
+                                  doc_names_selected=filenames))
+        assert resp.status_code == 200
+        assert len(zipfile.ZipFile(StringIO(resp.data)).namelist()) == 2
+
+    with journalist_app.app_context():
+        assert Submission.query.get(submission.id).downloaded
+
+
+def test_delete_starred_source(journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        journalist_app_module.utils.make_star_true(
+            test_source['filesystem_id'])
+        db.session.commit()
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        with patch('worker.enqueue_srm') as enqueue_srm:
+            enqueue_srm.return_value.id = 'job-id'
+            resp = app.post(url_for('col.delete_single',
+                                    filesystem_id=test_source[
+                                        'filesystem_id']))
+        assert resp.status_code == 302
+
+    with journalist_app.app_context():
+        assert Source.query.get(test_source['source'].id) is None
+
+
+def test_regenerate_code_keeps_filenames(journalist_app, test_journo,
+                                         test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submissions = utils.db_helper.submit(source, 2)
+        filenames = [submission.filename for submission in submissions]
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        resp = app.post(url_for('main.regenerate_code'),
+                        data=dict(filesystem_id=test_source['filesystem_id']))
+        assert resp.status_code == 302
+
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        assert [item.filename for item in source.collection] == filenames
+        assert [item.display_filename for item in source.collection] == [
+            store.display_filename(fn, source.journalist_filename)
+            for fn in filenames]
+        for filename in filenames:
+            assert os.path.exists(journalist_app.storage.path(
+                test_source['filesystem_id'], filename))
+
+
+def test_download_single_submission_uses_display_filename(
+        journalist_app, test_journo, test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = utils.db_helper.submit(source, 1)[0]
+        filename = submission.filename
+        display_filename = submission.display_filename
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        resp = app.get(url_for('col.download_single_submission',
+                               filesystem_id=test_source['filesystem_id'],
+                               fn=filename))
+        assert resp.status_code == 200
+        assert display_filename in resp.headers['Content-Disposition']
+        # It's only marked as downloaded once it was sent
+        resp.get_data()
+
+    with journalist_app.app_context():
+        assert Submission.query.filter(
+            Submission.filename == filename).one().downloaded
+
+
+def _revalidate(app, url, resp):
+    return app.get(url, headers={'If-None-Match': resp.headers['ETag']})
+
+
+def test_index_and_col_are_conditional(journalist_app, test_journo,
+                                       test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        source.pending = False
+        utils.db_helper.submit(source, 1)
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        index_url = url_for('main.index')
+        col_url = url_for('col.col',
+                          filesystem_id=test_source['filesystem_id'])
+        index = app.get(index_url)
+        col = app.get(col_url)
+        assert index.status_code == col.status_code == 200
+        assert index.headers['ETag'] != col.headers['ETag']
+        assert 'private' in index.headers['Cache-Control']
+
+        resp = _revalidate(app, index_url, index)
+        assert resp.status_code == 304
+        assert resp.data == ''
+        assert _revalidate(app, col_url, col).status_code == 304
+
+        # Any change to the sources invalidates the pages
+        app.post(url_for('col.add_star',
+                         filesystem_id=test_source['filesystem_id']))
+        assert _revalidate(app, index_url, index).status_code == 200
+        assert _revalidate(app, col_url, col).status_code == 200
+
+
+def test_conditional_pages_are_per_session(journalist_app, test_journo,
+                                           test_admin, test_source):
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        index_url = url_for('main.index')
+        index = app.get(index_url)
+
+        # Flashed messages are shown even if nothing else changed
+        with app.session_transaction() as session:
+            session['_flashes'] = [('notification', 'Hello')]
+        resp = _revalidate(app, index_url, index)
+        assert resp.status_code == 200
+        assert 'Hello' in resp.data
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_admin['username'],
+                    test_admin['password'], test_admin['otp_secret'])
+        assert _revalidate(app, index_url, index).status_code == 200
+
+
+def _download_submission(journalist_app, test_journo, test_source,
+                         headers_list, method='get'):
+    """Log in and download a new submission once with each of the headers
+    in `headers_list`, with the HTTP `method`. Returns the responses, the
+    file's contents and whether the submission was marked as downloaded
+    after each one."""
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = utils.db_helper.submit(source, 1)[0]
+        filename = submission.filename
+        with open(journalist_app.storage.path(test_source['filesystem_id'],
+                                              filename), 'rb') as f:
+            contents = f.read()
+
+    responses = []
+    downloaded = []
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        for headers in headers_list:
+            responses.append(getattr(app, method)(
+                url_for('col.download_single_submission',
+                        filesystem_id=test_source['filesystem_id'],
+                        fn=filename), headers=headers))
+            # Read the response, as the client would
+            responses[-1].get_data()
+            with journalist_app.app_context():
+                downloaded.append(Submission.query.filter(
+                    Submission.filename == filename).one().downloaded)
+    return responses, contents, downloaded
+
+
+def test_download_single_submission_in_ranges(journalist_app, test_journo,
+                                              test_source):
+    responses, contents, downloaded = _download_submission(
+        journalist_app, test_journo, test_source,
+        [{'Range': 'bytes=0-9'}, None, {'Range': 'bytes=10-'}])
+    first, etag_request, rest = responses
+    etag = etag_request.headers['ETag']
+
+    assert first.status_code == 206
+    assert first.headers['Accept-Ranges'] == 'bytes'
+    assert first.headers['Content-Range'] == 'bytes 0-9/{}'.format(
+        len(contents))
+    assert first.get_data() == contents[:10]
+    # Not marked as downloaded before the last range
+    assert downloaded == [False, True, True]
+
+    assert rest.status_code == 206
+    assert rest.headers['ETag'] == etag
+    assert first.get_data() + rest.get_data() == contents
+
+
+def test_download_single_submission_if_range(journalist_app, test_journo,
+                                             test_source):
+    responses, contents, _ = _download_submission(
+        journalist_app, test_journo, test_source,
+        [{'Range': 'bytes=5-', 'If-Range': '"stale"'},
+         {'Range': 'bytes={}-'.format(10 ** 9)}])
+    stale, unsatisfiable = responses
+
+    # The file changed, so the whole of it is sent
+    assert stale.status_code == 200
+    assert stale.get_data() == contents
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers['Content-Range'] == 'bytes */{}'.format(
+        len(contents))
+
+
+def test_download_single_submission_with_x_sendfile(
+        journalist_app, test_journo, test_source):
+    journalist_app.use_x_sendfile = True
+    responses, _, downloaded = _download_submission(
+        journalist_app, test_journo, test_source,
+        [{'Range': 'bytes=0-9'}, {'Range': 'bytes=10-'}])
+
+    for response in responses:
+        # Apache serves the range from the file
+        assert response.headers['X-Sendfile'].endswith('-msg.gpg')
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert 'ETag' in response.headers
+    assert downloaded == [False, True]
+
+
+def test_head_single_submission_with_x_sendfile(
+        journalist_app, test_journo, test_source):
+    journalist_app.use_x_sendfile = True
+    responses, _, downloaded = _download_submission(
+        journalist_app, test_journo, test_source, [None], method='head')
+
+    assert responses[0].status_code == 200
+    assert responses[0].headers['X-Sendfile'].endswith('-msg.gpg')
+    assert downloaded == [False]
+
+
+def test_deletion_progress(journalist_app, test_journo):
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        # Before the session transaction, which pops the request context
+        progress_url = url_for('main.deletion_progress', job_id='job-id')
+        with app.session_transaction() as sess:
+            sess['deletion_jobs'] = ['job-id']
+
+        with patch('worker.job_progress') as job_progress:
+            job_progress.return_value = {'status': 'started',
+                                         'done': 1,
+                                         'total': 3}
+            resp = app.get(progress_url)
+            assert resp.status_code == 200
+            assert json.loads(resp.data) == job_progress.return_value
+            assert session['deletion_jobs'] == ['job-id']
+
+            job_progress.return_value = {'status': 'finished',
+                                         'done': 3,
+                                         'total': 3}
+            resp = app.get(progress_url)
+            assert resp.status_code == 200
+            assert session['deletion_jobs'] == []
+
+
+def test_deletion_progress_of_other_jobs_is_hidden(journalist_app,
+                                                   test_journo):
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'],
+                    test_journo['password'], test_journo['otp_secret'])
+        with patch('worker.job_progress') as job_progress:
+            resp = app.get(url_for('main.deletion_progress', job_id='job-id'))
+            assert resp.status_code == 404
+            assert not job_progress.called
+
+
 def test_unauthorized_access_redirects_to_login(journalist_app):
     with journalist_app.test_client() as app:
         with InstrumentedApp(journalist_app) as ins:
@@ -309,6 +619,24 @@ def test_admin_index(journalist_app, test_admin):
         assert "Admin Interface" in text
 
 
+def test_admin_worker_stats(journalist_app, test_admin):
+    with journalist_app.test_client() as app:
+        _login_user(app, test_admin['username'], test_admin['password'],
+                    test_admin['otp_secret'])
+        resp = app.get('/admin/worker-stats')
+        assert resp.status_code == 200
+        stats = json.loads(resp.data)
+        assert set(stats['depth']) == {'high', 'default', 'low'}
+
+
+def test_worker_stats_requires_admin(journalist_app, test_journo):
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        resp = app.get('/admin/worker-stats')
+        assert resp.status_code == 302
+
+
 class TestJournalistApp(TestCase):
 
     # A method required by flask_testing.TestCase
@@ -1100,8 +1428,7 @@ class TestJournalistApp(TestCase):
         self._delete_collection_setup()
 
         # Encrypted documents exists
-        dir_source_docs = os.path.join(config.STORE_DIR,
-                                       self.source.filesystem_id)
+        dir_source_docs = current_app.storage.path(self.source.filesystem_id)
         self.assertTrue(os.path.exists(dir_source_docs))
 
         job = journalist_app_module.utils.delete_collection(
@@ -1141,7 +1468,8 @@ class TestJournalistApp(TestCase):
                         source.journalist_filename,
                         "%s_%s" % (filename.split('-')[0],
                                    source.last_updated.date()),
-                        filename
+                        store.display_filename(filename,
+                                               source.journalist_filename)
                     ))
                 )
 
@@ -1159,7 +1487,8 @@ class TestJournalistApp(TestCase):
                         source.journalist_designation,
                         "%s_%s" % (filename.split('-')[0],
                                    source.last_updated.date()),
-                        filename
+                        store.display_filename(filename,
+                                               source.journalist_filename)
                     ))
 
     def _bulk_download_setup(self):
@@ -1205,7 +1534,7 @@ class TestJournalistApp(TestCase):
                         self.source0.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source0.last_updated.date()),
-                        submission.filename
+                        submission.display_filename
                     ))
                 )
         for submission in self.not_downloaded1:
@@ -1216,7 +1545,7 @@ class TestJournalistApp(TestCase):
                         self.source1.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source1.last_updated.date()),
-                        submission.filename
+                        submission.display_filename
                     ))
                 )
 
@@ -1229,7 +1558,7 @@ class TestJournalistApp(TestCase):
                         self.source0.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source0.last_updated.date()),
-                        submission.filename
+                        submission.display_filename
                     ))
 
         for submission in self.downloaded1:
@@ -1240,7 +1569,7 @@ class TestJournalistApp(TestCase):
                         self.source1.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source1.last_updated.date()),
-                        submission.filename
+                        submission.display_filename
                     ))
 
     def test_download_all_selected_sources(self):
@@ -1272,7 +1601,7 @@ class TestJournalistApp(TestCase):
                         self.source1.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source1.last_updated.date()),
-                        submission.filename)
+                        submission.display_filename)
                     )
                 )
 
@@ -1285,7 +1614,7 @@ class TestJournalistApp(TestCase):
                         self.source0.journalist_designation,
                         "%s_%s" % (submission.filename.split('-')[0],
                                    self.source0.last_updated.date()),
-                        submission.filename)
+                        submission.display_filename)
                     )
 
     def test_single_source_is_successfully_starred(self):
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import time
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import maintenance
+
+from flask import current_app
+from mock import patch
+from sqlalchemy import text
+
+from db import db
+from models import Journalist, JournalistLoginAttempt, Source, Submission
+
+
+def _touch(path, age=0):
+    open(path, 'a').close()
+    old = time.time() - age
+    os.utime(path, (old, old))
+    return path
+
+
+def test_clean_upload_spools(tmpdir):
+    stale = _touch(str(tmpdir.join('A' * 43 + '.aes')), age=2 * 24 * 3600)
+    fresh = _touch(str(tmpdir.join('B' * 43 + '.aes')))
+    other = _touch(str(tmpdir.join('unrelated')), age=2 * 24 * 3600)
+
+    assert maintenance.clean_upload_spools(str(tmpdir)) == 1
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    assert os.path.exists(other)
+
+
+def test_prune_login_attempts(journalist_app, test_journo):
+    with journalist_app.app_context():
+        journalist = Journalist.query.get(test_journo['id'])
+        old = JournalistLoginAttempt(journalist)
+        old.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+        recent = JournalistLoginAttempt(journalist)
+        db.session.add_all([old, recent])
+        db.session.commit()
+        recent_id = recent.id
+
+        assert maintenance.prune_login_attempts() == 1
+
+        assert [a.id for a in JournalistLoginAttempt.query.all()] == \
+            [recent_id]
+
+
+def test_build_scheduler(config, journalist_app, tmpdir):
+    config.SCHEDULER_STATE_DIR = str(tmpdir)
+    sched = maintenance.build_scheduler(config, journalist_app)
+
+    assert sorted(sched.jobs) == ['clean-exports', 'clean-tmp',
+                                  'clean-upload-spools', 'prune-changes',
+                                  'prune-login-attempts', 'vacuum-db']
+
+    for name in ('prune-changes', 'prune-login-attempts', 'vacuum-db'):
+        assert sched.run(sched.jobs[name])
+        assert sched.jobs[name].last_status == 'success'
+
+
+def test_build_scheduler_with_retention(config, journalist_app, tmpdir):
+    config.SCHEDULER_STATE_DIR = str(tmpdir)
+    config.RETENTION_DOWNLOADED_SUBMISSION_DAYS = 30
+    sched = maintenance.build_scheduler(config, journalist_app)
+
+    assert 'retention' in sched.jobs
+
+
+def test_upgrade_db(journalist_app, test_source):
+    with journalist_app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_submissions_downloaded_at'))
+            # sqlite can't drop columns, so recreate the table without it
+            connection.execute(text(
+                'CREATE TABLE old_submissions AS SELECT id, source_id, '
+                'filename, size, downloaded FROM submissions'))
+            connection.execute(text('DROP TABLE submissions'))
+            connection.execute(text(
+                'ALTER TABLE old_submissions RENAME TO submissions'))
+            connection.execute(text(
+                "INSERT INTO submissions VALUES (1, 1, '1-msg.gpg', 1, 1)"))
+
+        assert maintenance.upgrade_db() == [
+            'submissions.downloaded_at', 'submissions.state',
+            'submissions.digest', 'ix_submissions_downloaded_at']
+        assert maintenance.upgrade_db() == []
+
+        submission = Submission.query.get(1)
+        assert submission.downloaded_at is not None
+
+
+def test_reap_pending_sources(journalist_app, test_source):
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+    with journalist_app.app_context():
+        storage = current_app.storage
+        idle = []
+        for i in range(3):
+            source = Source('IDLE{}'.format(i), 'idle {}'.format(i))
+            source.last_updated = old
+            storage.create_source_dir(source.filesystem_id)
+            idle.append(source)
+        recent = Source('RECENT', 'recent')
+        submitted = Source.query.get(test_source['source'].id)
+        submitted.pending = False
+        submitted.last_updated = old
+        db.session.add_all(idle + [recent])
+        db.session.commit()
+        filesystem_id = submitted.filesystem_id
+
+        with patch.object(storage, 'secure_delete') as secure_delete, \
+                patch.object(current_app.crypto_util, 'source_keys',
+                             return_value={'IDLE1': 'FINGERPRINT'}), \
+                patch.object(current_app.crypto_util,
+                             'delete_reply_keypair') as delete_keypair:
+            assert maintenance.reap_pending_sources(7, batch_size=2,
+                                                    pause=0) == 3
+
+        assert sorted(s.filesystem_id for s in Source.query.all()) == sorted(
+            ['RECENT', filesystem_id])
+        assert [call[0][0] for call in secure_delete.call_args_list] == [
+            [('IDLE0',), ('IDLE1',)], [('IDLE2',)]]
+        delete_keypair.assert_called_once_with('IDLE1')
+
+
+def test_build_scheduler_with_reaper(config, journalist_app, tmpdir):
+    config.SCHEDULER_STATE_DIR = str(tmpdir)
+    config.PENDING_SOURCE_MAX_IDLE_DAYS = 7
+    sched = maintenance.build_scheduler(config, journalist_app)
+
+    assert 'reap-pending-sources' in sched.jobs
+
+
+def test_build_scheduler_with_async_submissions(config, journalist_app,
+                                                tmpdir):
+    config.SCHEDULER_STATE_DIR = str(tmpdir)
+    config.ASYNC_SUBMISSIONS = True
+    sched = maintenance.build_scheduler(config, journalist_app)
+
+    # The spool directory is only created by the first submission
+    assert sched.run(sched.jobs['clean-submission-spool'])
+    assert sched.jobs['clean-submission-spool'].last_status == 'success'
@@ -4,6 +4,7 @@ import argparse
 import os
 from os.path import abspath, dirname, realpath
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from flask import current_app
 from sdconfig import config
 import logging
 import manage
@@ -18,7 +19,7 @@ import utils
 import journalist_app
 
 from db import db
-from models import Journalist
+from models import Journalist, Submission
 
 
 YUBIKEY_HOTP = ['cb a0 5f ad 41 a2 ff 4e eb 53 56 3a 1b f7 23 2e ce fc dc',
@@ -202,3 +203,42 @@ class TestManage(object):
         manage.setup_verbosity(args)
         manage.clean_tmp(args)
         assert 'FILE removed' in caplog.text
+
+    def test_migrate_store(self, caplog):
+        legacy = [os.path.join(config.STORE_DIR, 'SOURCE{}'.format(i))
+                  for i in range(3)]
+        for path in legacy:
+            os.mkdir(path)
+            open(os.path.join(path, '1-abc-msg.gpg'), 'a').close()
+        args = argparse.Namespace(batch_size=2, pause=0,
+                                  verbose=logging.DEBUG)
+        manage.setup_verbosity(args)
+
+        assert manage.migrate_store(args) == 0
+
+        assert 'Done, 3 sources migrated' in caplog.text
+        for i, path in enumerate(legacy):
+            assert not os.path.exists(path)
+            assert os.path.exists(current_app.storage.path(
+                'SOURCE{}'.format(i), '1-abc-msg.gpg'))
+            assert current_app.storage.path('SOURCE{}'.format(i)) != path
+
+    def test_migrate_filenames(self, caplog):
+        source, _ = utils.db_helper.init_source()
+        legacy_filename = '1-{}-msg.gpg'.format(source.journalist_filename)
+        open(current_app.storage.path(source.filesystem_id, legacy_filename),
+             'w').close()
+        submission = Submission(source, legacy_filename)
+        db.session.add(submission)
+        db.session.commit()
+        submission_id = submission.id
+        filesystem_id = source.filesystem_id
+        args = argparse.Namespace(verbose=logging.DEBUG)
+        manage.setup_verbosity(args)
+
+        assert manage.migrate_filenames(args) == 0
+
+        assert 'Done, 1 files migrated, 0 failed' in caplog.text
+        assert Submission.query.get(submission_id).filename == '1-msg.gpg'
+        assert os.path.exists(
+            current_app.storage.path(filesystem_id, '1-msg.gpg'))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+
+from flask import current_app
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import retention
+import utils
+
+from db import db
+from models import Source, Submission
+
+
+def _policy(tmpdir, **kwargs):
+    settings = {'downloaded_submission_days': None,
+                'inactive_source_days': None,
+                'batch_size': 2,
+                'audit_log': str(tmpdir.join('retention.log'))}
+    settings.update(kwargs)
+    return retention.Policy(**settings)
+
+
+def _age(days):
+    return datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+
+def test_policy_from_config(config):
+    assert not retention.Policy.from_config(config).enabled
+    config.RETENTION_INACTIVE_SOURCE_DAYS = 30
+    policy = retention.Policy.from_config(config)
+    assert policy.enabled
+    assert policy.batch_size == retention.DEFAULT_BATCH_SIZE
+
+
+def test_mark_downloaded_keeps_first_download_time(journalist_app,
+                                                   test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = utils.db_helper.submit(source, 1)[0]
+        assert submission.downloaded_at is None
+
+        submission.mark_downloaded()
+        first = submission.downloaded_at
+        submission.mark_downloaded()
+
+        assert submission.downloaded
+        assert submission.downloaded_at == first
+
+
+def test_expire_downloaded_submissions(journalist_app, test_source, tmpdir):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submissions = utils.db_helper.submit(source, 5)
+        for submission in submissions[:3]:
+            submission.downloaded = True
+            submission.downloaded_at = _age(40)
+        submissions[3].mark_downloaded()
+        db.session.commit()
+        kept_ids = [submissions[3].id, submissions[4].id]
+        expired = [(source.filesystem_id, submission.filename)
+                   for submission in submissions[:3]]
+        policy = _policy(tmpdir, downloaded_submission_days=30)
+
+        summary = retention.apply(policy, dry_run=True)
+
+        assert summary['submissions']['count'] == 3
+        assert len(summary['candidates']['submissions']) == 3
+        assert Submission.query.count() == 5
+
+        with patch.object(current_app.storage, 'secure_delete') as delete:
+            delete.return_value.id = 'job-id'
+            summary = retention.apply(policy)
+
+        assert summary['submissions']['count'] == 3
+        assert len(summary['jobs']) == 2
+        assert [call[0][0] for call in delete.call_args_list] == [
+            expired[:2], expired[2:]]
+        assert sorted(s.id for s in Submission.query.all()) == kept_ids
+
+        audit = [json.loads(line) for line in
+                 tmpdir.join('retention.log').readlines()]
+        assert [entry['dry_run'] for entry in audit] == [True, False]
+        # The audit log doesn't say what was deleted
+        assert 'candidates' not in audit[0]
+        assert source.filesystem_id not in tmpdir.join(
+            'retention.log').read()
+
+
+def test_expire_inactive_sources(journalist_app, test_source, tmpdir):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        utils.db_helper.submit(source, 1)
+        source.pending = False
+        source.last_updated = _age(100)
+        pending = Source('PENDING', 'pending source')
+        pending.last_updated = _age(100)
+        active = Source('ACTIVE', 'active source')
+        active.pending = False
+        db.session.add_all([pending, active])
+        db.session.commit()
+        filesystem_id = source.filesystem_id
+        policy = _policy(tmpdir, inactive_source_days=90)
+
+        with patch.object(current_app.storage, 'secure_delete') as delete, \
+                patch.object(current_app.crypto_util,
+                             'delete_reply_keypair') as delete_keypair:
+            delete.return_value.id = 'job-id'
+            summary = retention.apply(policy)
+
+        assert summary['sources']['count'] == 1
+        delete.assert_called_once_with([(filesystem_id,)])
+        delete_keypair.assert_called_once_with(filesystem_id)
+        assert sorted(s.filesystem_id for s in Source.query.all()) == [
+            'ACTIVE', 'PENDING']
+        assert Submission.query.count() == 0
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import rm
+
+from rm import SecureDeleter
+
+
+def _make_file(path, contents='x' * 4096):
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+
+def test_delete_file(tmpdir):
+    path = _make_file(str(tmpdir.join('1-abc-msg.gpg')))
+
+    SecureDeleter(passes=1).delete(path)
+
+    assert not os.path.exists(path)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_delete_file_overwrites_every_pass(tmpdir):
+    path = _make_file(str(tmpdir.join('1-abc-msg.gpg')))
+    deleter = SecureDeleter(passes=3, chunk_size=1024)
+
+    with patch('os.fdatasync') as fdatasync:
+        deleter.delete(path)
+
+    assert deleter.bytes_written == 3 * 4096
+    # one sync per pass, not per chunk
+    assert fdatasync.call_count == 3
+
+
+def test_delete_file_renames_before_unlink(tmpdir):
+    path = _make_file(str(tmpdir.join('1-abc-msg.gpg')))
+    unlinked = []
+    real_unlink = os.unlink
+
+    def unlink(p):
+        unlinked.append(p)
+        real_unlink(p)
+
+    with patch('os.unlink', side_effect=unlink):
+        SecureDeleter(passes=1).delete(path)
+
+    assert len(unlinked) == 1
+    assert unlinked[0] != path
+    assert len(os.path.basename(unlinked[0])) == len(os.path.basename(path))
+
+
+def test_delete_tree(tmpdir):
+    top = tmpdir.mkdir('source')
+    _make_file(str(top.join('1-abc-msg.gpg')))
+    nested = top.mkdir('nested')
+    _make_file(str(nested.join('2-abc-doc.gz.gpg')))
+    os.symlink(str(nested), str(top.join('link')))
+
+    SecureDeleter(passes=1).delete(str(top))
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_delete_empty_file(tmpdir):
+    path = _make_file(str(tmpdir.join('empty')), contents='')
+    deleter = SecureDeleter(passes=2)
+
+    deleter.delete(path)
+
+    assert not os.path.exists(path)
+    assert deleter.bytes_written == 0
+
+
+def test_passes_must_be_positive():
+    with pytest.raises(ValueError):
+        SecureDeleter(passes=0)
+
+
+def test_throttle(tmpdir):
+    path = _make_file(str(tmpdir.join('1-abc-msg.gpg')))
+    deleter = SecureDeleter(passes=2, max_bytes_per_second=1024,
+                            chunk_size=1024)
+
+    with patch('time.sleep') as sleep:
+        deleter.delete(path)
+
+    # 8 KiB at 1 KiB/s: every chunk after the first has to wait
+    assert sleep.call_count >= 7
+    assert sum(call[0][0] for call in sleep.call_args_list) >= 6
+
+
+def test_from_config():
+    class Config(object):
+        SECURE_DELETE_PASSES = 1
+        SECURE_DELETE_MAX_BYTES_PER_SECOND = 4096
+
+    deleter = SecureDeleter.from_config(Config())
+    assert deleter.passes == 1
+    assert deleter.max_bytes_per_second == 4096
+
+    deleter = SecureDeleter.from_config(object())
+    assert deleter.passes == SecureDeleter.DEFAULT_PASSES
+    assert deleter.max_bytes_per_second is None
+
+
+def test_srm_batch_skips_missing_paths(tmpdir):
+    present = _make_file(str(tmpdir.join('1-abc-msg.gpg')))
+    missing = str(tmpdir.join('2-abc-msg.gpg'))
+
+    assert rm.srm_batch([present, missing]) == 'success'
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_srm_batch_compacts_packs(tmpdir):
+    from store_pack import Pack
+    pack = Pack(str(tmpdir))
+    pack.append('1-msg.gpg', 'deleted')
+    pack.append('2-msg.gpg', 'kept')
+    pack.remove('1-msg.gpg')
+
+    assert rm.srm_batch([], compact=[str(tmpdir)]) == 'success'
+    assert 'deleted' not in tmpdir.join('_PACK').read()
+    assert pack.read('2-msg.gpg') == 'kept'
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import threading
+import time
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import scheduler
+
+from scheduler import Daily, Interval, Scheduler
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_interval_next_run():
+    schedule = Interval(60)
+
+    assert schedule.next_run(100, 130) == 160
+    # a run that was missed is caught up on immediately
+    assert schedule.next_run(100, 500) == 500
+
+
+def test_interval_first_run_is_spread_out():
+    schedule = Interval(60)
+
+    for _ in range(10):
+        assert 1000 <= schedule.next_run(None, 1000) <= 1060
+
+
+def test_daily_next_run():
+    schedule = Daily(hour=4, minute=30)
+    now = time.mktime(datetime.datetime(2018, 3, 1, 12, 0).timetuple())
+
+    next_run = datetime.datetime.fromtimestamp(schedule.next_run(None, now))
+
+    assert next_run == datetime.datetime(2018, 3, 2, 4, 30)
+
+
+def test_daily_catches_up_on_a_missed_run():
+    schedule = Daily(hour=4, minute=30)
+    now = time.mktime(datetime.datetime(2018, 3, 1, 12, 0).timetuple())
+    yesterday = time.mktime(datetime.datetime(2018, 2, 28, 4, 30).timetuple())
+    today = time.mktime(datetime.datetime(2018, 3, 1, 4, 30).timetuple())
+
+    # Down at 4:30 today
+    assert schedule.next_run(yesterday, now) == now
+    # Ran today already
+    assert datetime.datetime.fromtimestamp(
+        schedule.next_run(today, now)) == datetime.datetime(2018, 3, 2, 4, 30)
+
+
+def test_register_carries_on_from_the_saved_state(tmpdir):
+    clock = FakeClock(time.mktime(
+        datetime.datetime(2018, 3, 1, 4, 30).timetuple()))
+    sched = Scheduler(str(tmpdir), clock=clock)
+    job = sched.register('job', Daily(hour=4, minute=30), lambda: None)
+    sched.run(job)
+
+    # The worker restarts the next day, after the time of the run
+    clock.now += 25 * 60 * 60
+    restarted = Scheduler(str(tmpdir), clock=clock)
+    job = restarted.register('job', Daily(hour=4, minute=30), lambda: None)
+    assert job.runs == 1
+    assert job.next_run == clock.now
+
+
+def test_run_pending_runs_due_jobs(tmpdir):
+    clock = FakeClock()
+    sched = Scheduler(str(tmpdir), clock=clock)
+    calls = []
+    job = sched.register('job', Interval(60, jitter=0),
+                         lambda: calls.append(1))
+
+    clock.now = job.next_run
+    sched.run_pending(wait=True)
+    sched.run_pending(wait=True)
+    assert calls == [1]
+
+    clock.now += 60
+    sched.run_pending(wait=True)
+    assert calls == [1, 1]
+
+    state = scheduler.load_state(str(tmpdir))
+    assert state['job']['runs'] == 2
+    assert state['job']['last_status'] == 'success'
+    assert state['job']['next_run'] == clock.now + 60
+
+
+def test_failed_job_is_recorded(tmpdir):
+    sched = Scheduler(str(tmpdir))
+
+    def fail():
+        raise RuntimeError('oops')
+
+    job = sched.register('failing', Interval(60), fail)
+    assert sched.run(job)
+
+    assert scheduler.load_state(str(tmpdir))['failing']['last_status'] == \
+        'failed'
+
+
+def test_job_does_not_overlap_itself(tmpdir):
+    sched = Scheduler(str(tmpdir))
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+
+    job = sched.register('slow', Interval(60), slow)
+    thread = threading.Thread(target=sched.run, args=(job,))
+    thread.start()
+    started.wait()
+
+    assert job.status()['running']
+    assert not sched.run(job)
+
+    release.set()
+    thread.join()
+    assert calls == [1]
+
+
+def test_job_does_not_run_while_locked_by_another_scheduler(tmpdir):
+    first = Scheduler(str(tmpdir))
+    second = Scheduler(str(tmpdir))
+    calls = []
+    job = second.register('job', Interval(60), lambda: calls.append(1))
+
+    with first._file_lock(job) as locked:
+        assert locked
+        assert not second.run(job)
+    assert second.run(job)
+
+    assert calls == [1]
+
+
+def test_load_state_without_state_file(tmpdir):
+    assert scheduler.load_state(str(tmpdir.join('missing'))) == {}
@@ -3,19 +3,22 @@ import gzip
 import json
 import re
 import subprocess
+import threading
 
 from cStringIO import StringIO
-from flask import session, escape, current_app
+from flask import session, escape, current_app, g
 from mock import patch, ANY
+from multiprocessing.pool import ThreadPool
 
 import crypto_util
 import source
+import store
 import utils
 import version
 
 from db import db
-from models import Source
-from source_app import main as source_app_main
+from models import Reply, Source
+from source_app import create_app, main as source_app_main
 from utils.db_helper import new_codename
 from utils.instrument import InstrumentedApp
 
@@ -395,6 +398,49 @@ def test_delete_all_successfully_deletes_replies(source_app):
         assert "All replies have been deleted" in text
 
 
+def test_lookup_decrypts_a_page_of_replies(config):
+    config.REPLIES_PER_PAGE = 2
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        journalist, _ = utils.db_helper.init_journalist()
+        source, codename = utils.db_helper.init_source_without_keypair()
+        for i in range(1, 4):
+            [count] = source.allocate_interactions()
+            filename = store.stored_filename(count, 'reply')
+            current_app.storage.put(source.filesystem_id, filename,
+                                    StringIO('Reply {}'.format(i)))
+            db.session.add(Reply(journalist, source, filename))
+        db.session.commit()
+
+    def decrypt(self, secret, ciphertext, passphrase=None):
+        assert secret == codename
+        assert passphrase == 'passphrase'
+        return ciphertext.read()
+
+    with app.test_client() as client:
+        client.post('/login', data=dict(codename=codename))
+        with patch.object(crypto_util.CryptoUtil, 'reply_passphrase',
+                          return_value='passphrase') as reply_passphrase, \
+                patch.object(crypto_util.CryptoUtil, 'decrypt',
+                             autospec=True, side_effect=decrypt), \
+                patch.object(app.storage, 'stat') as stat:
+            text = client.get('/lookup').data.decode('utf-8')
+            # The newest replies, dated from the database
+            assert 'Reply 3' in text
+            assert 'Reply 2' in text
+            assert 'Reply 1' not in text
+            assert 'Older replies' in text
+            assert reply_passphrase.call_count == 1
+            assert not stat.called
+
+            text = client.get('/lookup?page=2').data.decode('utf-8')
+            assert 'Reply 1' in text
+            assert 'Reply 2' not in text
+            assert 'Newer replies' in text
+            assert 'Older replies' not in text
+
+
 def test_delete_all_replies_already_deleted(source_app):
     with source_app.app_context():
         journalist, _ = utils.db_helper.init_journalist()
@@ -592,3 +638,98 @@ def test_csrf_error_page(config, source_app):
         resp = app.post('/create', follow_redirects=True)
         text = resp.data.decode('utf-8')
         assert 'Your session timed out due to inactivity' in text
+
+
+def test_allocate_interactions(source_app, test_source):
+    with source_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        assert source.allocate_interactions() == [1]
+        assert source.allocate_interactions(2) == [2, 3]
+        assert source.interaction_count == 3
+        # The ORM doesn't write its copy back over the database's
+        source.flagged = True
+        db.session.commit()
+        assert db.session.query(Source.interaction_count).filter(
+            Source.id == source.id).scalar() == 3
+
+
+def test_allocate_interactions_concurrently(source_app, test_source):
+    source_id = test_source['source'].id
+    allocated = []
+
+    def allocate():
+        with source_app.app_context():
+            source = Source.query.get(source_id)
+            for _ in range(5):
+                allocated.extend(source.allocate_interactions())
+
+    threads = [threading.Thread(target=allocate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(allocated) == list(range(1, 21))
+
+
+def test_submit_multiple_files(source_app):
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        _dummy_submission(app)
+        with patch('source_app.utils.ThreadPool', wraps=ThreadPool) as pool:
+            resp = app.post('/submit', data=dict(
+                msg="This is a test.",
+                fh=[(StringIO('First document'), 'first.txt'),
+                    (StringIO('Second document'), 'second.txt')],
+            ), follow_redirects=True)
+        assert resp.status_code == 200
+        text = resp.data.decode('utf-8')
+        assert 'Thanks! We received your message and documents' in text
+        # The message and both documents were encrypted concurrently
+        pool.assert_called_once_with(3)
+
+        source = Source.query.filter(
+            Source.filesystem_id == g.filesystem_id).one()
+        assert [s.filename for s in source.submissions] == [
+            '1-msg.gpg', '2-msg.gpg', '3-doc.gz.gpg', '4-doc.gz.gpg']
+        for submission in source.submissions[2:]:
+            assert current_app.storage.stat(
+                g.filesystem_id, submission.filename).size == submission.size
+
+
+def test_submit_duplicate_document(source_app):
+    source_app.submission_digest_key = 'secret'
+    with source_app.test_client() as app:
+        new_codename(app, session)
+        resp = app.post('/submit', data=dict(
+            msg='',
+            fh=(StringIO('A document'), 'document.txt'),
+        ), follow_redirects=True)
+        assert 'already submitted' not in resp.data.decode('utf-8')
+
+        with patch.object(source_app.storage, 'secure_delete') as delete:
+            resp = app.post('/submit', data=dict(
+                msg='',
+                fh=[(StringIO('A document'), 'again.txt'),
+                    (StringIO('Another document'), 'another.txt')],
+            ), follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'You had already submitted this document' in \
+            resp.data.decode('utf-8')
+        delete.assert_called_once_with([(g.filesystem_id, '2-doc.gz.gpg')])
+
+        source = Source.query.filter(
+            Source.filesystem_id == g.filesystem_id).one()
+        assert [s.filename for s in source.submissions] == [
+            '1-doc.gz.gpg', '3-doc.gz.gpg']
+        assert all(len(s.digest) == 64 for s in source.submissions)
+
+
+def test_submission_digest_is_keyed_by_source():
+    digests = []
+    for key, filesystem_id in (('key', 'A'), ('key', 'B'), ('other', 'A')):
+        digest = store.submission_digest(key, filesystem_id)
+        stream = store.DigestingStream(StringIO('A document'), digest)
+        assert stream.read() == 'A document'
+        digests.append(digest.hexdigest())
+    assert len(set(digests)) == 3
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from cStringIO import StringIO
+from flask import current_app, session
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import fsck
+import spool
+import utils
+
+from crypto_util import CryptoException
+from db import db
+from models import Source, Submission
+from source_app import create_app
+from utils.db_helper import new_codename
+from test_journalist import _login_user
+
+
+@pytest.fixture(scope='function')
+def async_source_app(config):
+    config.ASYNC_SUBMISSIONS = True
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _spool(app, config, data, filename='document.txt'):
+    with app.app_context():
+        spool_file = spool.spool_from_config(config).open(filename)
+        spool_file.write(data)
+        return spool_file.finish()
+
+
+def test_async_submission(async_source_app):
+    with async_source_app.test_client() as app:
+        new_codename(app, session)
+        with patch('spool.worker.enqueue') as enqueue:
+            resp = app.post('/submit', data=dict(
+                msg='',
+                fh=(StringIO('This is a test'), 'test.txt'),
+            ), follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'being encrypted' in resp.data.decode('utf-8')
+
+        submission = Submission.query.one()
+        assert submission.processing
+        filesystem_id = submission.source.filesystem_id
+        assert not os.path.exists(current_app.storage.path(
+            filesystem_id, submission.filename))
+
+        # Only the submission and where it's spooled are handed to the job
+        (job, submission_id, path), _ = enqueue.call_args
+        assert job is spool.store_submission
+        assert submission.size == os.path.getsize(path)
+        with open(path, 'rb') as f:
+            assert 'This is a test' not in f.read()
+
+        job(submission_id, path)
+
+        submission = Submission.query.one()
+        assert submission.state is None
+        assert not os.path.exists(path)
+        assert submission.size == current_app.storage.stat(
+            filesystem_id, submission.filename).size
+
+        resp = app.get('/lookup')
+        assert 'being encrypted' not in resp.data.decode('utf-8')
+
+
+def test_spooled_document_is_encrypted(journalist_app, config):
+    config.ASYNC_SUBMISSIONS = True
+    spooled = _spool(journalist_app, config, 'To the journalist')
+
+    with open(spooled.path, 'rb') as f:
+        assert fsck._is_encrypted(f.read(2))
+    assert spooled.size == os.path.getsize(spooled.path)
+
+
+def test_spool_fails_without_the_journalist_key(journalist_app, config):
+    config.ASYNC_SUBMISSIONS = True
+    config.JOURNALIST_KEY = 'F' * 40
+    with pytest.raises(CryptoException):
+        _spool(journalist_app, config, 'x' * 1024 * 1024)
+
+    assert os.listdir(spool.spool_dir(config)) == []
+
+
+def test_interrupted_upload_is_removed(journalist_app, config):
+    config.ASYNC_SUBMISSIONS = True
+    with journalist_app.app_context():
+        spool_file = spool.spool_from_config(config).open('document.txt')
+        spool_file.write('Only the beginning')
+        spool_file.close()
+
+    assert not os.path.exists(spool_file.path)
+    assert os.listdir(spool.spool_dir(config)) == []
+
+
+def test_store_deleted_submission(journalist_app, config):
+    config.ASYNC_SUBMISSIONS = True
+    spooled = _spool(journalist_app, config, 'deleted')
+
+    with journalist_app.app_context():
+        spool.store_submission(1, spooled.path)
+
+    assert not os.path.exists(spooled.path)
+
+
+def test_store_lost_spool(journalist_app, test_source, config):
+    config.ASYNC_SUBMISSIONS = True
+    spooled = _spool(journalist_app, config, 'lost')
+    os.remove(spooled.path)
+
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        submission = Submission(source, '1-doc.gz.gpg', size=4)
+        submission.state = Submission.PROCESSING
+        db.session.add(submission)
+        db.session.commit()
+
+        with pytest.raises(IOError):
+            spool.store_submission(submission.id, spooled.path)
+
+        assert Submission.query.one().failed
+
+
+def test_journalist_processing_submission(journalist_app, test_journo,
+                                          test_source):
+    with journalist_app.app_context():
+        source = Source.query.get(test_source['source'].id)
+        stored = utils.db_helper.submit(source, 1)[0]
+        processing = Submission(source, '2-doc.gz.gpg', size=10)
+        processing.state = Submission.PROCESSING
+        db.session.add(processing)
+        db.session.commit()
+        stored_filename = stored.filename
+    filesystem_id = test_source['filesystem_id']
+
+    with journalist_app.test_client() as app:
+        _login_user(app, test_journo['username'], test_journo['password'],
+                    test_journo['otp_secret'])
+        resp = app.get('/col/' + filesystem_id)
+        assert 'Processing' in resp.data.decode('utf-8')
+
+        resp = app.get('/col/{}/2-doc.gz.gpg'.format(filesystem_id),
+                       follow_redirects=True)
+        assert "hasn&#39;t been stored yet" in resp.data.decode('utf-8')
+
+        resp = app.post('/col/process', data=dict(
+            action='download-all', cols_selected=[filesystem_id]))
+        assert resp.status_code == 200
+        assert Submission.query.filter(
+            Submission.downloaded).one().filename == stored_filename
+
+
+def test_async_submission_of_several_files(async_source_app):
+    with async_source_app.test_client() as app:
+        new_codename(app, session)
+        with patch('spool.worker.enqueue') as enqueue:
+            resp = app.post('/submit', data=dict(
+                msg='A message',
+                fh=[(StringIO('First document'), 'first.txt'),
+                    (StringIO('Second document'), 'second.txt')],
+            ), follow_redirects=True)
+        assert resp.status_code == 200
+
+        submissions = Submission.query.order_by(Submission.id).all()
+        assert [s.state for s in submissions] == [
+            None, Submission.PROCESSING, Submission.PROCESSING]
+        assert [call[0][1] for call in enqueue.call_args_list] == [
+            submission.id for submission in submissions[1:]]
+
+
+def test_async_duplicate_submission(async_source_app):
+    async_source_app.submission_digest_key = 'secret'
+    with async_source_app.test_client() as app:
+        new_codename(app, session)
+        with patch('spool.worker.enqueue') as enqueue:
+            for _ in range(2):
+                resp = app.post('/submit', data=dict(
+                    msg='',
+                    fh=(StringIO('A document'), 'document.txt'),
+                ), follow_redirects=True)
+        assert 'You had already submitted this document' in \
+            resp.data.decode('utf-8')
+
+        # Only the first one is encrypted, the second spool file is gone
+        assert Submission.query.count() == 1
+        assert enqueue.call_count == 1
+        spool_dir = spool.spool_dir(async_source_app.sdconfig)
+        assert os.listdir(spool_dir) == [
+            os.path.basename(enqueue.call_args[0][2])]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import os
+import time
+
+from flask import current_app
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import manage
+import stats
+import utils
+
+from db import db
+from models import Journalist, Source
+
+
+def test_report(journalist_app, test_journo, test_source, config):
+    now = time.time()
+    with journalist_app.app_context():
+        storage = current_app.storage
+        source = Source.query.get(test_source['source'].id)
+        filesystem_id = source.filesystem_id
+        source.last_updated = (datetime.datetime.utcnow() -
+                               datetime.timedelta(days=10))
+        submissions = utils.db_helper.submit(source, 2)
+        utils.db_helper.reply(Journalist.query.get(test_journo['id']),
+                              source, 1)
+        old = storage.path(filesystem_id, submissions[0].filename)
+        os.utime(old, (now - 400 * 24 * 3600,) * 2)
+        storage.create_source_dir('ORPHAN')
+        with open(storage.path('ORPHAN', '1-msg.gpg'), 'w') as f:
+            f.write('x' * 100)
+        db.session.add(Source('EMPTY', 'empty source'))
+        db.session.commit()
+        with open(os.path.join(config.TEMP_DIR, 'upload'), 'w') as f:
+            f.write('x' * 10)
+
+        result = stats.report(storage, config, top=1, now=now)
+
+    assert result['database']['sources'] == 2
+    assert result['database']['messages']['count'] == 2
+    assert result['database']['documents']['count'] == 0
+    assert result['database']['replies']['count'] == 1
+    assert result['database']['sources_by_last_activity']['<30d'][
+        'count'] == 1
+
+    assert result['store']['sources'] == 2
+    assert result['store']['orphaned_sources'] == 1
+    assert result['store']['files'] == 4
+    assert result['store']['files_by_age']['>=365d']['count'] == 1
+
+    [top] = result['top_sources']
+    assert top['filesystem_id'] == filesystem_id
+    assert top['disk_files'] == 3
+    assert top['disk_bytes'] == top['bytes']
+    assert top['submissions']['count'] == 2
+    assert top['replies']['count'] == 1
+
+    assert result['temp']['bytes'] == 10
+    assert result['keyring']['files'] > 0
+    assert 'keys' not in result['keyring']
+    json.dumps(result)
+
+
+def test_manage_stats(journalist_app, test_source, capsys):
+    args = argparse.Namespace(top=5, jobs=2, count_keys=True)
+
+    with patch('manage.app_context', journalist_app.app_context):
+        assert manage.stats(args) == 0
+
+    result = json.loads(capsys.readouterr()[0])
+    assert result['keyring']['keys'] >= 2
+    assert [source['filesystem_id'] for source in result['top_sources']] == [
+        test_source['filesystem_id']]
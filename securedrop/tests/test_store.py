@@ -50,7 +50,9 @@ class TestStore(unittest.TestCase):
 
         generated_absolute_path = current_app.storage.path(filesystem_id)
 
-        expected_absolute_path = os.path.join(config.STORE_DIR, filesystem_id)
+        expected_absolute_path = os.path.join(config.STORE_DIR,
+                                              *store.shard(filesystem_id) +
+                                              (filesystem_id,))
         self.assertEquals(generated_absolute_path, expected_absolute_path)
 
     def test_path_returns_filename_of_items_within_folder(self):
@@ -62,9 +64,64 @@ class TestStore(unittest.TestCase):
                                                            item_filename)
 
         expected_absolute_path = os.path.join(config.STORE_DIR,
-                                              filesystem_id, item_filename)
+                                              *store.shard(filesystem_id) +
+                                              (filesystem_id, item_filename))
         self.assertEquals(generated_absolute_path, expected_absolute_path)
 
+    def test_path_finds_unmigrated_source_dirs(self):
+        source_directory, file_path = self.create_file_in_source_dir(
+            'example', '1-quintuple_cant-msg.gpg')
+
+        self.assertEquals(current_app.storage.path('example'),
+                          source_directory)
+        self.assertEquals(
+            current_app.storage.path('example', '1-quintuple_cant-msg.gpg'),
+            file_path)
+
+    def test_path_rejects_invalid_filesystem_id(self):
+        for filesystem_id in ('..', 'a/b', ''):
+            with self.assertRaises(store.PathException):
+                current_app.storage.path(filesystem_id, '1-abc-msg.gpg')
+
+    def test_verify_source_dir_in_wrong_shard(self):
+        with self.assertRaisesRegexp(store.PathException, 'Invalid directory'):
+            current_app.storage.verify(
+                os.path.join(config.STORE_DIR, 'ab', 'cd', 'example'))
+
+    def test_create_source_dir(self):
+        path = current_app.storage.create_source_dir('example')
+
+        self.assertTrue(os.path.isdir(path))
+        self.assertEquals(current_app.storage.path('example'), path)
+
+    def test_migrate_source_dir(self):
+        source_directory, file_path = self.create_file_in_source_dir(
+            'example', '1-quintuple_cant-msg.gpg')
+
+        self.assertEquals(list(current_app.storage.legacy_source_dirs()),
+                          ['example'])
+        self.assertTrue(current_app.storage.migrate_source_dir('example'))
+
+        self.assertFalse(os.path.exists(source_directory))
+        self.assertEquals(list(current_app.storage.legacy_source_dirs()), [])
+        self.assertTrue(os.path.exists(
+            current_app.storage.path('example', '1-quintuple_cant-msg.gpg')))
+        self.assertFalse(current_app.storage.migrate_source_dir('example'))
+
+    def test_migrate_source_dir_merges_into_existing_shard(self):
+        self.create_file_in_source_dir('example', '1-quintuple_cant-msg.gpg')
+        sharded = os.path.join(config.STORE_DIR,
+                               *store.shard('example') + ('example',))
+        os.makedirs(sharded)
+        open(os.path.join(sharded, '2-quintuple_cant-msg.gpg'), 'a').close()
+
+        self.assertTrue(current_app.storage.migrate_source_dir('example'))
+
+        self.assertEquals(sorted(os.listdir(sharded)),
+                          ['1-quintuple_cant-msg.gpg',
+                           '2-quintuple_cant-msg.gpg'])
+        self.assertEquals(current_app.storage.path('example'), sharded)
+
     def test_verify_path_not_absolute(self):
         with self.assertRaises(store.PathException):
             current_app.storage.verify(
@@ -130,9 +187,8 @@ class TestStore(unittest.TestCase):
     def test_get_zip(self):
         source, _ = utils.db_helper.init_source()
         submissions = utils.db_helper.submit(source, 2)
-        filenames = [os.path.join(config.STORE_DIR,
-                                  source.filesystem_id,
-                                  submission.filename)
+        filenames = [current_app.storage.path(source.filesystem_id,
+                                              submission.filename)
                      for submission in submissions]
 
         archive = zipfile.ZipFile(
@@ -144,24 +200,56 @@ class TestStore(unittest.TestCase):
             zipped_file_content = archive.read(archived_file)
             self.assertEquals(zipped_file_content, actual_file_content)
 
-    def test_rename_valid_submission(self):
+    def test_save_message_submission_uses_stable_filename(self):
+        source, _ = utils.db_helper.init_source()
+        filename = current_app.storage.save_message_submission(
+            source.filesystem_id, 1, 'hello')
+
+        self.assertEquals(filename, '1-msg.gpg')
+        self.assertTrue(os.path.exists(
+            current_app.storage.path(source.filesystem_id, filename)))
+
+    def test_save_message_submission_packs_short_messages(self):
         source, _ = utils.db_helper.init_source()
-        old_journalist_filename = source.journalist_filename
-        old_filename = utils.db_helper.submit(source, 1)[0].filename
-        new_journalist_filename = 'nestor_makhno'
-        expected_filename = old_filename.replace(old_journalist_filename,
-                                                 new_journalist_filename)
-        actual_filename = current_app.storage.rename_submission(
-            source.filesystem_id, old_filename,
-            new_journalist_filename)
-        self.assertEquals(actual_filename, expected_filename)
-
-    def test_rename_submission_with_invalid_filename(self):
-        original_filename = '1-quintuple_cant-msg.gpg'
-        returned_filename = current_app.storage.rename_submission(
-                'example-filesystem-id', original_filename,
-                'this-new-filename-should-not-be-returned')
-
-        # None of the above files exist, so we expect the attempt to rename
-        # the submission to fail and the original filename to be returned.
-        self.assertEquals(original_filename, returned_filename)
+        storage = current_app.storage
+        storage.backend.pack_max_size = 4096
+        try:
+            filename = storage.save_message_submission(
+                source.filesystem_id, 1, 'hello')
+        finally:
+            storage.backend.pack_max_size = 0
+
+        self.assertEquals(os.listdir(storage.path(source.filesystem_id)),
+                          ['_PACK'])
+        self.assertTrue(storage.stat(source.filesystem_id, filename).size > 0)
+        with storage.local_copy(source.filesystem_id, filename) as path:
+            with open(path) as f:
+                self.assertEquals(
+                    f.read(), storage.get(source.filesystem_id,
+                                          filename).read())
+
+    def test_display_filename(self):
+        self.assertEquals(store.display_filename('3-doc.gz.gpg', 'dull_cat'),
+                          '3-dull_cat-doc.gz.gpg')
+        # files stored under the old naming scheme get the current name
+        self.assertEquals(store.display_filename('3-old_name-reply.gpg',
+                                                 'dull_cat'),
+                          '3-dull_cat-reply.gpg')
+
+    def test_migrate_filename(self):
+        source_directory, file_path = self.create_file_in_source_dir(
+            'example', '1-quintuple_cant-msg.gpg')
+
+        new_filename = current_app.storage.migrate_filename(
+            'example', '1-quintuple_cant-msg.gpg')
+
+        self.assertEquals(new_filename, '1-msg.gpg')
+        self.assertEquals(os.listdir(source_directory), ['1-msg.gpg'])
+        # a file that was already renamed is left alone
+        self.assertEquals(current_app.storage.migrate_filename(
+            'example', '1-quintuple_cant-msg.gpg'), '1-msg.gpg')
+
+    def test_migrate_filename_of_missing_file(self):
+        with self.assertRaises(OSError):
+            current_app.storage.migrate_filename('example',
+                                                 '1-quintuple_cant-msg.gpg')
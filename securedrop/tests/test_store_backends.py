@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import os
+import uuid
+
+import pytest
+
+from cStringIO import StringIO
+from flask import current_app
+from mock import patch
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import store
+import store_backends
+
+from store_backends import PosixBackend, S3Backend
+
+# The S3 backend is tested against a local S3-compatible object store, such
+# as MinIO, when its endpoint is set, e.g.
+# SECUREDROP_TEST_S3_ENDPOINT_URL=http://localhost:9000
+S3_ENDPOINT_URL = os.environ.get('SECUREDROP_TEST_S3_ENDPOINT_URL')
+
+requires_s3 = pytest.mark.skipif(
+    not S3_ENDPOINT_URL,
+    reason="SECUREDROP_TEST_S3_ENDPOINT_URL is not set")
+
+
+@pytest.fixture
+def s3_backend():
+    backend = S3Backend(
+        'test-' + uuid.uuid4().hex,
+        prefix='store/',
+        endpoint_url=S3_ENDPOINT_URL,
+        region_name='us-east-1',
+        aws_access_key_id=os.environ.get('SECUREDROP_TEST_S3_ACCESS_KEY_ID',
+                                         'minioadmin'),
+        aws_secret_access_key=os.environ.get(
+            'SECUREDROP_TEST_S3_SECRET_ACCESS_KEY', 'minioadmin'))
+    backend.client.create_bucket(Bucket=backend.bucket)
+    backend.client.put_bucket_versioning(
+        Bucket=backend.bucket,
+        VersioningConfiguration={'Status': 'Enabled'})
+    yield backend
+    versions = backend.client.list_object_versions(Bucket=backend.bucket)
+    for version in (versions.get('Versions', []) +
+                    versions.get('DeleteMarkers', [])):
+        backend.client.delete_object(Bucket=backend.bucket,
+                                     Key=version['Key'],
+                                     VersionId=version['VersionId'])
+    backend.client.delete_bucket(Bucket=backend.bucket)
+
+
+def _check_backend(backend):
+    contents = os.urandom(9 * 1024 * 1024)  # more than one upload part
+    backend.put('source', '1-msg.gpg', StringIO(contents))
+    backend.put('source', '2-reply.gpg', StringIO('reply'))
+    backend.put('other', '1-msg.gpg', StringIO('other'))
+
+    f = backend.get('source', '1-msg.gpg')
+    try:
+        assert f.read() == contents
+    finally:
+        f.close()
+    assert backend.stat('source', '1-msg.gpg').size == len(contents)
+    assert [(stored.filename, stored.size)
+            for stored in backend.list('source')] == [
+        ('1-msg.gpg', len(contents)), ('2-reply.gpg', 5)]
+
+    backend.delete('source', '2-reply.gpg')
+    with pytest.raises(OSError):
+        backend.stat('source', '2-reply.gpg')
+    with pytest.raises(OSError):
+        backend.get('source', '2-reply.gpg')
+    assert [stored.filename for stored in backend.list('source')] == [
+        '1-msg.gpg']
+    assert backend.list('missing') == []
+
+
+def test_posix_backend(journalist_app):
+    with journalist_app.app_context():
+        for filesystem_id in ('source', 'other'):
+            current_app.storage.create_source_dir(filesystem_id)
+        _check_backend(PosixBackend(current_app.storage))
+
+
+def test_posix_backend_secure_delete(journalist_app):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        with patch('worker.enqueue_srm') as enqueue_srm:
+            storage.secure_delete([('source', '1-msg.gpg'), ('other',)])
+        enqueue_srm.assert_called_once_with([
+            storage.path('source', '1-msg.gpg'), storage.path('other')])
+
+
+def test_backend_from_config(config):
+    config.STORAGE_BACKEND = 'unknown'
+    with pytest.raises(ValueError):
+        store.Storage.from_config(config)
+
+    config.STORAGE_BACKEND = 'posix'
+    storage = store.Storage.from_config(config)
+    assert isinstance(storage.backend, PosixBackend)
+
+
+@requires_s3
+def test_s3_backend(s3_backend):
+    _check_backend(s3_backend)
+
+    assert s3_backend.client.head_object(
+        Bucket=s3_backend.bucket,
+        Key='store/{}/{}/source/1-msg.gpg'.format(*store.shard('source')))
+
+
+@requires_s3
+def test_s3_backend_purge_removes_all_versions(s3_backend):
+    s3_backend.put('source', '1-msg.gpg', StringIO('first'))
+    s3_backend.put('source', '1-msg.gpg', StringIO('second'))
+    s3_backend.put('source', '2-msg.gpg', StringIO('kept'))
+    s3_backend.put('other', '1-msg.gpg', StringIO('other'))
+
+    s3_backend.purge([('source', '1-msg.gpg'), ('other',)])
+
+    versions = s3_backend.client.list_object_versions(
+        Bucket=s3_backend.bucket, Prefix='store/')
+    assert [v['Key'] for v in versions.get('Versions', [])] == [
+        s3_backend.key('source', '2-msg.gpg')]
+    assert versions.get('DeleteMarkers', []) == []
+
+
+@requires_s3
+def test_storage_with_s3_backend(journalist_app, s3_backend, test_source):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        storage.backend = s3_backend
+        filesystem_id = test_source['filesystem_id']
+
+        filename = storage.save_message_submission(filesystem_id, 1, 'hello')
+
+        # The ciphertext was only staged in STORE_DIR
+        assert not os.path.exists(storage.path(filesystem_id, filename))
+        assert storage.stat(filesystem_id, filename).size > 0
+        stored = storage.get(filesystem_id, filename)
+        try:
+            ciphertext = stored.read()
+        finally:
+            stored.close()
+        with storage.local_copy(filesystem_id, filename) as path:
+            with open(path) as f:
+                assert f.read() == ciphertext
+        assert not os.path.exists(path)
+
+        with patch('worker.enqueue') as enqueue:
+            storage.secure_delete([(filesystem_id,)])
+        enqueue.assert_called_once_with(store_backends.purge_batch,
+                                        [(filesystem_id,)])
+
+
+def test_posix_backend_packs_small_files(journalist_app):
+    with journalist_app.app_context():
+        storage = current_app.storage
+        storage.create_source_dir('source')
+        backend = PosixBackend(storage, pack_max_size=10)
+        backend.put('source', '1-msg.gpg', StringIO('small'))
+        backend.put('source', '2-msg.gpg', StringIO('x' * 11))
+        backend.put('source', '3-doc.gz.gpg', StringIO('doc'))
+
+        assert sorted(os.listdir(storage.path('source'))) == [
+            '2-msg.gpg', '3-doc.gz.gpg', '_PACK']
+        assert backend.get('source', '1-msg.gpg').read() == 'small'
+        assert backend.get('source', '2-msg.gpg').read() == 'x' * 11
+        assert [(stored.filename, stored.size)
+                for stored in backend.list('source')] == [
+            ('1-msg.gpg', 5), ('2-msg.gpg', 11), ('3-doc.gz.gpg', 3)]
+
+        with patch('worker.enqueue_srm') as enqueue_srm:
+            backend.secure_delete([('source', '1-msg.gpg'),
+                                   ('source', '2-msg.gpg')])
+        enqueue_srm.assert_called_once_with(
+            [storage.path('source', '2-msg.gpg')],
+            compact=[storage.path('source')])
+        with pytest.raises(OSError):
+            backend.stat('source', '1-msg.gpg')
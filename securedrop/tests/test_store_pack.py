@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import pytest
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from rm import SecureDeleter
+import store_pack
+from store_pack import Pack
+
+
+def test_append_and_read(tmpdir):
+    pack = Pack(str(tmpdir))
+    assert not pack.exists()
+    assert pack.list() == []
+
+    pack.append('1-msg.gpg', 'first')
+    pack.append('2-reply.gpg', 'second\nline')
+
+    assert pack.read('1-msg.gpg') == 'first'
+    assert pack.read('2-reply.gpg') == 'second\nline'
+    assert pack.stat('2-reply.gpg')[0] == len('second\nline')
+    assert [(filename, size) for filename, size, _ in pack.list()] == [
+        ('1-msg.gpg', 5), ('2-reply.gpg', 11)]
+    with pytest.raises(OSError):
+        pack.read('3-msg.gpg')
+
+    # Another process only has the pack on disk to go by
+    assert Pack(str(tmpdir)).read('2-reply.gpg') == 'second\nline'
+
+
+def test_remove_and_compact(tmpdir):
+    pack = Pack(str(tmpdir))
+    pack.append('1-msg.gpg', 'secret')
+    pack.append('2-msg.gpg', 'kept')
+    pack.remove('1-msg.gpg')
+
+    with pytest.raises(OSError):
+        pack.stat('1-msg.gpg')
+    assert 'secret' in tmpdir.join('_PACK').read()
+
+    assert pack.compact(SecureDeleter(passes=1))
+    assert 'secret' not in tmpdir.join('_PACK').read()
+    assert sorted(os.listdir(str(tmpdir))) == ['_PACK']
+    assert pack.read('2-msg.gpg') == 'kept'
+
+    # Nothing left to compact
+    assert not pack.compact(SecureDeleter(passes=1))
+
+
+def test_interrupted_append_is_ignored(tmpdir):
+    pack = Pack(str(tmpdir))
+    pack.append('1-msg.gpg', 'complete')
+    with open(pack.path, 'ab') as f:
+        f.write('2-msg.gpg 100\npartial')
+
+    assert Pack(str(tmpdir)).list()[0][0] == '1-msg.gpg'
+    assert len(pack.list()) == 1
+
+    pack.append('3-msg.gpg', 'next')
+    assert pack.read('3-msg.gpg') == 'next'
+    assert 'partial' not in tmpdir.join('_PACK').read()
+
+
+def test_index_is_read_once_by_concurrent_readers(tmpdir):
+    pack = Pack(str(tmpdir))
+    for i in range(200):
+        pack.append('{}-msg.gpg'.format(i), 'message {}'.format(i))
+    for i in range(0, 200, 2):
+        pack.remove('{}-msg.gpg'.format(i))
+    store_pack._indexes.clear()
+
+    listed = []
+    threads = [threading.Thread(target=lambda: listed.append(pack.list()))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(len(entries) == 100 for entries in listed)
+    assert store_pack._indexes[pack.path].deleted == 100
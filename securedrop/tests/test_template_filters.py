@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import os
 
 from flask import session
+from jinja2.bccache import bc_magic
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 from sdconfig import SDConfig, config
@@ -115,3 +116,34 @@ class TestTemplateFilters(object):
             assert i18n.LOCALES == fake_config.SUPPORTED_LOCALES
             self.verify_filesizeformat(app)
             self.verify_rel_datetime_format(app)
+
+    def test_bytecode_cache(self, tmpdir):
+        fake_config = self.get_fake_config()
+        fake_config.TEMPLATE_CACHE_DIR = str(tmpdir.join('template-cache'))
+        app = source_app.create_app(fake_config)
+        with app.test_request_context('/'):
+            app.jinja_env.get_template('index.html')
+        cached = os.listdir(fake_config.TEMPLATE_CACHE_DIR)
+        assert cached
+
+        # Another process loads the compiled template from the cache
+        app = source_app.create_app(fake_config)
+        with app.test_request_context('/'):
+            app.jinja_env.get_template('index.html')
+        assert os.listdir(fake_config.TEMPLATE_CACHE_DIR) == cached
+
+        # A cached template cut short, before the end of its checksum which
+        # Jinja fails to load, is compiled again and replaced
+        for name in cached:
+            path = os.path.join(fake_config.TEMPLATE_CACHE_DIR, name)
+            with open(path, 'r+b') as f:
+                f.truncate(len(bc_magic) + 4)
+        app = source_app.create_app(fake_config)
+        with app.test_request_context('/'):
+            app.jinja_env.get_template('index.html')
+        assert os.listdir(fake_config.TEMPLATE_CACHE_DIR) == cached
+        source, filename, _ = app.jinja_env.loader.get_source(
+            app.jinja_env, 'index.html')
+        bucket = app.jinja_env.bytecode_cache.get_bucket(
+            app.jinja_env, 'index.html', filename, source)
+        assert bucket.code is not None
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import threading
+import time
+
+from mock import patch
+from redis.exceptions import ConnectionError
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import worker
+
+from worker import QueueFull, RQBackend, ThreadPoolBackend
+
+
+def _noop():
+    return 'success'
+
+
+def _fail():
+    raise ValueError('job failed')
+
+
+@pytest.fixture
+def backend():
+    original = worker._backend
+    backend = ThreadPoolBackend(threads=1)
+    worker.set_backend(backend)
+    yield backend
+    backend.join()
+    worker.set_backend(original)
+
+
+def test_thread_pool_runs_jobs(backend):
+    job = worker.enqueue(_noop)
+    backend.join()
+
+    assert job.get_status() == 'finished'
+    assert job.result == 'success'
+    assert backend.fetch_job(job.id) is job
+
+
+def test_thread_pool_records_failures(backend):
+    job = worker.enqueue(_fail)
+    backend.join()
+
+    assert job.get_status() == 'failed'
+    assert 'job failed' in job.exc_info
+
+
+def test_thread_pool_runs_higher_priorities_first(backend):
+    ran = []
+    gate = threading.Event()
+
+    # Block the only worker thread until every job is queued
+    worker.enqueue(gate.wait, 10)
+    for priority in ('low', 'default', 'high'):
+        worker.enqueue(ran.append, priority, priority=priority)
+    gate.set()
+    backend.join()
+
+    assert ran == ['high', 'default', 'low']
+
+
+def test_thread_pool_is_bounded():
+    backend = ThreadPoolBackend(threads=1, max_queue_size=1)
+    gate = threading.Event()
+    backend.enqueue(gate.wait, (10,), {}, 'default', 10)
+    # wait for the worker to pick up the first job, so the queue is empty
+    deadline = time.time() + 10
+    while backend.stats()['depth']['default']:
+        assert time.time() < deadline, 'The job was never picked up'
+        time.sleep(0.01)
+    backend.enqueue(_noop, (), {}, 'default', 10)
+
+    with pytest.raises(QueueFull):
+        backend.enqueue(_noop, (), {}, 'default', 10)
+    gate.set()
+    backend.join()
+
+
+def test_thread_pool_stats(backend):
+    worker.enqueue(_noop)
+    worker.enqueue(_noop)
+    backend.join()
+
+    stats = worker.stats()
+    assert stats['backend'] == 'thread'
+    assert stats['depth'] == {'high': 0, 'default': 0, 'low': 0}
+    latency = stats['latency'][worker.job_type(_noop)]
+    assert latency['count'] == 2
+    assert latency['run_max'] >= latency['run_avg'] >= 0
+
+
+def test_current_job_and_progress(backend, tmpdir):
+    paths = []
+    for i in range(3):
+        path = tmpdir.join('{}-abc-msg.gpg'.format(i))
+        path.write('x')
+        paths.append(str(path))
+
+    job = worker.enqueue_srm(paths)
+    backend.join()
+
+    assert worker.job_progress(job.id) == {'status': 'finished',
+                                           'done': 3,
+                                           'total': 3}
+    assert worker.job_progress('unknown') is None
+    assert os.listdir(str(tmpdir)) == []
+    assert worker.get_current_job() is None
+
+
+def test_enqueue_uses_job_type_defaults():
+    backend = ThreadPoolBackend()
+    with patch.object(worker, '_backend', backend), \
+            patch.object(backend, 'enqueue') as enqueue:
+        worker.enqueue_srm(['/nonexistent'])
+        worker.enqueue(_noop, priority='high', timeout=5)
+
+    assert enqueue.call_args_list[0][0][3:] == ('low', 3600)
+    assert enqueue.call_args_list[1][0][3:] == ('high', 5)
+
+
+def test_enqueue_rejects_unknown_priority(backend):
+    with pytest.raises(ValueError):
+        worker.enqueue(_noop, priority='urgent')
+
+
+def test_rq_backend_retries_enqueue():
+    backend = RQBackend(retries=2, retry_delay=0)
+    queue = backend.queues['default']
+    with patch.object(queue, 'enqueue_call',
+                      side_effect=[ConnectionError(), 'job']) as enqueue_call:
+        assert backend.enqueue(_noop, (), {}, 'default', 10) == 'job'
+    assert enqueue_call.call_count == 2
+
+    with patch.object(queue, 'enqueue_call',
+                      side_effect=ConnectionError()) as enqueue_call:
+        with pytest.raises(ConnectionError):
+            backend.enqueue(_noop, (), {}, 'default', 10)
+    assert enqueue_call.call_count == 3
+
+
+def test_backend_from_config():
+    class Config(object):
+        WORKER_BACKEND = 'thread'
+        WORKER_THREADS = 4
+
+    backend = worker.backend_from_config(Config())
+    assert isinstance(backend, ThreadPoolBackend)
+    assert backend.threads == 4
+
+    Config.WORKER_BACKEND = 'rq'
+    assert isinstance(worker.backend_from_config(Config()), RQBackend)
+
+    Config.WORKER_BACKEND = 'carrier-pigeon'
+    with pytest.raises(ValueError):
+        worker.backend_from_config(Config())
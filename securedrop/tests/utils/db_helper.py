@@ -10,6 +10,7 @@ from flask import current_app
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 from sdconfig import config
 import models
+import store
 
 from db import db
 
@@ -50,9 +51,8 @@ def reply(journalist, source, num_replies):
     assert num_replies >= 1
     replies = []
     for _ in range(num_replies):
-        source.interaction_count += 1
-        fname = "{}-{}-reply.gpg".format(source.interaction_count,
-                                         source.journalist_filename)
+        [count] = source.allocate_interactions()
+        fname = store.stored_filename(count, 'reply')
         current_app.crypto_util.encrypt(
             str(os.urandom(1)),
             [current_app.crypto_util.getkey(source.filesystem_id),
@@ -87,7 +87,7 @@ def mark_downloaded(*submissions):
                                       should be marked as downloaded.
     """
     for submission in submissions:
-        submission.downloaded = True
+        submission.mark_downloaded()
     db.session.commit()
 
 
@@ -109,7 +109,7 @@ def init_source_without_keypair():
     db.session.add(source)
     db.session.commit()
     # Create the directory to store their submissions and replies
-    os.mkdir(current_app.storage.path(source.filesystem_id))
+    current_app.storage.create_source_dir(source.filesystem_id)
 
     return source, codename
 
@@ -145,11 +145,10 @@ def submit(source, num_submissions):
     assert num_submissions >= 1
     submissions = []
     for _ in range(num_submissions):
-        source.interaction_count += 1
+        [count] = source.allocate_interactions()
         fpath = current_app.storage.save_message_submission(
             source.filesystem_id,
-            source.interaction_count,
-            source.journalist_filename,
+            count,
             str(os.urandom(1))
         )
         submission = models.Submission(source, fpath)
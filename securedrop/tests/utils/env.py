@@ -10,18 +10,12 @@ from os.path import abspath, dirname, isdir, join, realpath
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 from sdconfig import config
+import worker
 
 from db import db
 
 FILES_DIR = abspath(join(dirname(realpath(__file__)), '..', 'files'))
 
-# TODO: the PID file for the redis worker is hard-coded below.  Ideally this
-# constant would be provided by a test harness.  It has been intentionally
-# omitted from `config.py.example` in order to isolate the test vars from prod
-# vars.  When refactoring the test suite, the test_worker_pidfile
-# test_worker_pidfile is also hard-coded in `manage.py`.
-TEST_WORKER_PIDFILE = "/tmp/securedrop_test_worker.pid"
-
 
 def create_directories():
     """Create directories for the file store and the GPG keyring.
@@ -52,11 +46,16 @@ def setup():
 
 
 def teardown():
-    # make sure threads launched by tests complete before
+    # make sure threads and jobs launched by tests complete before
     # teardown, otherwise they may fail because resources
     # they need disappear
+    backend = worker.get_backend()
+    if isinstance(backend, worker.ThreadPoolBackend):
+        backend.join()
     for t in threading.enumerate():
-        if t.is_alive() and not isinstance(t, threading._MainThread):
+        # the job queue's worker threads are daemons that never exit
+        if (t.is_alive() and not t.daemon and
+                not isinstance(t, threading._MainThread)):
             t.join()
     db.session.remove()
     shutil.rmtree(config.TEMP_DIR)
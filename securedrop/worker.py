@@ -1,14 +1,412 @@
+# -*- coding: utf-8 -*-
+"""Background jobs.
+
+Jobs are enqueued through this module rather than through rq directly, so
+that the queue backend can be chosen in `config.py`:
+
+* ``rq`` (the default) hands jobs to Redis, where they are picked up by
+  ``rqworker -w worker.SchedulingWorker high default low``, which also
+  runs the recurring maintenance jobs.
+* ``thread`` runs jobs in a bounded pool of threads inside the current
+  process. This lets small installs and the test suite run without Redis,
+  at the cost of losing queued jobs if the process exits.
+
+Jobs have a priority (one of `PRIORITIES`) and a timeout, both of which
+default per job type, so short jobs don't wait behind hour-long shreds.
+"""
+import collections
+import itertools
+import logging
 import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from redis import ConnectionPool, Redis
+from redis.exceptions import ConnectionError, TimeoutError
+from rq import Queue, Worker
+from rq import get_current_job as get_current_rq_job
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue  # type: ignore
+
+import rm
+
+import typing
+# https://www.python.org/dev/peps/pep-0484/#runtime-or-type-checking
+if typing.TYPE_CHECKING:
+    # flake8 can not understand type annotation yet.
+    # That is why all type annotation relative import
+    # statements has to be marked as noqa.
+    # http://flake8.pycqa.org/en/latest/user/error-codes.html?highlight=f401
+    from typing import Any, Callable, Dict, Optional  # noqa: F401
+
+PRIORITIES = ('high', 'default', 'low')
+
+DEFAULT_TIMEOUT = 180
+
+# Default priority and timeout of each job type, keyed by the qualified name
+# of the job function. Timeouts can be overridden with WORKER_JOB_TIMEOUTS.
+JOB_TYPES = {
+    # `srm` can take a long time on large files, so allow it run for up to an
+    # hour, but don't let it hold up anything else
+    'rm.srm_batch': {'priority': 'low', 'timeout': 3600},
+    'store_backends.purge_batch': {'priority': 'low', 'timeout': 3600},
+    # Large documents take a while to copy to the store, but journalists are
+    # waiting for them
+    'spool.store_submission': {'priority': 'high', 'timeout': 3600},
+    # Exports of many GB take a while to write and checksum
+    'export.build_export': {'priority': 'default', 'timeout': 4 * 3600},
+}  # type: Dict[str, Dict[str, Any]]
+
+
+class QueueFull(Exception):
+
+    """Raised when a job is enqueued on a thread pool that already has as
+    many pending jobs as it allows."""
+
+
+def job_type(func):
+    # type: (Callable) -> str
+    return '{}.{}'.format(func.__module__, func.__name__)
+
+
+class RQBackend(object):
+
+    """Enqueue jobs on Redis, with one rq queue per priority. Enqueueing is
+    retried with exponential backoff if Redis can't be reached."""
+
+    name = 'rq'
+
+    def __init__(self, host='localhost', port=6379, db=0,
+                 max_connections=None, retries=3, retry_delay=0.1,
+                 queue_prefix=''):
+        pool = ConnectionPool(host=host, port=port, db=db,
+                              max_connections=max_connections)
+        self.connection = Redis(connection_pool=pool)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queues = dict((priority,
+                            Queue(name=queue_prefix + priority,
+                                  connection=self.connection))
+                           for priority in PRIORITIES)
+
+    def enqueue(self, func, args, kwargs, priority, timeout):
+        attempt = 0
+        while True:
+            try:
+                return self.queues[priority].enqueue_call(
+                    func, args=args, kwargs=kwargs, timeout=timeout)
+            except (ConnectionError, TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+    def fetch_job(self, job_id):
+        # Any of the queues can fetch any job, since jobs are stored by id
+        return self.queues['default'].fetch_job(job_id)
+
+    def stats(self):
+        return {'backend': self.name,
+                'depth': dict((priority, self.queues[priority].count)
+                              for priority in PRIORITIES)}
+
+
+class ThreadPoolJob(object):
+
+    """A job run by :class:`ThreadPoolBackend`. It offers the subset of the
+    :class:`rq.job.Job` interface used by SecureDrop."""
+
+    def __init__(self, func, args, kwargs, priority, timeout):
+        self.id = str(uuid.uuid4())
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.timeout = timeout
+        self.meta = {}  # type: Dict[str, Any]
+        self.result = None
+        self.exc_info = None  # type: Optional[str]
+        self.status = 'queued'
+        self.enqueued_at = time.time()
+        self.started_at = None  # type: Optional[float]
+        self.ended_at = None  # type: Optional[float]
+
+    def get_status(self):
+        return self.status
+
+    def save_meta(self):
+        # `meta` is only ever read from this process, nothing to persist
+        pass
+
+
+class ThreadPoolBackend(object):
+
+    """Run jobs on a bounded pool of threads in the current process.
+
+    At most `max_queue_size` jobs can be pending; enqueueing more raises
+    :exc:`QueueFull`. Job timeouts can't be enforced on threads, so jobs
+    that overrun are only logged. The most recent `max_finished_jobs` jobs
+    are kept so their status and progress can be fetched after they ran.
+    """
+
+    name = 'thread'
+
+    def __init__(self, threads=2, max_queue_size=1000, max_finished_jobs=1000):
+        self.threads = threads
+        self.__queue = queue.PriorityQueue(maxsize=max_queue_size)
+        self.__order = itertools.count()
+        self.__lock = threading.Lock()
+        self.__workers = []  # type: list
+        self.__jobs = collections.OrderedDict()  # type: Dict[str, ThreadPoolJob]  # noqa: E501
+        self.__max_finished_jobs = max_finished_jobs
+        self.__depth = dict((priority, 0) for priority in PRIORITIES)
+        self.__latency = {}  # type: Dict[str, Dict[str, Any]]
+        self.__current = threading.local()
+
+    def enqueue(self, func, args, kwargs, priority, timeout):
+        job = ThreadPoolJob(func, args, kwargs, priority, timeout)
+        with self.__lock:
+            try:
+                self.__queue.put_nowait(
+                    (PRIORITIES.index(priority), next(self.__order), job))
+            except queue.Full:
+                raise QueueFull("{} jobs already pending".format(
+                    self.__queue.maxsize))
+            self.__depth[priority] += 1
+            self.__jobs[job.id] = job
+            self.__start_workers()
+        return job
+
+    def fetch_job(self, job_id):
+        return self.__jobs.get(job_id)
+
+    def get_current_job(self):
+        return getattr(self.__current, 'job', None)
+
+    def join(self):
+        """Block until every job enqueued so far has run."""
+        self.__queue.join()
+
+    def stats(self):
+        with self.__lock:
+            latency = {}
+            for name, totals in self.__latency.items():
+                latency[name] = {
+                    'count': totals['count'],
+                    'wait_avg': totals['wait_total'] / totals['count'],
+                    'wait_max': totals['wait_max'],
+                    'run_avg': totals['run_total'] / totals['count'],
+                    'run_max': totals['run_max'],
+                }
+            return {'backend': self.name,
+                    'threads': self.threads,
+                    'depth': dict(self.__depth),
+                    'latency': latency}
+
+    def __start_workers(self):
+        # Threads are only started once there is work, so merely importing
+        # this module (e.g. in every web worker) stays cheap
+        while len(self.__workers) < self.threads:
+            thread = threading.Thread(target=self.__work)
+            thread.daemon = True
+            thread.start()
+            self.__workers.append(thread)
+
+    def __work(self):
+        while True:
+            _, _, job = self.__queue.get()
+            try:
+                self.__run(job)
+            finally:
+                self.__queue.task_done()
+
+    def __run(self, job):
+        with self.__lock:
+            self.__depth[job.priority] -= 1
+        job.started_at = time.time()
+        job.status = 'started'
+        self.__current.job = job
+        try:
+            job.result = job.func(*job.args, **job.kwargs)
+        except Exception:
+            job.exc_info = ''.join(traceback.format_exception(*sys.exc_info()))
+            job.status = 'failed'
+            logging.getLogger(__name__).error(
+                "Job {} ({}) failed: {}".format(job.id, job_type(job.func),
+                                                job.exc_info))
+        else:
+            job.status = 'finished'
+        finally:
+            self.__current.job = None
+            job.ended_at = time.time()
+        if job.timeout and job.ended_at - job.started_at > job.timeout:
+            logging.getLogger(__name__).warning(
+                "Job {} ({}) ran for longer than its {}s timeout".format(
+                    job.id, job_type(job.func), job.timeout))
+        self.__record(job)
+
+    def __record(self, job):
+        wait = job.started_at - job.enqueued_at
+        run = job.ended_at - job.started_at
+        with self.__lock:
+            totals = self.__latency.setdefault(job_type(job.func), {
+                'count': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+                'run_total': 0.0, 'run_max': 0.0})
+            totals['count'] += 1
+            totals['wait_total'] += wait
+            totals['wait_max'] = max(totals['wait_max'], wait)
+            totals['run_total'] += run
+            totals['run_max'] = max(totals['run_max'], run)
+
+            finished = [job_id for job_id, j in self.__jobs.items()
+                        if j.status in ('finished', 'failed')]
+            for job_id in finished[:-self.__max_finished_jobs]:
+                del self.__jobs[job_id]
+
+
+class SchedulingWorker(Worker):
+
+    """An rq worker that also runs the recurring maintenance jobs from
+    :mod:`maintenance` on a scheduler thread, for as long as it is working.
+    Run it with `rqworker -w worker.SchedulingWorker high default low`."""
+
+    def work(self, *args, **kwargs):
+        # Imported here because the web applications import this module
+        import journalist_app
+        import maintenance
+        from sdconfig import config
+
+        scheduler = maintenance.build_scheduler(
+            config, journalist_app.create_app(config))
+        scheduler.start()
+        try:
+            return super(SchedulingWorker, self).work(*args, **kwargs)
+        finally:
+            scheduler.stop()
+
+
+def backend_from_config(config):
+    default_backend = ('thread' if os.environ.get('SECUREDROP_ENV') == 'test'
+                       else 'rq')
+    backend = getattr(config, 'WORKER_BACKEND', default_backend)
+    if backend == 'thread':
+        return ThreadPoolBackend(
+            threads=getattr(config, 'WORKER_THREADS', 2),
+            max_queue_size=getattr(config, 'WORKER_MAX_QUEUE_SIZE', 1000))
+    elif backend == 'rq':
+        return RQBackend(
+            host=getattr(config, 'REDIS_HOST', 'localhost'),
+            port=getattr(config, 'REDIS_PORT', 6379),
+            max_connections=getattr(config, 'REDIS_MAX_CONNECTIONS', None),
+            retries=getattr(config, 'WORKER_ENQUEUE_RETRIES', 3))
+    raise ValueError("Unknown WORKER_BACKEND {}".format(backend))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the queue backend, creating it from the configuration the
+    first time it's needed rather than at import time."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            from sdconfig import config
+            _backend = backend_from_config(config)
+        return _backend
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+_job_app = None
+
+
+def job_app():
+    """Return the application jobs that need one run in, outside of any
+    request. It's created the first time it's needed."""
+    global _job_app
+    if _job_app is None:
+        # Imported here because the web applications import this module
+        import journalist_app
+        from sdconfig import config
+        _job_app = journalist_app.create_app(config)
+    return _job_app
+
+
+def enqueue(func, *args, **kwargs):
+    """Enqueue `func(*args, **kwargs)`. The `priority` and `timeout` keyword
+    arguments, if given, override the defaults for the job type and are not
+    passed on to `func`."""
+    defaults = JOB_TYPES.get(job_type(func), {})
+    priority = (kwargs.pop('priority', None) or
+                defaults.get('priority', 'default'))
+    timeout = kwargs.pop('timeout', None) or _job_timeout(func, defaults)
+    if priority not in PRIORITIES:
+        raise ValueError("Unknown priority {}".format(priority))
+    return get_backend().enqueue(func, args, kwargs, priority, timeout)
+
+
+def _job_timeout(func, defaults):
+    from sdconfig import config
+    overrides = getattr(config, 'WORKER_JOB_TIMEOUTS', {})
+    return overrides.get(job_type(func),
+                         defaults.get('timeout', DEFAULT_TIMEOUT))
+
+
+def get_current_job():
+    """Return the job running in the current worker, or `None` when called
+    outside of a job."""
+    backend = _backend
+    if isinstance(backend, ThreadPoolBackend):
+        job = backend.get_current_job()
+        if job is not None:
+            return job
+    return get_current_rq_job()
+
+
+def stats():
+    return get_backend().stats()
+
 
-from redis import Redis
-from rq import Queue
+def enqueue_srm(paths, compact=None):
+    """Enqueue a single job that securely deletes all of *paths*, instead of
+    one job per path, so that large deletions don't flood the queue. The
+    packs of the source directories in *compact* are compacted afterwards,
+    see :func:`rm.srm_batch`."""
+    if compact:
+        return enqueue(rm.srm_batch, list(paths), list(compact))
+    return enqueue(rm.srm_batch, list(paths))
 
-queue_name = 'test' if os.environ.get(
-    'SECUREDROP_ENV') == 'test' else 'default'
 
-# `srm` can take a long time on large files, so allow it run for up to an hour
-q = Queue(name=queue_name, connection=Redis(), default_timeout=3600)
+def set_progress(job, done, total):
+    """Record in the `meta` of `job` that `done` of its `total` items are
+    processed, for :func:`job_progress`."""
+    # Job functions can be called outside of a worker, in which case there
+    # is no job to report progress on
+    if job is None:
+        return
+    job.meta['progress'] = {'done': done, 'total': total}
+    job.save_meta()
 
 
-def enqueue(*args, **kwargs):
-    return q.enqueue(*args, **kwargs)
+def job_progress(job_id):
+    """Return the status and progress of the job *job_id* as a dict, or
+    `None` if the job is unknown (e.g. its result has expired)."""
+    job = get_backend().fetch_job(job_id)
+    if job is None:
+        return None
+    progress = job.meta.get('progress', {'done': 0, 'total': 0})
+    return {'status': job.get_status(),
+            'done': progress['done'],
+            'total': progress['total']}
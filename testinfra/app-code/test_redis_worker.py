@@ -7,7 +7,8 @@ securedrop_test_vars = pytest.securedrop_test_vars
 
 @pytest.mark.parametrize('config_line', [
   '[program:securedrop_worker]',
-  'command=/usr/local/bin/rqworker',
+  ('command=/usr/local/bin/rqworker -w worker.SchedulingWorker '
+   'high default low'),
   "directory={}".format(securedrop_test_vars.securedrop_code),
   'autostart=true',
   'autorestart=true',
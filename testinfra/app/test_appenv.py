@@ -62,12 +62,13 @@ def test_ensure_logo(File, Sudo):
 
 
 def test_securedrop_tmp_clean_cron(Command, Sudo):
-    """ Ensure securedrop tmp clean cron job in place """
+    """ Ensure securedrop tmp clean cron job is gone, the worker's scheduler
+    runs it now """
     with Sudo():
         cronlist = Command("crontab -l").stdout
         cronjob = "@daily {}/manage.py clean-tmp".format(
             sdvars.securedrop_code)
-        assert cronjob in cronlist
+        assert cronjob not in cronlist
 
 
 def test_app_workerlog_dir(File, Sudo):